@@ -1,32 +1,42 @@
 """Main body of the code for shuffling dialogue in videos, including the main function."""
 
+import os
 import json
-import argparse
-import random
+import time
+import shutil
 import typing
+import argparse
+import threading
 from decimal import Decimal
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, Future
 
 # note: you must install ffmpeg executable
 import ffmpeg
+import kingsquit.demux
 import kingsquit.downloader
+import kingsquit.timestamps
+from kingsquit import media, ledger, trace, backends, journal
+from kingsquit.manifest import (ClipEntry, load_manifest, save_manifest, ok_entries, manifest_name, status_ok,
+                                status_failed, status_repaired)
+from kingsquit.plan import (t_type, tl_type, get_intermediate_timestamps, plan_memoised_reform,
+                            get_replacement_owners, get_dialogue_keys, shuffle_items, shuffle_strategies, new_seed)
 
 
 # polish for general release
-# make the same dialogue make the same sound - record mappings, add text back to timestamps file
 # gold coin
-# todo: add more argparse
 # todo: give all relevant folders as arguments instead of getting them from video path - better code
-# todo: fix invalid timestamps from subs by removing timestamps that go over the duration and fixing ones that overlap
-# todo: readable error message if ffmpeg executable is not found
 # maybe move the video processing code to its own file like downloader.py and just have this be the main stuff
 __version__ = '0.1.3'
 
 
-t_type = typing.Tuple[float, float]
-tl_type = typing.List[t_type]
 videos_folder = Path('kingsquit-videos')
+renderer_names = ['pcm', 'filtergraph', 'streaming', 'clips']
+# seconds between saves of the clips made so far, so a stopped run can carry on from them
+checkpoint_interval = 5.0
+# clips are pcm, which has no encoder delay or padding, so they join without gaps and their lengths are exact.
+# the audio is only encoded once, when it's muxed into the new video
+clip_extension = '.wav'
 
 
 def verify_timestamp_pairs(timestamps: tl_type, maximum: float) -> bool:
@@ -37,31 +47,43 @@ def verify_timestamp_pairs(timestamps: tl_type, maximum: float) -> bool:
         maximum -- the maximum size of any timestamp (the duration of the video)
     Returns True if the timestamps list is valid, False otherwise.
     """
+    if not timestamps:
+        return False
+
     last = 0.0
     for t in timestamps:
-        if last >= t[0] or t[0] >= t[1]:
+        if last > t[0] or t[0] >= t[1]:
             return False
-        if maximum and t[1] >= maximum:
+        if maximum and t[1] > maximum:
             return False
+        last = t[1]
 
     return True
 
 
+def get_duration(t: t_type) -> Decimal:
+    """Get the duration of a timestamp exactly, without float rounding errors."""
+    return Decimal(str(t[1])) - Decimal(str(t[0]))
+
+
 class ProgressBarRunner:
-    """Class for a simple progress bar."""
+    """Class for a simple progress bar, which can be moved on from many threads at once."""
 
-    def __init__(self, total, progress_divisor=10):
+    def __init__(self, total, progress_divisor=10, name='clips'):
         """Initialise an instance.
 
         Args:
             total -- total jobs that need doing
             progress_divisor -- a new progress symbol will be printed about this many times
+            name -- name of the counter in the trace
         """
         self.total = total
+        self.name = name
 
         self.progress_bar_interval = self.total // progress_divisor
         self.last_log = 0
         self.done = 0
+        self.lock = threading.Lock()
 
     def progress(self):
         """Increment self.done, and if it's significant, print something.
@@ -69,16 +91,53 @@ class ProgressBarRunner:
         If done is 1 it means we just started so it prints a start message and one ascii block.
         If done is more than the last log time add the interval, print one ascii block.
         If done is equal to total, print a finished message.
+        The count is also written to the trace, if tracing is on.
         """
-        self.done += 1
+        with self.lock:
+            self.done += 1
+
+            if self.done == 1:
+                print(f'Doing {self.total} {self.name}\n█', end='')
+            if self.done == self.total:
+                print(f'\nDid {self.done} {self.name}!')
+            elif self.done >= self.last_log + self.progress_bar_interval:
+                print('█', end='')
+                self.last_log += self.progress_bar_interval
+
+            trace.counter(self.name, done=self.done, total=self.total)
 
-        if self.done == 1:
-            print(f'Doing {self.total} clips\n█', end='')
-        if self.done == self.total:
-            print(f'\nDid {self.done} clips!')
-        elif self.done >= self.last_log + self.progress_bar_interval:
-            print('█', end='')
-            self.last_log += self.progress_bar_interval
+
+class ManifestCheckpoint:
+    """Class for saving the manifest of the clips made so far every so often, as they're made by many threads."""
+
+    def __init__(self, folder: Path, entries: list[typing.Optional[ClipEntry]]):
+        """Initialise an instance.
+
+        Args:
+            folder -- folder of the clips, to save the manifest in
+            entries -- manifest entry of each clip in timeline order, with None for the ones that aren't made yet
+        """
+        self.folder = folder
+        self.entries = entries
+        self.last_save = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, index: int, entry: ClipEntry):
+        """Record a clip that's been made, and save the manifest if it hasn't been saved for a while."""
+        with self.lock:
+            self.entries[index] = entry
+            if time.monotonic() - self.last_save >= checkpoint_interval:
+                self.save_locked()
+
+    def save(self):
+        """Save the manifest of the clips made so far."""
+        with self.lock:
+            self.save_locked()
+
+    def save_locked(self):
+        """Save the manifest of the clips made so far, when the lock is already held."""
+        save_manifest(self.folder, [e for e in self.entries if e is not None])
+        self.last_save = time.monotonic()
 
 
 # made this way to work with ThreadPoolExecutor
@@ -86,311 +145,965 @@ class ClipRipper(ProgressBarRunner):
     """Class for storing the video path and output path for ripping clips."""
 
     def __init__(self, video_path, clips_folder, total):
-        """Save the video path and clips folder to the instance."""
+        """Save the video path and clips folder to the instance.
+
+        The video path can be an audio-only copy of the video from kingsquit.demux instead, which is faster to rip from.
+        """
         self.video_path = video_path
         self.clips_folder = clips_folder
 
         super().__init__(total)
 
-    def rip_audio_clip(self, t: t_type):
-        """Take a snippet of audio from a video and save it to its own mp3 file.
+    def rip_audio_clip(self, t: t_type) -> ClipEntry:
+        """Take a snippet of audio from a video and save it to its own wav file.
 
         Args:
             t -- a tuple of the time to start the clip and the time to end the clip, in seconds
-        Returns nothing.
+        Returns the manifest entry for the clip, with its real duration if it was ripped successfully.
+        A clip that fails or comes out the wrong length is repaired with repair_audio_clip.
 
         Gets the video path and output folder path from the object. This is so it can easily be used in a
         ThreadPoolExecutor.
-        Saves the mp3 file with the name {start time}d{duration}.mp3 where both start time and duration are in seconds,
+        Saves the wav file with the name {start time}d{duration}.wav where both start time and duration are in seconds,
         like the timestamp argument.
         """
         self.progress()
 
-        t_duration = Decimal(str(t[1])) - Decimal(str(t[0]))
-        clip_path = self.clips_folder / f'{t[0]}d{t_duration}.mp3'
-        stream = ffmpeg.input(str(self.video_path), ss=t[0])
-        # skip clips already ripped with -n
-        stream = ffmpeg.output(stream, str(clip_path), t=t_duration).global_args('-n')
-        ffmpeg.run(stream, quiet=True)
+        t_duration = get_duration(t)
+        clip_path = self.clips_folder / f'{t[0]}d{t_duration}{clip_extension}'
+        with trace.span('rip_audio_clip', 'clip', start=t[0], duration=float(t_duration)) as details:
+            stream = ffmpeg.input(str(self.video_path), ss=t[0])
+            stream = ffmpeg.output(stream, str(clip_path), t=t_duration)
+            try:
+                media.run(stream, quiet=True, overwrite_output=True)
+            except ffmpeg.Error:
+                entry = ClipEntry(t[0], float(t_duration), None, clip_path, status_failed)
+            else:
+                entry = ClipEntry(t[0], float(t_duration), media.get_wav_duration(clip_path), clip_path, status_ok)
+
+            if ledger.needs_repair(entry):
+                entry = repair_audio_clip(self.video_path,
+                                          [(self.video_path, Decimal(str(t[0])), Decimal(str(t[1])))], t, clip_path)
+            details['status'] = entry.status
+        return entry
+
+
+def repair_audio_clip(video_path: Path, components: list[tuple[Path, Decimal, Decimal]], t: t_type,
+                      out_path: Path) -> ClipEntry:
+    """Make a clip again in one ffmpeg run, cutting its parts at exact sample offsets and padding or cutting it to
+    exactly the right number of samples.
+
+    Args:
+        video_path -- path to the video, to match its sample rate and channels
+        components -- a list of tuples, each containing source path, start time, and end time.
+                      a start and end of 0 means the whole source
+        t -- timestamp of the clip, for its start and the duration it should be
+        out_path -- path to save the clip to
+    Returns the manifest entry for the clip.
+
+    If the components can't be read at all, the clip is made as silence instead, so that one bad clip never stops the
+    whole shuffle or shortens the audio.
+    """
+    t_duration = get_duration(t)
+    audio_info = media.get_audio_stream_info(backends.get_backend().probe(video_path))
+    sample_rate = int(audio_info['sample_rate'])
+    length = round(t_duration * sample_rate)
+    streams = []
+    for path, start, end in components:
+        if start or end:
+            streams.append(backends.seek_audio(path, round(start * sample_rate), round(end * sample_rate),
+                                               sample_rate))
+        else:
+            streams.append(ffmpeg.input(str(path)).audio.filter('aresample', sample_rate))
+    stream = ffmpeg.concat(*streams, v=0, a=1) if len(streams) > 1 else streams[0]
+    stream = stream.filter('apad', whole_len=length).filter('atrim', end_sample=length)
+    stream = ffmpeg.output(stream, str(out_path), ac=audio_info['channels'])
+    try:
+        media.run(stream, quiet=True, overwrite_output=True)
+    except ffmpeg.Error:
+        print(f'\nCould not repair the clip at {t[0]}s, using silence')
+        stream = ffmpeg.input(f'anullsrc=r={sample_rate}', format='lavfi').filter('atrim', end_sample=length)
+        stream = ffmpeg.output(stream, str(out_path), ac=audio_info['channels'])
+        media.run(stream, quiet=True, overwrite_output=True)
+    return ClipEntry(t[0], float(t_duration), media.get_wav_duration(out_path), out_path, status_repaired)
 
 
-def rip_all_audio_clips(video_path: Path, timestamps: tl_type, dest='audio-clips') -> Path:
-    """Rip an audio clip from the video for each timestamp.
+@trace.stage
+def rip_all_audio_clips(video_path: Path, timestamps: tl_type, dest='audio-clips', workers: int = None,
+                        source_path: Path = None) -> Path:
+    """Rip an audio clip from the video for each timestamp, and write the folder's manifest.
 
     Args:
         video_path -- path to the video to rip clips from
         timestamps -- list of tuple start/end timestamps
         dest -- name of the destination folder
+        workers -- number of clips to rip at once, the ThreadPoolExecutor default if None
+        source_path -- file to rip the clips from instead of the video, like its audio-only copy from kingsquit.demux
     Returns the path of the destination folder.
+
+    The stage is recorded in the video folder's journal, keyed on the video and the timestamps. It's skipped if it
+    already finished with the same key and all its clips are still there. If it was stopped part way, the clips the
+    manifest says were already ripped successfully are skipped, and the manifest is saved every so often while
+    ripping so there's something to carry on from.
     """
-    clips_folder = video_path.with_suffix('') / dest
+    video_folder = video_path.with_suffix('')
+    clips_folder = video_folder / dest
     clips_folder.mkdir(parents=True, exist_ok=True)
 
-    clip_ripper = ClipRipper(video_path, clips_folder, len(timestamps))
+    rip_journal = journal.get_journal(video_folder)
+    key = journal.make_key(journal.file_key(video_path), timestamps, clip_extension)
+    if rip_journal.is_done(dest, key):
+        print(f'{dest}: already ripped')
+        return clips_folder
+
+    # clips from a run with a different video or timestamps can't be used
+    old_entries = {}
+    if rip_journal.get(dest, key):
+        old_entries = {e.start: e for e in ok_entries(load_manifest(clips_folder)) if e.path.is_file()}
+    else:
+        rip_journal.start(dest, key)
+    entries = []
+    to_rip = []
+    for i, t in enumerate(timestamps):
+        old_entry = old_entries.get(t[0])
+        if old_entry and old_entry.duration == float(get_duration(t)):
+            entries.append(old_entry)
+        else:
+            entries.append(None)
+            to_rip.append(i)
+
+    clip_ripper = ClipRipper(source_path or video_path, clips_folder, len(to_rip))
+    checkpoint = ManifestCheckpoint(clips_folder, entries)
+
+    def rip_job(i: int):
+        checkpoint.add(i, clip_ripper.rip_audio_clip(timestamps[i]))
+
     # one thread
-    # for t in timestamps:
-    #     clip_ripper.rip_audio_clip(t)
+    # for i in to_rip:
+    #     rip_job(i)
 
     # multithread
-    with ThreadPoolExecutor() as threads:
-        threads.map(clip_ripper.rip_audio_clip, timestamps)
+    try:
+        with ThreadPoolExecutor(workers) as threads:
+            for _ in threads.map(rip_job, to_rip):
+                pass
+    except BaseException:
+        checkpoint.save()
+        raise
+
+    save_manifest(clips_folder, entries)
+    rip_journal.finish(dest, key, [e.path for e in ok_entries(entries)] + [clips_folder / manifest_name])
+    print(f'{dest}: {ledger.describe_ledger(ledger.summarise_ledger(entries))}')
 
     return clips_folder
 
 
-def rip_intermediate_audio_clips(video_path: Path, timestamps: tl_type, video_duration: float):
+@trace.stage
+def rip_intermediate_audio_clips(video_path: Path, timestamps: tl_type, video_duration: float, workers: int = None,
+                                 source_path: Path = None):
     """Calculate timestamps where there are is no dialogue and rip them.
 
     Args:
         video_path -- path to the video to rip clips from
         timestamps -- timestamps of dialogue, used to calculate where there is no dialogue
         video_duration -- length of the video in seconds, used to calculate the final timestamp
+        workers, source_path -- passed on to rip_all_audio_clips
     Returns the path of the destination folder.
 
     Uses rip_all_audio_clips to rip the clips after calculating their timestamps.
     """
-    intermediate_timestamps = []
-    if timestamps[0][0] != 0.0:
-        intermediate_timestamps.append((0.0, timestamps[0][0]))
-    for i in range(len(timestamps) - 1):
-        if timestamps[i][1] != timestamps[i+1][0]:
-            intermediate_timestamps.append((timestamps[i][1], timestamps[i+1][0]))
-    if timestamps[-1][1] <= video_duration:
-        intermediate_timestamps.append((timestamps[-1][1], video_duration))
+    intermediate_timestamps = get_intermediate_timestamps(timestamps, video_duration)
+    return rip_all_audio_clips(video_path, intermediate_timestamps, dest='audio-clips-intermediate',
+                               workers=workers, source_path=source_path)
 
-    return rip_all_audio_clips(video_path, intermediate_timestamps, dest='audio-clips-intermediate')
 
-
-def shuffle_clips(video_path: Path, jump_chance: float = 0.3):
-    """Shuffle the files in the folder in chunks.
+@trace.stage
+def shuffle_clips(video_path: Path, strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3):
+    """Shuffle the clips in the folder, in chunks by default.
 
     Args:
         video_folder  -- path to the video, to find the audio-clips folder
+        strategy -- name of the shuffle strategy to use, see kingsquit.plan.shuffle_strategies
+        seed -- seed for the shuffle, so it can be made again
         jump_chance -- chance that audio will jump to a new random clip instead of continuing to the next clip.
                        therefore, the size of each chunk on average should the number of clips / jump chance
-    Returns a last of clips paths, shuffled.
+    Returns a list of manifest entries for the clips, shuffled.
     """
     video_folder = video_path.with_suffix('')
     clips_folder = video_folder / 'audio-clips'
-    clips = list(clips_folder.iterdir())
-    clips.sort()
-
-    clips_shuffled = []
-    # todo: more efficient implementation by just getting random indices then splitting at them?
-    while clips:
-        index = random.randint(0, len(clips))
-        while jump_chance < random.random():
-            try:
-                clips_shuffled.append(clips.pop(index))
-                index += 1
-            except IndexError:
-                break
-
-    return clips_shuffled
+    clips = ok_entries(load_manifest(clips_folder))
+    return shuffle_items(clips, strategy, seed, jump_chance, [c.best_duration for c in clips])
 
 
-def reform_one_clip(video_path: Path, timestamp: t_type, components: list[tuple[Path, float, float]]):
+def reform_one_clip(video_path: Path, timestamp: t_type, components: list[tuple[Path, Decimal, Decimal]],
+                    scratch_folder: Path = None, job: int = 0) -> ClipEntry:
     """Take snippets from a few clips and combine them into one.
 
     Args:
         video_path -- path to the video to get the folder paths from
         timestamp -- timestamp of the clip we're making, used to pick the destination file name
-        components -- a list of tuples, each containing clip path, start time, and end time
-    Returns nothing.
+        components -- a list of tuples, each containing clip path, start time, and end time.
+                      a start and end of 0 means the whole clip
+        scratch_folder -- folder to make the new clip in, the video folder by default
+        job -- number used to name this clip's working files, so clips can be made at the same time
+    Returns the manifest entry for the new clip. Raises ffmpeg.Error if ffmpeg fails.
     """
-    video_folder = video_path.with_suffix('')
-    components_folder = video_folder / 'audio-components'
-    shuffled_clips_folder = video_folder / 'audio-shuffled'
-    components_folder.mkdir(exist_ok=True)
-    shuffled_clips_folder.mkdir(exist_ok=True)
-
-    concat_file_path = components_folder / 'concat.txt'
+    scratch_folder = scratch_folder or video_path.with_suffix('')
+    components_folder = scratch_folder / 'audio-components'
+    shuffled_clips_folder = scratch_folder / 'audio-shuffled'
+    components_folder.mkdir(parents=True, exist_ok=True)
+    shuffled_clips_folder.mkdir(parents=True, exist_ok=True)
+
+    concat_file_path = components_folder / f'{job}-concat.txt'
+    # cut parts of clips are only needed until they're joined, so they're deleted straight after
+    working_paths = [concat_file_path]
     concat_list = []
-    for component in components:
-        if component[1] or component[2]:
-            component_duration = Decimal(str(component[2])) - Decimal(str(component[1]))
-            out_name = f'{component[1]}d{component_duration}.mp3'
-            out_path = components_folder / out_name
-            stream = ffmpeg.input(str(component[0]), ss=component[1])
-            stream = ffmpeg.output(stream, str(out_path), to=component[2])
-            ffmpeg.run(stream, quiet=True, overwrite_output=True)
-
-            concat_new_path = out_path
-        else:
-            concat_new_path = component[0]
-        concat_new_str = str(concat_new_path.resolve()).replace('\\', '\\\\')
-        concat_list.append(f"file '{concat_new_str}'\n")
+    try:
+        for n, component in enumerate(components):
+            if component[1] or component[2]:
+                out_path = components_folder / f'{job}-{n}{clip_extension}'
+                working_paths.append(out_path)
+                stream = ffmpeg.input(str(component[0]), ss=component[1])
+                stream = ffmpeg.output(stream, str(out_path), t=component[2] - component[1])
+                media.run(stream, quiet=True, overwrite_output=True)
+
+                concat_new_path = out_path
+            else:
+                concat_new_path = component[0]
+            concat_new_str = str(concat_new_path.resolve()).replace('\\', '\\\\')
+            concat_list.append(f"file '{concat_new_str}'\n")
 
-    with open(concat_file_path, 'w') as concat_file:
-        concat_file.writelines(concat_list)
+        with open(concat_file_path, 'w') as concat_file:
+            concat_file.writelines(concat_list)
 
-    # todo: fix bug where this will break when a clip is extremely short
-    timestamp_duration = Decimal(str(timestamp[1])) - Decimal(str(timestamp[0]))
-    out_path = shuffled_clips_folder / f'{timestamp[0]}d{timestamp_duration}.mp3'
-    stream = ffmpeg.input(str(concat_file_path), format='concat', safe=0)
-    stream = ffmpeg.output(stream, str(out_path), **{'c:a': 'copy'})
-    ffmpeg.run(stream, quiet=True, overwrite_output=True)
+        timestamp_duration = get_duration(timestamp)
+        out_path = shuffled_clips_folder / f'{timestamp[0]}d{timestamp_duration}{clip_extension}'
+        stream = ffmpeg.input(str(concat_file_path), format='concat', safe=0)
+        stream = ffmpeg.output(stream, str(out_path), **{'c:a': 'copy'})
+        media.run(stream, quiet=True, overwrite_output=True)
+    finally:
+        for path in working_paths:
+            path.unlink(missing_ok=True)
+
+    return ClipEntry(timestamp[0], float(timestamp_duration), media.get_wav_duration(out_path), out_path, status_ok)
 
 
-# todo: add multithreading?
-def reform_shuffled_clips(video_path: Path, timestamps: tl_type, shuffled_clips: list[Path]) -> Path:
-    """Cut and join shuffled clips to match the timestamps again.
+def make_reformed_clip(video_path: Path, timestamp: t_type, components: list[tuple[Path, Decimal, Decimal]],
+                       scratch_folder: Path = None, job: int = 0) -> ClipEntry:
+    """Reform one clip, and repair it on its own if that fails or it comes out the wrong length.
+
+    Takes the same arguments as reform_one_clip. Returns the manifest entry for the new clip.
+    """
+    with trace.span('reform_clip', 'clip', start=timestamp[0], duration=float(get_duration(timestamp)),
+                    components=len(components)) as details:
+        try:
+            entry = reform_one_clip(video_path, timestamp, components, scratch_folder, job)
+        except ffmpeg.Error:
+            entry = None
+        if entry is None or ledger.needs_repair(entry):
+            scratch_folder = scratch_folder or video_path.with_suffix('')
+            out_path = scratch_folder / 'audio-shuffled' / f'{timestamp[0]}d{get_duration(timestamp)}{clip_extension}'
+            entry = repair_audio_clip(video_path, components, timestamp, out_path)
+        details['status'] = entry.status
+    return entry
+
+
+def cut_repeated_clip(timestamp: t_type, owner_timestamp: t_type, owner_entry: ClipEntry,
+                      scratch_folder: Path) -> ClipEntry:
+    """Make the clip for a repeated line of dialogue from the start of the clip made for its longest time.
 
     Args:
-        video_path -- path to the video, used to get the video folder and clips folder
-        timestamps -- list of tuple timestamps to make the clips conform to
-        shuffled_clips -- ordered list of clips paths
-    Returns the path to the folder of shuffled and reformed clips.
+        timestamp -- timestamp of the clip we're making
+        owner_timestamp -- timestamp of the clip with the whole replacement for the line
+        owner_entry -- manifest entry of that clip
+        scratch_folder -- folder the clips are made in
+    Returns the manifest entry for the clip. Raises ffmpeg.Error if ffmpeg fails.
+
+    A line said for just as long uses the same file, so it isn't made at all.
     """
-    video_folder = video_path.with_suffix('')
-    shuffled_clips_folder = video_folder / 'audio-shuffled'
+    timestamp_duration = get_duration(timestamp)
+    if timestamp_duration == get_duration(owner_timestamp):
+        return owner_entry._replace(start=timestamp[0])
 
-    progress_bar = ProgressBarRunner(len(timestamps))
+    out_path = scratch_folder / 'audio-shuffled' / f'{timestamp[0]}d{timestamp_duration}{clip_extension}'
+    stream = ffmpeg.output(ffmpeg.input(str(owner_entry.path)), str(out_path), t=timestamp_duration)
+    media.run(stream, quiet=True, overwrite_output=True)
+    return ClipEntry(timestamp[0], float(timestamp_duration), media.get_wav_duration(out_path), out_path, status_ok)
 
-    cursor_file_index = 0
-    cursor_time = Decimal('0.0')
-    for t in timestamps:
-        t_duration = Decimal(str(t[1])) - Decimal(str(t[0]))
-        time_to_fill = t_duration
+
+def make_repeated_clip(video_path: Path, timestamp: t_type, owner_timestamp: t_type, owner_entry: ClipEntry,
+                       scratch_folder: Path = None) -> ClipEntry:
+    """Cut a repeated line's clip from its longest one, and repair it on its own if that fails or it comes out the
+    wrong length.
+
+    Takes the same arguments as cut_repeated_clip. Returns the manifest entry for the new clip.
+    """
+    scratch_folder = scratch_folder or video_path.with_suffix('')
+    with trace.span('cut_repeated_clip', 'clip', start=timestamp[0], duration=float(get_duration(timestamp)),
+                    components=1) as details:
+        try:
+            entry = cut_repeated_clip(timestamp, owner_timestamp, owner_entry, scratch_folder)
+        except ffmpeg.Error:
+            entry = None
+        if entry is None or ledger.needs_repair(entry):
+            out_path = scratch_folder / 'audio-shuffled' / f'{timestamp[0]}d{get_duration(timestamp)}{clip_extension}'
+            entry = repair_audio_clip(video_path, [(owner_entry.path, Decimal(0), get_duration(timestamp))],
+                                      timestamp, out_path)
+        details['status'] = entry.status
+    return entry
+
+
+def plan_reformed_clips(timestamps: tl_type, shuffled_clips: list[ClipEntry], texts: list[str] = None
+                        ) -> tuple[list[list[tuple[Path, Decimal, Decimal]]], list[int]]:
+    """Work out which parts of which shuffled clips make up each reformed clip, without running ffmpeg.
+
+    Args:
+        timestamps -- list of tuple timestamps to make the clips conform to
+        shuffled_clips -- ordered list of manifest entries for the clips
+        texts -- text of each timestamp, so the same lines get the same replacement. None if unknown
+    Returns a tuple of a list of components for each timestamp, in the form reform_one_clip takes, and the number
+    of the replacement each timestamp takes the start of, see kingsquit.plan.plan_memoised_reform.
+    """
+    durations = [Decimal(str(c.best_duration)) for c in shuffled_clips]
+    reform_plan, replacement_numbers = plan_memoised_reform(durations, [get_duration(t) for t in timestamps],
+                                                            get_dialogue_keys(texts, len(timestamps)))
+
+    all_components = []
+    for components in reform_plan:
         reformed_clip_content = []
-        while time_to_fill > 0:
-            clip_to_add = shuffled_clips[cursor_file_index]
-            clip_duration = Decimal(clip_to_add.stem[clip_to_add.stem.index('d') + 1:])
-
-            clip_start = cursor_time
-            clip_duration_from_cursor = clip_duration - clip_start
-            if clip_duration_from_cursor > time_to_fill:
-                clip_end = clip_start + time_to_fill
-                cursor_time = clip_end
-            else:
-                cursor_time = Decimal('0.0')
-                cursor_file_index += 1
-                if not clip_start:
-                    clip_end = 0.0
-                else:
-                    clip_end = clip_duration
+        for index, start, end in components:
+            if not start and end == durations[index]:
+                # whole clip, no need to cut it
+                start, end = Decimal(0), Decimal(0)
+            reformed_clip_content.append((shuffled_clips[index].path, start, end))
+        all_components.append(reformed_clip_content)
+
+    return all_components, replacement_numbers
 
-            reformed_clip_content.append((clip_to_add, clip_start, clip_end))
-            time_to_fill -= clip_duration
 
-        reform_one_clip(video_path, t, reformed_clip_content)
+@trace.stage
+def reform_shuffled_clips(video_path: Path, timestamps: tl_type, shuffled_clips: list[ClipEntry],
+                          scratch_folder: Path = None, workers: int = None, texts: list[str] = None) -> Path:
+    """Cut and join shuffled clips to match the timestamps again, and write the folder's manifest.
+
+    Args:
+        video_path -- path to the video, used to get the video folder and clips folder
+        timestamps -- list of tuple timestamps to make the clips conform to
+        shuffled_clips -- ordered list of manifest entries for the clips
+        scratch_folder -- folder to make the new clips in, the video folder by default
+        workers -- number of clips to make at once, the ThreadPoolExecutor default if None
+        texts -- text of each timestamp, passed on to plan_reformed_clips
+    Returns the path to the folder of shuffled and reformed clips.
+
+    Plans every clip first, then makes them in parallel. A clip that fails or comes out the wrong length is repaired
+    on its own, without making any of the others again. A line that's said more than once is only reformed for the
+    longest time it's said, and the rest are cut from that clip.
+
+    The stage is recorded in the scratch folder's journal like rip_all_audio_clips, keyed on the timestamps, their
+    text and the shuffled clips, so a stopped reform carries on with the clips it hadn't made yet.
+    """
+    scratch_folder = scratch_folder or video_path.with_suffix('')
+    shuffled_clips_folder = scratch_folder / 'audio-shuffled'
+    stage = 'audio-shuffled'
+
+    reform_journal = journal.get_journal(scratch_folder)
+    # the shuffle is quick and the same every time for a seed, so it's part of this stage's key instead of its own
+    key = journal.make_key(timestamps, texts, [(c.path.name, c.best_duration) for c in shuffled_clips])
+    if reform_journal.is_done(stage, key):
+        print('Shuffled clips already made')
+        return shuffled_clips_folder
+
+    old_entries = {}
+    if reform_journal.get(stage, key):
+        old_entries = {e.start: e for e in ok_entries(load_manifest(shuffled_clips_folder)) if e.path.is_file()}
+    else:
+        reform_journal.start(stage, key)
+
+    shuffled_clips_folder.mkdir(parents=True, exist_ok=True)
+
+    all_components, replacement_numbers = plan_reformed_clips(timestamps, shuffled_clips, texts)
+    owners = get_replacement_owners([get_duration(t) for t in timestamps], replacement_numbers)
+
+    # clips made by a run that was stopped are already finished
+    futures = [None] * len(timestamps)
+    checkpoint = ManifestCheckpoint(shuffled_clips_folder, [None] * len(timestamps))
+    for job, t in enumerate(timestamps):
+        old_entry = old_entries.get(t[0])
+        if old_entry and old_entry.duration == float(get_duration(t)):
+            futures[job] = Future()
+            futures[job].set_result(old_entry)
+            checkpoint.entries[job] = old_entry
+    progress_bar = ProgressBarRunner(futures.count(None))
+
+    def reform_job(job: int) -> ClipEntry:
+        entry = make_reformed_clip(video_path, timestamps[job], all_components[job], scratch_folder, job)
+        checkpoint.add(job, entry)
         progress_bar.progress()
+        return entry
 
+    def cut_job(job: int, owner_future: Future) -> ClipEntry:
+        owner = owners[replacement_numbers[job]]
+        entry = make_repeated_clip(video_path, timestamps[job], timestamps[owner], owner_future.result(),
+                                   scratch_folder)
+        checkpoint.add(job, entry)
+        progress_bar.progress()
+        return entry
+
+    with ThreadPoolExecutor(workers) as threads:
+        # every clip that's reformed is queued before any that wait for one, so the waiting ones can't block them
+        for job in owners:
+            if futures[job] is None:
+                futures[job] = threads.submit(reform_job, job)
+        for job, number in enumerate(replacement_numbers):
+            if futures[job] is None:
+                futures[job] = threads.submit(cut_job, job, futures[owners[number]])
+        try:
+            entries = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            checkpoint.save()
+            raise
+
+    save_manifest(shuffled_clips_folder, entries)
+    reform_journal.finish(stage, key, [e.path for e in ok_entries(entries)] + [shuffled_clips_folder / manifest_name])
+    print(ledger.describe_ledger(ledger.summarise_ledger(entries)))
     return shuffled_clips_folder
 
 
+# names handed out but maybe not written yet, so variants made at the same time don't get the same one
+claimed_result_paths = set()
+claimed_result_paths_lock = threading.Lock()
+
+
 def get_final_result_path(video_path: Path) -> Path:
     """Get a new name for the output video that hasn't been used before by adding a number."""
-    final_result_path = video_path.with_stem('(SHUFFLED) ' + video_path.stem)
-    number = 2
-    while final_result_path.is_file():
-        final_result_path = video_path.with_stem(f'(SHUFFLED-{number}) {video_path.stem}')
-        number += 1
+    with claimed_result_paths_lock:
+        final_result_path = video_path.with_stem('(SHUFFLED) ' + video_path.stem)
+        number = 2
+        while final_result_path.is_file() or final_result_path in claimed_result_paths:
+            final_result_path = video_path.with_stem(f'(SHUFFLED-{number}) {video_path.stem}')
+            number += 1
+        claimed_result_paths.add(final_result_path)
     return final_result_path
 
 
-def generate_new_video(video_path: Path):
+@trace.stage
+def generate_new_video(video_path: Path, final_result_path: Path, scratch_folder: Path = None):
     """Reform shuffled clips into a single audio track, and join it back to the video.
 
     Args:
         video_path -- path to the video, also used to get the video folder and clips folder
+        final_result_path -- path to save the new video to
+        scratch_folder -- folder the shuffled clips were made in, the video folder by default
     Returns nothing.
 
     Ran after the clips have been ripped, shuffled, and reforms. Concatenates the clips with the concat demuxer,
-    then takes that and the original video to make a new video file.
+    then takes that and the original video to make a new video file, encoding the audio in the new video's usual
+    format. The shuffled clips and the joined audio track
+    are deleted once they're in the new video. The ripped clips are kept, because every seed is made from them.
     """
     video_folder = video_path.with_suffix('')
-    shuffled_clips_folder = video_folder / 'audio-shuffled'
+    scratch_folder = scratch_folder or video_folder
+    shuffled_clips_folder = scratch_folder / 'audio-shuffled'
     intermediate_clips_folder = video_folder / 'audio-clips-intermediate'
-    shuffled_clips = list(shuffled_clips_folder.iterdir()) + list(intermediate_clips_folder.iterdir())
-    shuffled_clips.sort(key=lambda p: p.name)
+    entries = ok_entries(load_manifest(shuffled_clips_folder)) + ok_entries(load_manifest(intermediate_clips_folder))
+    entries.sort(key=lambda e: e.start)
+    shuffled_clips = [e.path for e in entries]
+    print(f'New audio track: {ledger.describe_ledger(ledger.summarise_ledger(entries))}')
 
     # concatenate shuffled audio back into a single audio track
-    # todo: fix audio not being long enough - on a ~25 minute video I got ~22 minute audio
-    # a clue - audio repeats sometimes
-    concat_folder = video_folder / 'audio-shuffled-concat'
+    concat_folder = scratch_folder / 'audio-shuffled-concat'
     concat_folder.mkdir(exist_ok=True)
     concat_file_path = concat_folder / 'concat.txt'
-    concat_output = concat_folder / 'audio.mp3'
+    concat_output = concat_folder / f'audio{clip_extension}'
 
-    shuffled_clip_paths_escaped = [str(f).replace('\\', '\\\\') for f in shuffled_clips]
+    shuffled_clip_paths_escaped = [str(f.resolve()).replace('\\', '\\\\') for f in shuffled_clips]
     with open(concat_file_path, 'w') as concat_file:
         concat_file.writelines([f"file '{f}'\n" for f in shuffled_clip_paths_escaped])
     stream = ffmpeg.input(str(concat_file_path), format='concat', safe=0)
-    stream = ffmpeg.output(stream, str(concat_output), **{'c:a': 'copy'})
-    ffmpeg.run(stream, overwrite_output=True)
+    # rf64 if it's over 4GB, which is too big for a plain wav file
+    stream = ffmpeg.output(stream, str(concat_output), rf64='auto', **{'c:a': 'copy'})
+    media.run(stream, overwrite_output=True)
 
     # combine new audio with video to create the new video
-    final_result_path = get_final_result_path(video_path)
-
     video_stream = ffmpeg.input(str(video_path)).video
     audio_stream = ffmpeg.input(str(concat_output))
-    stream = ffmpeg.output(video_stream, audio_stream, str(final_result_path), **{'c:v': 'copy', 'c:a': 'copy'})
-    ffmpeg.run(stream)
+    stream = ffmpeg.output(video_stream, audio_stream, str(final_result_path), **{'c:v': 'copy'})
+    media.run(stream, overwrite_output=True)
+
+    for folder in (shuffled_clips_folder, scratch_folder / 'audio-components', concat_folder):
+        shutil.rmtree(folder, ignore_errors=True)
 
 
 def parse_args():
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(description='Shuffle the dialogue in a video. Run with no input to be asked '
+                                                 'for a youtube url.')
     parser.add_argument('--version', action='version', version=__version__)
+    parser.add_argument('input', nargs='?',
+                        help='local video file, or url of a video to download. nothing is asked for if this is given')
+    parser.add_argument('-s', '--subs', type=Path, metavar='PATH',
+                        help='subtitle or json timestamps file to use, instead of the one next to the video')
+    parser.add_argument('-o', '--output', type=Path, metavar='PATH',
+                        help='path to save the new video to, next to the original with (SHUFFLED) in front by default')
+    parser.add_argument('--language', help='subtitle language to download, any language by default')
+    parser.add_argument('--search', metavar='IDENTIFIER',
+                        help='if the input is not a valid url, search for it with this youtube-dl search, '
+                             'like auto or ytsearch')
+    parser.add_argument('--renderer', choices=renderer_names, default='pcm',
+                        help='pcm shuffles the decoded audio in memory, '
+                             'filtergraph cuts the audio with ffmpeg filtergraphs without keeping any decoded audio, '
+                             'streaming rips, reforms and muxes clips all at the same time, '
+                             'clips is the old way that rips every clip to its own file')
+    parser.add_argument('--backend', choices=backends.backend_names, default='ffmpeg',
+                        help='media library the pcm, filtergraph and streaming renderers decode and mux with. '
+                             'pyav works in-process without starting ffmpeg for every clip, and needs: pip install av')
+    parser.add_argument('--shuffle', choices=list(shuffle_strategies), default='chunked',
+                        help='how to shuffle the dialogue')
+    parser.add_argument('--seed', type=int, help='seed for the shuffle, to make the same video again')
+    parser.add_argument('--variants', type=int, default=1,
+                        help='number of differently shuffled videos to make from the same ripped clips')
+    parser.add_argument('--workers', type=int,
+                        help='number of clips to rip or reform at once with the streaming and clips renderers, '
+                             'or groups of clips to cut at once with the filtergraph renderer')
+    parser.add_argument('--max-scratch', type=float, metavar='MB',
+                        help='most megabytes of ripped clips the streaming renderer keeps on disk at once. '
+                             'clips are deleted after their last use either way. the copy of the audio they are '
+                             'ripped from is kept in the video folder, and not counted')
+    parser.add_argument('--preview', type=get_preview_window, metavar='WINDOW',
+                        help='quickly make just part of the shuffle to listen to: the first N seconds, or START-END '
+                             'in seconds. make the whole video afterwards by running again with the same --seed')
+    parser.add_argument('--preview-video', action='store_true',
+                        help='make the preview a small low-bitrate video instead of just audio')
+    parser.add_argument('--min-cue', type=float, default=kingsquit.timestamps.default_min_cue,
+                        help='join dialogue shorter than this many seconds onto its neighbour if it is close, or '
+                             'else make it this long')
+    parser.add_argument('--min-gap', type=float, default=kingsquit.timestamps.default_min_gap,
+                        help='join dialogue separated by less than this many seconds')
+    parser.add_argument('--trace', type=Path, metavar='PATH',
+                        help='write how long every stage and ffmpeg process took to this file')
+    parser.add_argument('--trace-format', choices=trace.trace_formats, default='jsonl',
+                        help='jsonl for one event per line, or chrome to open in chrome://tracing or ui.perfetto.dev')
+    parser.add_argument('--summarise-trace', type=Path, metavar='PATH',
+                        help='print which stages, clips and ffmpeg processes took longest in a trace, then exit')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help="delete the decoded audio and audio copy kept in the input video's folder, then exit")
+    parser.add_argument('--batch', nargs='+', metavar='INPUT',
+                        help='shuffle many local videos, or folders of videos, at once instead of downloading one')
+    parser.add_argument('--jobs', type=int, default=max(1, (os.cpu_count() or 1) // 2),
+                        help='number of videos to shuffle at once in batch mode')
+    parser.add_argument('--max-ffmpeg', type=int, default=os.cpu_count() or 1,
+                        help='most ffmpeg processes to run at once, across all variants, and all videos in batch and '
+                             'serve mode')
+    parser.add_argument('--serve', nargs='?', const='', metavar='ADDRESS',
+                        help='keep running and make new shuffles of videos when asked over HTTP, keeping the videos '
+                             'ready between requests. listens on HOST:PORT, 127.0.0.1:8765 by default, or a Unix '
+                             'socket with unix:PATH. the other options are the defaults for requests')
     return parser.parse_args()
 
 
-def main():
-    """Run the program."""
-    # if starts with http or https, use ydl to download video and subtitles
-    # video_name = input('Video name: ')
-    # video_path = videos_folder / video_name
-    parse_args()
-
-    video_path, subtitle_path = kingsquit.downloader.main(str(videos_folder))
-    if not subtitle_path:
-        return False
+def shuffle_clips_variant(video_path: Path, timestamps: tl_type, final_result_path: Path, scratch_folder: Path,
+                          strategy: str, seed: int, workers: int = None, texts: list[str] = None):
+    """Shuffle the ripped clips, reform them and make one new video from them.
 
+    Args:
+        video_path -- path to the video the clips were ripped from
+        timestamps -- list of tuple timestamps of dialogue
+        final_result_path -- path to save the new video to
+        scratch_folder -- folder for this variant's own shuffled clips
+        strategy -- name of the shuffle strategy to use
+        seed -- seed for the shuffle
+        workers, texts -- passed on to reform_shuffled_clips
+    Returns nothing.
+    """
+    shuffled_clips = shuffle_clips(video_path, strategy, seed)
+    reform_shuffled_clips(video_path, timestamps, shuffled_clips, scratch_folder, workers, texts)
+    print('Creating new video with shuffled audio!')
+    generate_new_video(video_path, final_result_path, scratch_folder)
+
+
+class PreparedVideo(typing.NamedTuple):
+    """A video that's ready to be shuffled, with everything that's read from it and its timestamps file."""
+
+    video_path: Path
+    # fingerprint of the video, see kingsquit.fingerprint
+    fingerprint: str
+    # output of ffmpeg.probe for the video
+    video_info: dict
+    timestamps: tl_type
+    # text of each timestamp, empty if unknown
+    texts: list[str]
+
+    @property
+    def duration(self) -> float:
+        """Get the length of the video in seconds."""
+        return float(self.video_info['format']['duration'])
+
+
+@trace.stage
+def prepare_video(video_path: Path, timestamps_path: Path, min_cue: float = kingsquit.timestamps.default_min_cue,
+                  min_gap: float = kingsquit.timestamps.default_min_gap) -> typing.Optional[PreparedVideo]:
+    """Probe a video and load its timestamps, so it's ready to be shuffled with make_variants.
+
+    Args:
+        video_path -- path to the video
+        timestamps_path -- path to the json timestamps file for the video
+        min_cue, min_gap -- passed on to kingsquit.timestamps.normalise_timestamps
+    Returns the prepared video, or None if the video or its timestamps are missing or invalid.
+
+    The probe is saved in the video folder's journal, so it's only done again if the video changes.
+    """
     if not video_path.is_file():
         print("Video doesn't exist")
-        return False
+        return None
     video_folder = video_path.with_suffix('')
     video_folder.mkdir(exist_ok=True)
 
-    video_info = ffmpeg.probe(str(video_path))
+    video_journal = journal.get_journal(video_folder)
+    video_key = journal.file_key(video_path)
+    probe_key = journal.make_key(video_key, backends.get_backend().name)
+    if video_journal.is_done('probe', probe_key):
+        video_info = video_journal.get('probe', probe_key)['info']
+    else:
+        video_info = backends.get_backend().probe(video_path)
+        video_journal.finish('probe', probe_key, info=video_info)
     video_length_seconds = float(video_info['format']['duration'])
 
     print('Checking for timestamps file')
     try:
-        with open(subtitle_path.with_suffix('.json')) as timestamps_file:
+        with open(timestamps_path) as timestamps_file:
             timestamps = json.load(timestamps_file)
             print('Loaded timestamps file')
     except FileNotFoundError:
         print('Timestamps file not found!')
-        return False
+        return None
     # look for subtitle file by name
     # look for subtitle file by extension
     # look for subtitle file with subtitle on pypi
     # convert subtitles to label track so user can edit it?
-    # todo: handle timestamps that go over end of video from yt auto subs
+    timestamps, texts, report = kingsquit.timestamps.normalise_timestamps(timestamps, video_length_seconds, min_cue,
+                                                                           min_gap)
+    print(kingsquit.timestamps.describe_report(report))
     if not verify_timestamp_pairs(timestamps, video_length_seconds):
         print('Invalid timestamps')
-        return False
+        return None
+    return PreparedVideo(video_path, video_key, video_info, timestamps, texts)
 
+
+def make_variants(prepared: PreparedVideo, renderer: str = 'pcm', strategy: str = 'chunked',
+                  seed: int = None, variants: int = 1, workers: int = None, output_path: Path = None,
+                  max_scratch: int = None, samples=None) -> typing.List[Path]:
+    """Shuffle the dialogue in a prepared video and save it as one or more new videos.
+
+    Args:
+        prepared -- the video, from prepare_video
+        renderer -- name of the renderer to use: pcm, filtergraph, streaming or clips
+        strategy -- name of the shuffle strategy to use
+        seed -- seed for the shuffle, a new one is picked if None. variant n uses seed + n - 1
+        variants -- number of differently shuffled videos to make. they share the ripping, and are made at once
+        workers -- number of clips or groups of clips to cut at once with the filtergraph, streaming and clips
+                   renderers
+        output_path -- path to save the new video to. with more than one variant, the variant number is added to the
+                       name. if None, the video is saved next to the original with (SHUFFLED) in front of its name
+        max_scratch -- most bytes of ripped clips the streaming renderer keeps on disk at once, no limit if None
+        samples -- decoded audio for the pcm renderer, from kingsquit.pcm.load_audio. loaded here if None
+    Returns the paths of the new videos.
+
+    Each video is recorded in the video folder's journal, and one that was already made with the same seed, renderer
+    and timestamps isn't made again.
+    """
+    video_path, video_key, video_info, timestamps, texts = prepared
+    video_folder = video_path.with_suffix('')
+    video_journal = journal.get_journal(video_folder)
+
+    if seed is None:
+        seed = new_seed()
+    seeds = [seed + i for i in range(variants)]
+    print(f"Shuffle seed{'s' if variants > 1 else ''}: {', '.join(map(str, seeds))}")
+    if output_path is None:
+        final_result_paths = [None] * variants
+    elif variants == 1:
+        final_result_paths = [output_path]
+    else:
+        final_result_paths = [output_path.with_stem(f'{output_path.stem}-{n}') for n in range(1, variants + 1)]
+
+    # variant number, seed, path, journal stage and key of each video that needs making
+    to_render = []
+    for n, (s, path) in enumerate(zip(seeds, final_result_paths)):
+        # one stage for each renderer, strategy and output, so making the same seed another way doesn't replace it
+        stage = f'render-{renderer}-{strategy}-{s}' + (f'-{path.resolve()}' if path else '')
+        key = journal.make_key(renderer, strategy, s, video_key, timestamps, texts, path)
+        entry = video_journal.get(stage, key)
+        if video_journal.is_done(stage, key):
+            final_result_paths[n] = Path(entry['outputs'][0])
+            print(f'Seed {s} was already made: {final_result_paths[n]}')
+            continue
+        if path is None:
+            # a video left half made by a stopped run is made again in the same place, instead of next to it
+            path = final_result_paths[n] = Path(entry['outputs'][0]) if entry else get_final_result_path(video_path)
+        video_journal.start(stage, key, [path])
+        to_render.append((n, s, path, stage, key))
+    if not to_render:
+        return final_result_paths
+
+    if renderer in ('filtergraph', 'pcm', 'streaming'):
+        # the renderers are imported when they're used, so starting up doesn't import numpy and all of them
+        renderer_options = {}
+        if renderer == 'pcm':
+            from kingsquit import pcm
+            renderer_module = pcm
+            # decode once up front, so the variants don't all try to make the cache at once
+            if samples is None:
+                audio_info = media.get_audio_stream_info(video_info)
+                samples = pcm.load_audio(video_path, int(audio_info['sample_rate']), int(audio_info['channels']),
+                                         pcm.get_sample_format(audio_info))
+            renderer_options['samples'] = samples
+        else:
+            if renderer == 'streaming':
+                from kingsquit import streaming
+                renderer_module = streaming
+                renderer_options['max_scratch'] = max_scratch
+            else:
+                from kingsquit import filtergraph
+                renderer_module = filtergraph
+            renderer_options['workers'] = workers
+            # copy the audio once up front, so the variants don't all try to at once
+            kingsquit.demux.demux_audio(video_path)
+
+        print('Creating new video with shuffled audio!')
+        with ThreadPoolExecutor(len(to_render)) as threads:
+            futures = [threads.submit(renderer_module.generate_new_video, video_path, path, video_info, timestamps,
+                                      strategy, s, texts=texts, **renderer_options)
+                       for _, s, path, _, _ in to_render]
+            for future, (_, _, path, stage, key) in zip(futures, to_render):
+                future.result()
+                video_journal.finish(stage, key, [path])
+        return final_result_paths
+
+    # the video is only opened again for the final mux
+    source_path = kingsquit.demux.demux_audio(video_path)
     print('Ripping audio clips')
-    rip_all_audio_clips(video_path, timestamps)
-    rip_intermediate_audio_clips(video_path, timestamps, video_length_seconds)
+    rip_all_audio_clips(video_path, timestamps, workers=workers, source_path=source_path)
+    rip_intermediate_audio_clips(video_path, timestamps, prepared.duration, workers, source_path)
     print('Shuffling audio')
-    shuffle_success = False
-    while not shuffle_success:
+    if variants == 1:
+        scratch_folders = [video_folder]
+    else:
+        scratch_folders = [video_folder / f'variant-{n}' for n in range(1, variants + 1)]
+    with ThreadPoolExecutor(len(to_render)) as threads:
+        futures = [threads.submit(shuffle_clips_variant, video_path, timestamps, path, scratch_folders[n], strategy, s,
+                                  workers, texts)
+                   for n, s, path, _, _ in to_render]
+        for future, (_, _, path, stage, key) in zip(futures, to_render):
+            future.result()
+            video_journal.finish(stage, key, [path])
+    return final_result_paths
+
+
+def make_preview(prepared: PreparedVideo, start: float = 0.0, end: float = None, strategy: str = 'chunked',
+                 seed: int = None, output_path: Path = None, video: bool = False, workers: int = None,
+                 samples=None) -> Path:
+    """Make a quick preview of part of a shuffle, which sounds the same as that part of the full video.
+
+    Args:
+        prepared -- the video, from prepare_video
+        start, end -- part of the new video to preview, in seconds. to the end of the video if end is None
+        strategy -- name of the shuffle strategy to use
+        seed -- seed for the shuffle, a new one is picked if None. make_variants makes the whole video with it
+        output_path -- path to save the preview to, in the video folder named after the seed and part if None
+        video -- True for a small low-bitrate video, False for just the audio
+        workers -- number of parts of the audio to decode at once
+        samples -- decoded audio from kingsquit.pcm.load_audio, taken from its cache or decoded as needed if None
+    Returns the path of the preview. Raises ValueError if the part to preview isn't in the video.
+    """
+    from kingsquit import preview
+    end = prepared.duration if end is None else min(end, prepared.duration)
+    if not 0 <= start < end:
+        raise ValueError(f'Nothing to preview starting at {start:g}s of a {prepared.duration:g}s video')
+    if seed is None:
+        seed = new_seed()
+    if output_path is None:
+        output_path = prepared.video_path.with_suffix('') / (f'preview-{seed}-{start:g}-{end:g}'
+                                                             f'{preview.get_preview_extension(video)}')
+
+    print(f'Previewing seed {seed} from {start:g}s to {end:g}s')
+    preview.generate_preview(prepared.video_path, output_path, prepared.video_info, prepared.timestamps, start, end,
+                             strategy, seed, texts=prepared.texts, samples=samples, video=video, workers=workers)
+    return output_path
+
+
+@trace.stage
+def shuffle_video(video_path: Path, timestamps_path: Path, renderer: str = 'pcm', strategy: str = 'chunked',
+                  seed: int = None, variants: int = 1, workers: int = None,
+                  min_cue: float = kingsquit.timestamps.default_min_cue,
+                  min_gap: float = kingsquit.timestamps.default_min_gap,
+                  output_path: Path = None, max_scratch: int = None) -> typing.List[Path]:
+    """Shuffle the dialogue in a video and save it as one or more new videos.
+
+    Args:
+        video_path -- path to the video
+        timestamps_path -- path to the json timestamps file for the video. lines with the same text in it get the
+                           same replacement
+        min_cue, min_gap -- passed on to prepare_video
+        renderer, strategy, seed, variants, workers, output_path, max_scratch -- passed on to make_variants
+    Returns the paths of the new videos, or an empty list if they couldn't be made.
+
+    Each stage is recorded in the video folder's journal with a key made from its inputs, so running it again only
+    does the stages whose inputs changed or that didn't finish, see kingsquit.journal.
+    """
+    prepared = prepare_video(video_path, timestamps_path, min_cue, min_gap)
+    if prepared is None:
+        return []
+    return make_variants(prepared, renderer, strategy, seed, variants, workers, output_path, max_scratch)
+
+
+def get_timestamps_path(subtitle_path: Path) -> typing.Optional[Path]:
+    """Get the timestamps file for a subtitle file given by the user, converting it if it isn't one already.
+
+    Returns the path of the timestamps file, or None if the subtitles couldn't be converted.
+    """
+    if subtitle_path.suffix.casefold() == '.json':
+        return subtitle_path
+    if not kingsquit.downloader.convert_subs(subtitle_path):
+        return None
+    return subtitle_path.with_suffix('.json')
+
+
+def get_preview_window(text: str) -> typing.Tuple[float, typing.Optional[float]]:
+    """Parse the part of a video to preview given by the user, for argparse.
+
+    Args:
+        text -- N for the first N seconds, START-END for a window in seconds, or START- for from START to the end
+    Returns a tuple of the start and end in seconds, with an end of None for the end of the video.
+    Raises argparse.ArgumentTypeError if it's not valid.
+    """
+    start_text, dash, end_text = text.partition('-')
+    if not dash:
+        start_text, end_text = '0', start_text
+    try:
+        start = float(start_text)
+        end = float(end_text) if end_text else None
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'must be SECONDS or START-END, not {text}') from None
+    if start < 0 or end is not None and end <= start:
+        raise argparse.ArgumentTypeError(f'must be a part of the video that lasts more than 0 seconds, not {text}')
+    return start, end
+
+
+def clear_caches(video_path: Path) -> int:
+    """Delete the decoded audio and audio-only copy kept in a video's folder, and return how many bytes they took.
+
+    They're made again the next time a renderer needs them.
+    """
+    from kingsquit import pcm
+    return pcm.clear_cache(video_path) + kingsquit.demux.clear_cache(video_path)
+
+
+def get_max_scratch(megabytes: typing.Optional[float]) -> typing.Optional[int]:
+    """Convert the scratch space limit given by the user in megabytes to bytes."""
+    if megabytes is None:
+        return None
+    return int(megabytes * 1024 * 1024)
+
+
+def main():
+    """Run the program.
+
+    Returns 1 if something went wrong, for the exit code.
+    """
+    args = parse_args()
+
+    if args.summarise_trace:
+        print(trace.summarise(trace.load_events(args.summarise_trace)))
+        return
+
+    if args.clear_cache:
+        if not args.input or not Path(args.input).is_file():
+            print('--clear-cache needs the path of a local video')
+            return 1
+        print(f'Deleted {clear_caches(Path(args.input)) / 1024 / 1024:.1f}MB of cached audio')
+        return
+
+    if args.batch:
+        # imported here so a normal run doesn't start multiprocessing
+        from kingsquit import batch
+        if not batch.run_batch(args.batch, args.jobs, args.max_ffmpeg, args.renderer, args.shuffle, args.seed,
+                               args.variants, args.workers, args.min_cue, args.min_gap, args.trace, args.trace_format,
+                               args.backend, get_max_scratch(args.max_scratch)):
+            return 1
+        return
+
+    try:
+        backends.set_backend(args.backend)
+    except media.MediaError as err:
+        print(err)
+        return 1
+    if args.trace:
+        trace.start_trace(args.trace, args.trace_format)
+    # the renderers and variants each start their own ffmpeg processes from many threads, so they're capped here
+    media.set_process_limit(threading.BoundedSemaphore(args.max_ffmpeg))
+
+    if args.serve is not None:
+        # imported here so a normal run doesn't import the http server
+        import kingsquit.serve as serve
+        shuffler = serve.Shuffler(args.renderer, args.shuffle, args.workers, args.min_cue, args.min_gap,
+                                  get_max_scratch(args.max_scratch))
+        address = args.serve or serve.default_address
         try:
-            shuffled_clips = shuffle_clips(video_path)
-            reform_shuffled_clips(video_path, timestamps, shuffled_clips)
-        except ffmpeg.Error as err:
-            print('\nError shuffling audio, retrying..')
-            print(err.stdout)
-            print(err.stderr)
+            serve.run_server(address, shuffler)
+        except (ValueError, OSError) as err:
+            print(f"Couldn't serve on {address}: {err}")
+            return 1
+        finally:
+            trace.stop_trace()
+        return
+
+    try:
+        if args.input and Path(args.input).is_file():
+            video_path = Path(args.input)
+            timestamps_path = kingsquit.downloader.find_timestamps(video_path) if not args.subs else None
+        elif args.input and not args.search and not kingsquit.downloader.is_url(args.input):
+            print(f'File not found: {args.input}')
+            return 1
         else:
-            shuffle_success = True
-    print('Creating new video with shuffled audio!')
-    generate_new_video(video_path)
+            video_path, subtitle_path = kingsquit.downloader.main(str(videos_folder), args.input, args.language,
+                                                                  args.search)
+            if not video_path:
+                return 1
+            timestamps_path = subtitle_path.with_suffix('.json') if subtitle_path and not args.subs else None
+            if not timestamps_path and not args.subs:
+                timestamps_path = kingsquit.downloader.detect_timestamps(video_path)
+        if args.subs:
+            timestamps_path = get_timestamps_path(args.subs)
+        if not timestamps_path:
+            print('No usable subtitles, timestamps file or dialogue')
+            return 1
+
+        if args.preview:
+            prepared = prepare_video(video_path, timestamps_path, args.min_cue, args.min_gap)
+            if prepared is None:
+                return 1
+            seed = args.seed if args.seed is not None else new_seed()
+            try:
+                preview_path = make_preview(prepared, *args.preview, args.shuffle, seed, args.output,
+                                            args.preview_video, args.workers)
+            except ValueError as err:
+                print(err)
+                return 1
+            print(f'Preview saved to {preview_path}\n'
+                  f'To make the whole video, run again with --seed {seed} instead of --preview')
+        elif not shuffle_video(video_path, timestamps_path, args.renderer, args.shuffle, args.seed, args.variants,
+                               args.workers, args.min_cue, args.min_gap, args.output,
+                               get_max_scratch(args.max_scratch)):
+            return 1
+    except media.MediaError as err:
+        print(f'\nError: {err}')
+        return 1
+    finally:
+        trace.stop_trace()
     print('Done.')
-    input('Press enter to exit')
+    if not args.input:
+        input('Press enter to exit')
 
 
 if __name__ == '__main__':
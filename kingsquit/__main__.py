@@ -1,3 +1,4 @@
 """Run the main function."""
+import sys
 import kingsquit
-kingsquit.main()
+sys.exit(kingsquit.main())
@@ -0,0 +1,25 @@
+"""Writing files so that a stopped run never leaves one half written."""
+
+import os
+import typing
+import contextlib
+from pathlib import Path
+
+
+partial_suffix = '.part'
+
+
+@contextlib.contextmanager
+def replace_when_done(path: Path) -> typing.Iterator[Path]:
+    """Write a file under a temporary name, and only move it to its real name once the with block finishes.
+
+    Yields the temporary path to write to. If the block raises, the temporary file is deleted instead, and anything
+    already at the real path is left as it was.
+    """
+    partial_path = path.with_suffix(partial_suffix)
+    try:
+        yield partial_path
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+    os.replace(partial_path, path)
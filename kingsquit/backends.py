@@ -0,0 +1,397 @@
+"""Media backends: the few things the renderers need from a media library, behind one interface.
+
+FFmpegBackend runs an ffmpeg process for each job, like the rest of kingsquit. PyAVBackend does the same work
+in-process with PyAV, and keeps each file's decoder open between clips, so ripping a clip doesn't cost a process
+start, probing the container again and a pipe. Both raise media.MediaError when something goes wrong.
+
+Raw samples are passed around as bytes of interleaved samples, in one of sample_formats.
+"""
+
+import typing
+import threading
+import contextlib
+from pathlib import Path
+from fractions import Fraction
+
+import ffmpeg
+
+from kingsquit import media
+from kingsquit.media import MediaError
+
+
+backend_names = ['ffmpeg', 'pyav']
+# raw sample format names as ffmpeg knows them, and the PyAV format and numpy type for each. the numpy types are
+# named rather than imported, so choosing a backend doesn't import numpy
+sample_formats = {
+    's16le': ('s16', 'int16'),
+    'f32le': ('flt', 'float32'),
+}
+# seconds to start decoding before a clip, so the decoder has settled by the time it gets to the clip
+seek_preroll = 0.1
+current_backend = None
+current_backend_lock = threading.Lock()
+
+
+def get_frame_size(channels: int, sample_format: str) -> int:
+    """Get the number of bytes in one sample of every channel."""
+    import numpy as np
+    return np.dtype(sample_formats[sample_format][1]).itemsize * channels
+
+
+def fit_samples(data: bytes, length: int, frame_size: int) -> bytes:
+    """Cut raw samples to a number of samples, padding with silence if there aren't enough."""
+    return data[:length * frame_size].ljust(length * frame_size, b'\0')
+
+
+def seek_audio(path: Path, start: int, end: int, sample_rate: int):
+    """Make an ffmpeg-python stream of part of the audio of a file, cut at exact samples.
+
+    Args:
+        path -- path of the file
+        start, end -- range to take, in samples at the sample rate
+        sample_rate -- sample rate to resample to
+    Returns the stream. It seeks to before the preroll, then trims to the exact samples, so the decoder has settled by
+    the start, and only decodes a little past the end.
+    """
+    seek_start = max(0, start - round(seek_preroll * sample_rate))
+    stream = ffmpeg.input(str(path), ss=seek_start / sample_rate, t=(end - seek_start) / sample_rate + seek_preroll)
+    return stream.audio.filter('aresample', sample_rate).filter(
+        'atrim', start_sample=start - seek_start, end_sample=end - seek_start)
+
+
+class MediaBackend:
+    """Base class for media backends."""
+
+    name = None
+
+    def probe(self, path: Path) -> dict:
+        """Get info about a media file, in the shape ffprobe gives.
+
+        Only format.duration, and codec_type, sample_fmt, sample_rate and channels of the streams, can be relied on.
+        """
+        raise NotImplementedError
+
+    def decode_range(self, path: Path, start: int, end: int, sample_rate: int, channels: int,
+                     sample_format: str = 's16le') -> bytes:
+        """Decode part of the audio of a file to raw samples.
+
+        Args:
+            path -- path of the file to decode
+            start, end -- range to decode, in samples at the sample rate
+            sample_rate -- sample rate to decode at
+            channels -- number of channels to decode
+            sample_format -- raw sample format, one of sample_formats
+        Returns exactly end - start samples, padded with silence if the file ends first.
+        """
+        raise NotImplementedError
+
+    def decode_to_file(self, path: Path, out_path: Path, sample_rate: int, channels: int,
+                       sample_format: str = 's16le'):
+        """Decode the whole audio of a file to a raw sample file, without holding it all in memory.
+
+        Takes the same arguments as decode_range, and the path to save the raw samples to.
+        """
+        raise NotImplementedError
+
+    def encode(self, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+               sample_format: str = 's16le'):
+        """Encode raw samples to an audio file, with the codec picked from its extension.
+
+        Args:
+            chunks -- raw samples, in order, in chunks of any size
+            out_path -- path to save the audio to
+            sample_rate, channels, sample_format -- format of the raw samples
+        """
+        raise NotImplementedError
+
+    def mux(self, video_path: Path, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+            sample_format: str = 's16le'):
+        """Encode raw samples as the audio of a new video, with the video stream copied from another file.
+
+        Takes the same arguments as encode, and the path of the video to copy the video stream from. If getting a
+        chunk raises an error, the new video is abandoned and the error is raised again.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Free anything that was kept open between calls and isn't needed any more."""
+
+
+class FFmpegBackend(MediaBackend):
+    """Backend that runs the ffmpeg and ffprobe executables."""
+
+    name = 'ffmpeg'
+
+    def probe(self, path: Path) -> dict:
+        return media.probe(str(path))
+
+    def decode_range(self, path: Path, start: int, end: int, sample_rate: int, channels: int,
+                     sample_format: str = 's16le') -> bytes:
+        stream = ffmpeg.output(seek_audio(path, start, end, sample_rate), 'pipe:', format=sample_format, ac=channels)
+        data, _ = media.run(stream, capture_stdout=True, capture_stderr=True)
+        return fit_samples(data, end - start, get_frame_size(channels, sample_format))
+
+    def decode_to_file(self, path: Path, out_path: Path, sample_rate: int, channels: int,
+                       sample_format: str = 's16le'):
+        stream = ffmpeg.output(ffmpeg.input(str(path)).audio, str(out_path), format=sample_format, ar=sample_rate,
+                               ac=channels)
+        media.run(stream, quiet=True, overwrite_output=True)
+
+    def pipe_samples(self, stream, chunks: typing.Iterable[bytes]):
+        """Run an ffmpeg-python stream that reads raw samples from stdin, and write the chunks into it.
+
+        Doesn't take a process slot, because it spends most of its time waiting for chunks, which may need slots to
+        be made. Its output isn't hidden, since it can run for a long time.
+        """
+        process = media.run_async(stream, pipe_stdin=True)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            # ffmpeg stopped early, its exit code says why
+            pass
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            with contextlib.suppress(BrokenPipeError):
+                process.stdin.close()
+            process.wait()
+        if process.returncode:
+            raise MediaError(f'ffmpeg failed with exit code {process.returncode}, see its output above')
+
+    def encode(self, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+               sample_format: str = 's16le'):
+        stream = ffmpeg.input('pipe:', format=sample_format, ar=sample_rate, ac=channels)
+        self.pipe_samples(ffmpeg.output(stream, str(out_path)).overwrite_output(), chunks)
+
+    def mux(self, video_path: Path, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+            sample_format: str = 's16le'):
+        video_stream = ffmpeg.input(str(video_path)).video
+        audio_stream = ffmpeg.input('pipe:', format=sample_format, ar=sample_rate, ac=channels)
+        stream = ffmpeg.output(video_stream, audio_stream, str(out_path), **{'c:v': 'copy'}).overwrite_output()
+        self.pipe_samples(stream, chunks)
+
+
+class PyAVBackend(MediaBackend):
+    """Backend that decodes and encodes in-process with PyAV.
+
+    Each thread keeps its own open container for each file it decodes from, so clips from the same file reuse the
+    same decoder, seeking instead of opening the file again.
+    """
+
+    name = 'pyav'
+
+    def __init__(self):
+        """Import PyAV, which is optional."""
+        try:
+            import av
+        except ImportError as err:
+            raise MediaError('The pyav backend needs PyAV, install it with: pip install av', 'pyav') from err
+        self.av = av
+        self.local = threading.local()
+        # every container opened for decoding, with the thread that uses it, so they can be closed
+        self.open_inputs: typing.List[typing.Tuple[threading.Thread, typing.Any]] = []
+        self.open_inputs_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def errors(self, action: str):
+        """Turn PyAV errors in the with block into MediaError, saying what was being done."""
+        try:
+            yield
+        except self.av.error.FFmpegError as err:
+            raise MediaError(f"Couldn't {action}: {err}", 'pyav') from err
+
+    @staticmethod
+    def get_layout(channels: int) -> str:
+        """Get the name of the channel layout for a number of channels."""
+        return {1: 'mono', 2: 'stereo'}.get(channels, f'{channels}c')
+
+    def open_input(self, path: Path):
+        """Get this thread's open container and first audio stream of a file, opening it the first time."""
+        inputs = getattr(self.local, 'inputs', None)
+        if inputs is None:
+            inputs = self.local.inputs = {}
+        if path not in inputs:
+            with self.errors(f'open {path}'):
+                container = self.av.open(str(path))
+            if not container.streams.audio:
+                container.close()
+                raise MediaError(f'{path} has no audio stream', 'pyav')
+            inputs[path] = container, container.streams.audio[0]
+            with self.open_inputs_lock:
+                self.open_inputs.append((threading.current_thread(), container))
+        return inputs[path]
+
+    def probe(self, path: Path) -> dict:
+        with self.errors(f'read {path}'), self.av.open(str(path)) as container:
+            streams = []
+            for stream in container.streams:
+                stream_info = {'index': stream.index, 'codec_type': stream.type}
+                if stream.type == 'audio':
+                    stream_info.update(codec_name=stream.codec_context.name,
+                                       sample_fmt=stream.codec_context.format.name,
+                                       sample_rate=str(stream.codec_context.sample_rate),
+                                       channels=stream.codec_context.channels)
+                elif stream.type == 'video':
+                    stream_info.update(codec_name=stream.codec_context.name, width=stream.codec_context.width,
+                                       height=stream.codec_context.height)
+                streams.append(stream_info)
+            duration = container.duration / self.av.time_base if container.duration is not None else None
+            return {'format': {'filename': str(path), 'duration': str(duration)}, 'streams': streams}
+
+    @staticmethod
+    def iter_decoded(container, stream, decoder) -> typing.Iterator:
+        """Decode a stream from where its container is with a decoder of its own, and yield the frames."""
+        for packet in container.demux(stream):
+            yield from decoder.decode(packet)
+
+    def decode_range(self, path: Path, start: int, end: int, sample_rate: int, channels: int,
+                     sample_format: str = 's16le') -> bytes:
+        """Decode part of the audio of a file to raw samples, with a new decoder for every range.
+
+        The container stays open between calls, but the decoder doesn't, because flushing one doesn't reset all of
+        its state, like aac's noise generator. A reused decoder would make the same range come out slightly
+        differently depending on what was decoded before it, so a preview wouldn't match the full video. Making and
+        opening a decoder costs about half a millisecond per range, next to about 5ms to decode a second of aac, and
+        doesn't add any decoding, since every range is seeked to and decoded from its preroll either way.
+        """
+        container, stream = self.open_input(path)
+        frame_size = get_frame_size(channels, sample_format)
+        resampler = self.av.AudioResampler(format=sample_formats[sample_format][0], layout=self.get_layout(channels),
+                                           rate=sample_rate)
+        data = bytearray()
+        # sample the decoded data starts at, known once the first frame is decoded
+        data_start = None
+
+        with self.errors(f'decode {path}'):
+            # seeks back to the nearest seek point at or before the preroll. decoders like aac need a few frames
+            # before their output is right, so the samples decoded before the start are dropped
+            seek_time = max(0.0, start / sample_rate - seek_preroll)
+            container.seek(int(seek_time / stream.time_base), stream=stream)
+            decoder = self.av.CodecContext.create(stream.codec_context.name, 'r')
+            decoder.extradata = stream.codec_context.extradata
+            for frame in self.iter_decoded(container, stream, decoder):
+                if data_start is None:
+                    data_start = round(frame.time * sample_rate) if frame.time is not None else start
+                for resampled_frame in resampler.resample(frame):
+                    data += resampled_frame.to_ndarray().tobytes()
+                if data_start + len(data) // frame_size >= end:
+                    break
+
+        if data_start is None:
+            # nothing left to decode at the start
+            return fit_samples(b'', end - start, frame_size)
+        if data_start > start:
+            # the first frame starts after the start, so fill the gap with silence
+            data[:0] = bytes((data_start - start) * frame_size)
+            data_start = start
+        offset = (start - data_start) * frame_size
+        return fit_samples(bytes(data[offset:]), end - start, frame_size)
+
+    def decode_to_file(self, path: Path, out_path: Path, sample_rate: int, channels: int,
+                       sample_format: str = 's16le'):
+        resampler = self.av.AudioResampler(format=sample_formats[sample_format][0], layout=self.get_layout(channels),
+                                           rate=sample_rate)
+        # a container of its own, since this reads the whole file from the start
+        with self.errors(f'decode {path}'), self.av.open(str(path)) as container, open(out_path, 'wb') as out_file:
+            if not container.streams.audio:
+                raise MediaError(f'{path} has no audio stream', 'pyav')
+            for frame in container.decode(container.streams.audio[0]):
+                for resampled_frame in resampler.resample(frame):
+                    out_file.write(resampled_frame.to_ndarray().tobytes())
+            for resampled_frame in resampler.resample(None):
+                out_file.write(resampled_frame.to_ndarray().tobytes())
+
+    def add_audio_stream(self, output, sample_rate: int, channels: int):
+        """Add an audio stream to an output container, with the container's usual audio codec."""
+        audio_stream = output.add_stream(output.default_audio_codec, rate=sample_rate)
+        audio_stream.layout = self.get_layout(channels)
+        return audio_stream
+
+    def iter_frames(self, chunks: typing.Iterable[bytes], sample_rate: int, channels: int, sample_format: str):
+        """Turn chunks of raw samples into audio frames with timestamps."""
+        import numpy as np
+        av_format, dtype = sample_formats[sample_format]
+        layout = self.get_layout(channels)
+        position = 0
+        for chunk in chunks:
+            if not chunk:
+                continue
+            frame = self.av.AudioFrame.from_ndarray(np.frombuffer(chunk, dtype).reshape(1, -1), format=av_format,
+                                                    layout=layout)
+            frame.sample_rate = sample_rate
+            frame.time_base = Fraction(1, sample_rate)
+            frame.pts = position
+            position += frame.samples
+            yield frame
+
+    def encode(self, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+               sample_format: str = 's16le'):
+        with self.errors(f'write {out_path}'), self.av.open(str(out_path), 'w') as output:
+            audio_stream = self.add_audio_stream(output, sample_rate, channels)
+            for frame in self.iter_frames(chunks, sample_rate, channels, sample_format):
+                output.mux(audio_stream.encode(frame))
+            output.mux(audio_stream.encode(None))
+
+    def mux(self, video_path: Path, chunks: typing.Iterable[bytes], out_path: Path, sample_rate: int, channels: int,
+            sample_format: str = 's16le'):
+        with self.errors(f'write {out_path}'), self.av.open(str(video_path)) as source, \
+                self.av.open(str(out_path), 'w') as output:
+            in_video_stream = source.streams.video[0]
+            out_video_stream = output.add_stream_from_template(in_video_stream)
+            audio_stream = self.add_audio_stream(output, sample_rate, channels)
+            frames = self.iter_frames(chunks, sample_rate, channels, sample_format)
+            audio_time = 0.0
+
+            for packet in source.demux(in_video_stream):
+                if packet.dts is None:
+                    # the empty packet at the end
+                    continue
+                # keep the audio written about level with the video, so the muxer doesn't have to buffer much
+                while frames is not None and audio_time <= packet.dts * packet.time_base:
+                    frame = next(frames, None)
+                    if frame is None:
+                        frames = None
+                        break
+                    output.mux(audio_stream.encode(frame))
+                    audio_time = (frame.pts + frame.samples) / sample_rate
+                packet.stream = out_video_stream
+                output.mux(packet)
+
+            for frame in frames or ():
+                output.mux(audio_stream.encode(frame))
+            output.mux(audio_stream.encode(None))
+
+    def close(self):
+        """Close the containers opened by threads that have finished."""
+        with self.open_inputs_lock:
+            still_open = []
+            for thread, container in self.open_inputs:
+                if thread.is_alive():
+                    still_open.append((thread, container))
+                else:
+                    container.close()
+            self.open_inputs = still_open
+
+
+backend_classes = {
+    'ffmpeg': FFmpegBackend,
+    'pyav': PyAVBackend,
+}
+
+
+def set_backend(name: str):
+    """Pick the media backend the renderers use, by name. Raises MediaError if it can't be used."""
+    global current_backend
+    with current_backend_lock:
+        current_backend = backend_classes[name]()
+
+
+def get_backend() -> MediaBackend:
+    """Get the media backend the renderers use, the ffmpeg one if none was picked."""
+    global current_backend
+    with current_backend_lock:
+        if current_backend is None:
+            current_backend = FFmpegBackend()
+        return current_backend
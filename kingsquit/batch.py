@@ -0,0 +1,111 @@
+"""Batch mode, for shuffling many local videos at once in a pool of processes.
+
+The number of ffmpeg processes running at once is limited across the whole pool with a shared semaphore, so that
+several videos each ripping clips in their own thread pool don't swamp the machine.
+"""
+
+import os
+import typing
+import traceback
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import ffmpeg
+
+import kingsquit
+import kingsquit.downloader
+import kingsquit.timestamps
+from kingsquit import media, trace, backends
+
+
+video_extensions = {'.mp4', '.mkv', '.webm', '.mov', '.avi'}
+
+
+def find_videos(inputs: typing.Iterable[str]) -> typing.List[Path]:
+    """Get the paths of all the videos given, looking inside any folders given. Skips already shuffled videos."""
+    videos = []
+    for i in inputs:
+        path = Path(i)
+        if path.is_dir():
+            candidates = sorted(p for p in path.iterdir() if p.suffix.casefold() in video_extensions)
+        else:
+            candidates = [path]
+        videos.extend(p for p in candidates if not p.name.startswith('(SHUFFLED'))
+    return videos
+
+
+def init_worker(process_limit, trace_path: typing.Optional[Path] = None, trace_format: str = 'jsonl',
+                backend: str = 'ffmpeg'):
+    """Set up a worker process to share the ffmpeg process limit, use the media backend, and trace to its own file
+    if tracing is on.
+    """
+    media.set_process_limit(process_limit)
+    backends.set_backend(backend)
+    if trace_path:
+        trace.start_trace(trace_path.with_stem(f'{trace_path.stem}-{os.getpid()}'), trace_format)
+
+
+def shuffle_one(video_path: Path, renderer: str, strategy: str, seed: typing.Optional[int],
+                variants: int, workers: typing.Optional[int], min_cue: float,
+                min_gap: float, max_scratch: typing.Optional[int]) -> typing.Tuple[bool, str]:
+    """Shuffle one video in a worker process.
+
+    Returns a tuple of whether it worked, and the paths of the new videos or what went wrong.
+    """
+    try:
+        timestamps_path = kingsquit.downloader.find_timestamps(video_path)
+        if not timestamps_path:
+            return False, 'no usable subtitles, timestamps file or dialogue'
+
+        final_result_paths = kingsquit.shuffle_video(video_path, timestamps_path, renderer, strategy, seed, variants,
+                                                     workers, min_cue, min_gap, max_scratch=max_scratch)
+        if not final_result_paths:
+            return False, 'invalid video or timestamps'
+        return True, ', '.join(map(str, final_result_paths))
+    except ffmpeg.Error as err:
+        return False, f'ffmpeg error: {media.get_stderr_tail(err.stderr) or err}'
+    except Exception:
+        return False, traceback.format_exc().strip().splitlines()[-1]
+
+
+def run_batch(inputs: typing.Iterable[str], jobs: int, max_ffmpeg: int, renderer: str = 'pcm',
+              strategy: str = 'chunked', seed: int = None, variants: int = 1,
+              workers: int = None, min_cue: float = kingsquit.timestamps.default_min_cue,
+              min_gap: float = kingsquit.timestamps.default_min_gap, trace_path: Path = None,
+              trace_format: str = 'jsonl', backend: str = 'ffmpeg', max_scratch: int = None) -> bool:
+    """Shuffle many videos at once, then print a report of how each one went.
+
+    Args:
+        inputs -- paths of videos, or folders of videos
+        jobs -- number of videos to work on at once
+        max_ffmpeg -- most ffmpeg processes that can run at once, across all videos
+        renderer, strategy, seed, variants, workers, min_cue, min_gap -- passed on to kingsquit.shuffle_video
+        trace_path -- if given, each worker process writes a trace to this path with its process id added
+        trace_format -- format of the traces, see kingsquit.trace
+        backend -- name of the media backend to use, see kingsquit.backends
+        max_scratch -- most bytes of ripped clips each video keeps on disk at once with the streaming renderer, so
+                       the disk a batch needs is about jobs times this
+    Returns True if every video worked, False otherwise.
+    """
+    videos = find_videos(inputs)
+    if not videos:
+        print('No videos found')
+        return False
+    print(f'Shuffling {len(videos)} videos, {jobs} at a time')
+
+    process_limit = multiprocessing.BoundedSemaphore(max_ffmpeg)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(process_limit, trace_path, trace_format, backend)) as pool:
+        futures = [pool.submit(shuffle_one, v, renderer, strategy, seed, variants, workers, min_cue, min_gap,
+                               max_scratch)
+                   for v in videos]
+        results = [f.result() for f in futures]
+
+    print('\nBatch report:')
+    for video_path, (success, message) in zip(videos, results):
+        print(f"{'OK    ' if success else 'FAILED'} {video_path}: {message}")
+    succeeded = sum(success for success, _ in results)
+    print(f'{succeeded}/{len(results)} videos shuffled')
+
+    return succeeded == len(results)
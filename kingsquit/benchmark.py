@@ -0,0 +1,422 @@
+"""Offline benchmarks, for checking whether a change makes kingsquit faster.
+
+Test videos are made locally with ffmpeg's lavfi sources, and paired with generated subtitles of a given number of
+cues per minute, so nothing needs downloading. Each stage of each renderer is timed on its own, in its own process so
+its peak memory can be measured, and the wall time, peak memory, number of ffmpeg processes and bytes written are
+saved to a json file that can be compared with the results from another commit.
+
+Usage:
+    python -m kingsquit.benchmark --lengths 60 600 --densities 10 30 --output after.json
+    python -m kingsquit.benchmark --compare before.json after.json
+"""
+
+import io
+import sys
+import json
+import time
+import random
+import shutil
+import typing
+import argparse
+import platform
+import traceback
+import contextlib
+import subprocess
+import multiprocessing
+from pathlib import Path
+
+import ffmpeg
+
+import kingsquit
+import kingsquit.demux
+import kingsquit.downloader
+import kingsquit.filtergraph
+import kingsquit.pcm
+import kingsquit.streaming
+import kingsquit.timestamps
+from kingsquit import media
+from kingsquit.atomic import replace_when_done
+
+try:
+    import resource
+except ImportError:
+    # not on Windows
+    resource = None
+
+
+renderers = ['clips', 'filtergraph', 'pcm', 'streaming']
+subtitle_formats = ['srt', 'vtt', 'ttml']
+default_lengths = [60, 300]
+default_densities = [10, 30]
+seed = 1234
+# lines the made-up subtitles repeat, like the catchphrases in a stream or compilation
+catchphrases = ['Let\'s go!', 'No way.', 'What?', 'Thank you so much!', 'Oh no...']
+
+
+def make_video(video_path: Path, length: float, sample_rate: int = 44100):
+    """Make a test video with ffmpeg's testsrc pattern and a sine tone, if it hasn't been made already."""
+    if video_path.is_file():
+        return
+    video_stream = ffmpeg.input(f'testsrc=size=320x240:rate=25:duration={length}', format='lavfi')
+    audio_stream = ffmpeg.input(f'sine=frequency=440:sample_rate={sample_rate}:duration={length}', format='lavfi')
+    with replace_when_done(video_path) as partial_path:
+        stream = ffmpeg.output(video_stream, audio_stream, str(partial_path), format='mp4', vcodec='mpeg4',
+                               acodec='aac', shortest=None)
+        ffmpeg.run(stream, quiet=True, overwrite_output=True)
+
+
+def make_cues(length: float, density: float, rng: random.Random) -> kingsquit.tl_type:
+    """Make made-up subtitle timings with about density cues per minute, of varied length and spacing."""
+    mean_step = 60 / density
+    cues = []
+    cursor = rng.uniform(0, mean_step)
+    while True:
+        duration = rng.uniform(0.3, 0.8) * mean_step
+        if cursor + duration > length:
+            break
+        cues.append((round(cursor, 3), round(cursor + duration, 3)))
+        cursor += duration + rng.uniform(0.05, 0.4) * mean_step
+    return cues
+
+
+def make_cue_texts(count: int, repeats: float, rng: random.Random) -> typing.List[str]:
+    """Make made-up subtitle text, with about the given fraction of the lines being repeated catchphrases."""
+    return [rng.choice(catchphrases) if rng.random() < repeats else f'Line {n}' for n in range(1, count + 1)]
+
+
+def format_cue_time(time: float, decimal_mark: str) -> str:
+    """Format a time in seconds like 00:01:02.345, with the given decimal mark."""
+    milliseconds = round(time * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f'{hours:02}:{minutes:02}:{seconds:02}{decimal_mark}{milliseconds:03}'
+
+
+def write_subtitles(cues: kingsquit.tl_type, texts: typing.List[str], subtitle_path: Path, sub_format: str):
+    """Write made-up subtitles with the given timings and text, as srt, vtt or ttml."""
+    with open(subtitle_path, 'w', encoding='utf-8') as sub_file:
+        if sub_format == 'ttml':
+            sub_file.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                           '<tt xmlns="http://www.w3.org/ns/ttml"><body><div>\n')
+            for (start, end), text in zip(cues, texts):
+                sub_file.write(f'<p begin="{start}s" end="{end}s">{text}</p>\n')
+            sub_file.write('</div></body></tt>\n')
+            return
+
+        if sub_format == 'vtt':
+            sub_file.write('WEBVTT\n\n')
+        decimal_mark = '.' if sub_format == 'vtt' else ','
+        for n, ((start, end), text) in enumerate(zip(cues, texts), 1):
+            sub_file.write(f'{n}\n{format_cue_time(start, decimal_mark)} --> {format_cue_time(end, decimal_mark)}\n'
+                           f'{text}\n\n')
+
+
+def list_files(folder: Path) -> typing.Dict[Path, typing.Tuple[int, int]]:
+    """Get the size and modification time of every file in a folder."""
+    files = {}
+    for path in folder.rglob('*'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        if path.is_file():
+            files[path] = stat.st_size, stat.st_mtime_ns
+    return files
+
+
+def count_bytes_created(before: typing.Dict[Path, typing.Tuple[int, int]],
+                        after: typing.Dict[Path, typing.Tuple[int, int]]) -> int:
+    """Get the total size of the files that are new or changed between two list_files, in bytes.
+
+    Files a stage deletes don't take anything off, and ones it makes and deletes again aren't counted at all.
+    """
+    return sum(size for path, (size, mtime) in after.items() if before.get(path) != (size, mtime))
+
+
+def peak_rss() -> typing.Tuple[typing.Optional[int], typing.Optional[int]]:
+    """Get the peak memory use so far of this process and of its biggest finished child process, in KiB.
+
+    Returns a tuple of None, None where it can't be measured. These are high-water marks for the life of the process,
+    so StageRecorder runs each stage in its own process to measure them per stage. On Linux, a child process's peak is
+    never less than this process's memory use when it was started.
+    """
+    if resource is None:
+        return None, None
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes instead of KiB
+        own //= 1024
+        children //= 1024
+    return own, children
+
+
+def run_stage(connection, function: typing.Callable, args: tuple, kwargs: dict):
+    """Run a stage in a child process, and send back what it returned, its peak memory and ffmpeg process count.
+
+    A stage that fails sends back its traceback instead of what it returned.
+    """
+    processes_before = media.process_count
+    try:
+        result, error = function(*args, **kwargs), None
+    except BaseException:
+        result, error = None, traceback.format_exc()
+    connection.send((result, error, media.process_count - processes_before, *peak_rss()))
+    connection.close()
+
+
+def measure_in_process(function: typing.Callable, *args, **kwargs) -> tuple:
+    """Run a stage in a child process, so its peak memory and that of its ffmpeg processes are its own.
+
+    Returns a tuple of what the stage returned, how many ffmpeg processes it started, its peak memory and that of its
+    biggest ffmpeg process in KiB. Raises RuntimeError with the stage's traceback if it fails.
+
+    Runs the stage in this process instead where processes can't be forked, without measuring its memory.
+    """
+    if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        processes_before = media.process_count
+        return function(*args, **kwargs), media.process_count - processes_before, None, None
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=run_stage, args=(sender, function, args, kwargs))
+    process.start()
+    sender.close()
+    try:
+        result, error, processes, own_rss, child_rss = receiver.recv()
+    except EOFError:
+        result, error = None, f'exited with code {process.exitcode}'
+    process.join()
+    if error is not None:
+        raise RuntimeError(f'Stage failed: {error}')
+    return result, processes, own_rss, child_rss
+
+
+class StageRecorder:
+    """Class for timing the stages of one benchmark run and saving a result row for each."""
+
+    def __init__(self, rows: list, work_folder: Path, verbose: bool = False, **case):
+        """Save the settings to the instance.
+
+        Args:
+            rows -- list to add the result rows to
+            work_folder -- folder everything in this run is written to, for counting the bytes each stage creates
+            verbose -- show what kingsquit prints during each stage
+            case -- the settings of this run, saved in every row
+        """
+        self.rows = rows
+        self.work_folder = work_folder
+        self.verbose = verbose
+        self.case = case
+
+    def measure(self, stage: str, function: typing.Callable, *args, **kwargs):
+        """Run one stage in its own process and save how long it took and what it used.
+
+        Returns what the stage returned, which has to be picklable.
+        """
+        files_before = list_files(self.work_folder)
+        output = contextlib.nullcontext() if self.verbose else contextlib.redirect_stdout(io.StringIO())
+
+        start = time.perf_counter()
+        with output:
+            result, processes, own_rss, child_rss = measure_in_process(function, *args, **kwargs)
+        wall = time.perf_counter() - start
+
+        row = {
+            **self.case,
+            'stage': stage,
+            'wall': round(wall, 4),
+            'peak_rss_kib': own_rss,
+            'peak_child_rss_kib': child_rss,
+            'ffmpeg_processes': processes,
+            'bytes_written': count_bytes_created(files_before, list_files(self.work_folder)),
+        }
+        self.rows.append(row)
+        print(f"  {row['renderer']:<12}{stage:<30}{wall:>9.3f}s {row['ffmpeg_processes']:>6} ffmpeg "
+              f"{row['bytes_written'] / 1e6:>9.2f}MB")
+        return result
+
+
+def bench_clips(recorder: StageRecorder, video_path: Path, timestamps: kingsquit.tl_type, texts: typing.List[str],
+                duration: float, workers: typing.Optional[int]):
+    """Time each stage of the clips renderer separately."""
+    source_path = recorder.measure('demux_audio', kingsquit.demux.demux_audio, video_path)
+    recorder.measure('rip_all_audio_clips', kingsquit.rip_all_audio_clips, video_path, timestamps, workers=workers,
+                     source_path=source_path)
+    recorder.measure('rip_intermediate_audio_clips', kingsquit.rip_intermediate_audio_clips, video_path, timestamps,
+                     duration, workers, source_path)
+    shuffled_clips = recorder.measure('shuffle_clips', kingsquit.shuffle_clips, video_path, 'chunked', seed)
+    recorder.measure('reform_shuffled_clips', kingsquit.reform_shuffled_clips, video_path, timestamps,
+                     shuffled_clips, None, workers, texts)
+    recorder.measure('generate_new_video', kingsquit.generate_new_video, video_path,
+                     kingsquit.get_final_result_path(video_path))
+
+
+def bench_renderer(recorder: StageRecorder, renderer: str, video_path: Path, video_info: dict,
+                   timestamps: kingsquit.tl_type, texts: typing.List[str], workers: typing.Optional[int]):
+    """Time one of the renderers that make the video in a single stage."""
+    renderer_options = {}
+    if renderer == 'pcm':
+        renderer_module = kingsquit.pcm
+    elif renderer == 'streaming':
+        renderer_module = kingsquit.streaming
+        renderer_options['workers'] = workers
+    else:
+        renderer_module = kingsquit.filtergraph
+        renderer_options['workers'] = workers
+    recorder.measure('generate_new_video', renderer_module.generate_new_video, video_path,
+                     kingsquit.get_final_result_path(video_path), video_info, timestamps, 'chunked', seed,
+                     texts=texts, **renderer_options)
+
+
+def run_benchmarks(folder: Path, lengths: typing.List[float], densities: typing.List[float],
+                   run_renderers: typing.List[str], sub_format: str = 'srt', workers: int = None,
+                   keep: bool = False, verbose: bool = False, repeats: float = 0.0) -> typing.List[dict]:
+    """Run every renderer on a test video of every length with subtitles of every density.
+
+    Args:
+        folder -- folder to make the test videos and do the work in
+        lengths -- lengths of the test videos, in seconds
+        densities -- numbers of subtitle cues per minute
+        run_renderers -- names of the renderers to time
+        sub_format -- format of the made-up subtitles, srt, vtt or ttml
+        workers -- passed on to the renderers that take it
+        keep -- keep each run's files instead of deleting them after
+        verbose -- show what kingsquit prints during each stage
+        repeats -- fraction of the subtitle lines that are repeated catchphrases
+    Returns the list of result rows.
+    """
+    inputs_folder = folder / 'inputs'
+    inputs_folder.mkdir(parents=True, exist_ok=True)
+    rows = []
+
+    for length in lengths:
+        source_video_path = inputs_folder / f'{length}s.mp4'
+        print(f'Making {length}s test video')
+        make_video(source_video_path, length)
+
+        for density in densities:
+            rng = random.Random(seed)
+            cues = make_cues(length, density, rng)
+            texts = make_cue_texts(len(cues), repeats, rng)
+            for renderer in run_renderers:
+                print(f'{length}s video, {density} cues per minute ({len(cues)} cues), {renderer} renderer')
+                # every run gets its own copy, so nothing is reused from an earlier run
+                work_folder = folder / f'{length}s-{density}cpm-{renderer}'
+                shutil.rmtree(work_folder, ignore_errors=True)
+                work_folder.mkdir()
+                video_path = work_folder / 'video.mp4'
+                shutil.copyfile(source_video_path, video_path)
+                subtitle_path = video_path.with_suffix(f'.{sub_format}')
+                write_subtitles(cues, texts, subtitle_path, sub_format)
+
+                recorder = StageRecorder(rows, work_folder, verbose, length=length, density=density,
+                                         cues=len(cues), renderer=renderer, sub_format=sub_format)
+                recorder.measure('convert_subs', kingsquit.downloader.convert_subs, subtitle_path)
+                video_info = media.probe(str(video_path))
+                duration = float(video_info['format']['duration'])
+                with open(video_path.with_suffix('.json')) as timestamps_file:
+                    timestamps, cue_texts, _ = kingsquit.timestamps.normalise_timestamps(json.load(timestamps_file),
+                                                                                         duration)
+                video_path.with_suffix('').mkdir()
+
+                if renderer == 'clips':
+                    bench_clips(recorder, video_path, timestamps, cue_texts, duration, workers)
+                else:
+                    bench_renderer(recorder, renderer, video_path, video_info, timestamps, cue_texts, workers)
+
+                if not keep:
+                    shutil.rmtree(work_folder)
+
+    return rows
+
+
+def get_environment() -> dict:
+    """Get what the results depend on apart from the code: the commit, and the versions of things."""
+    def first_line(args: typing.List[str]) -> typing.Optional[str]:
+        try:
+            process = subprocess.run(args, capture_output=True, text=True, cwd=Path(__file__).parent)
+        except OSError:
+            return None
+        return process.stdout.strip().splitlines()[0] if process.returncode == 0 and process.stdout else None
+
+    return {
+        'commit': first_line(['git', 'rev-parse', '--short', 'HEAD']),
+        'version': kingsquit.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'ffmpeg': first_line(['ffmpeg', '-version']),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def compare_results(old_path: Path, new_path: Path):
+    """Print the wall time of every stage in two results files side by side."""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+
+    def key(row: dict) -> tuple:
+        return row['length'], row['density'], row['renderer'], row['stage']
+
+    old_rows = {key(row): row for row in old['results']}
+    old_name = old['environment']['commit'] or old_path.name
+    new_name = new['environment']['commit'] or new_path.name
+    print(f"{'':<50}{old_name:>12}{new_name:>12}")
+    for row in new['results']:
+        old_row = old_rows.get(key(row))
+        name = f"{row['length']}s {row['density']}cpm {row['renderer']} {row['stage']}"
+        if old_row is None:
+            print(f"{name:<50}{'':>12}{row['wall']:>11.3f}s")
+            continue
+        ratio = row['wall'] / old_row['wall'] if old_row['wall'] else float('inf')
+        print(f"{name:<50}{old_row['wall']:>11.3f}s{row['wall']:>11.3f}s  x{ratio:.2f}  "
+              f"ffmpeg {old_row['ffmpeg_processes']} -> {row['ffmpeg_processes']}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(prog='python -m kingsquit.benchmark',
+                                     description='Time kingsquit on made-up videos and subtitles, offline.')
+    parser.add_argument('--lengths', type=float, nargs='+', default=default_lengths,
+                        help='lengths of the test videos, in seconds')
+    parser.add_argument('--densities', type=float, nargs='+', default=default_densities,
+                        help='numbers of subtitle cues per minute')
+    parser.add_argument('--renderers', choices=renderers, nargs='+', default=renderers, help='renderers to time')
+    parser.add_argument('--format', choices=subtitle_formats, default='srt', help='format of the test subtitles')
+    parser.add_argument('--workers', type=int, help='number of clips to rip or reform at once')
+    parser.add_argument('--repeats', type=float, default=0.0,
+                        help='fraction of the subtitle lines that are repeated catchphrases, from 0 to 1')
+    parser.add_argument('--folder', type=Path, default=Path('kingsquit-benchmark'),
+                        help='folder to make the test videos and do the work in')
+    parser.add_argument('--output', type=Path, default=Path('kingsquit-benchmark.json'),
+                        help='file to save the results to')
+    parser.add_argument('--keep', action='store_true', help="keep each run's files instead of deleting them")
+    parser.add_argument('--verbose', action='store_true', help='show what kingsquit prints during each stage')
+    parser.add_argument('--compare', type=Path, nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead of running the benchmarks')
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmarks, or compare two results files."""
+    args = parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    # lengths like 60.0 read better as 60 in folder names and results
+    lengths = [int(length) if length.is_integer() else length for length in args.lengths]
+    densities = [int(density) if density.is_integer() else density for density in args.densities]
+    rows = run_benchmarks(args.folder, lengths, densities, args.renderers, args.format, args.workers, args.keep,
+                          args.verbose, args.repeats)
+    results = {
+        'environment': get_environment(),
+        'settings': {'format': args.format, 'workers': args.workers, 'seed': seed, 'repeats': args.repeats},
+        'results': rows,
+    }
+    with open(args.output, 'w') as results_file:
+        json.dump(results, results_file, indent=1)
+    print(f'Saved results to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Copying a video's audio track into its own small file once, so clips can be ripped without reopening the video.
+
+Ripping thousands of clips straight from a big video means opening its container and seeking through it thousands of
+times just to read the audio. The audio is stream copied, not re-encoded, into an audio-only file with a seek point
+for every packet. Only the final mux goes back to the video.
+"""
+
+import json
+from pathlib import Path
+
+import ffmpeg
+
+from kingsquit import media, trace
+from kingsquit.atomic import replace_when_done
+from kingsquit.fingerprint import fingerprint_file
+
+
+info_name = 'source-audio.json'
+# containers to try, in order, as file name, ffmpeg format and options.
+# mp4 keeps exact sample timestamps and the encoder delay, and with faststart its index of every packet is at the front.
+# Matroska only has millisecond timestamps and loses the encoder delay, which moves clips by about a frame, so it's
+# only for codecs mp4 can't hold. Its clusters are kept short so there's a seek point every 250ms.
+containers = [
+    ('source-audio.m4a', 'mp4', {'movflags': '+faststart'}),
+    ('source-audio.mka', 'matroska', {'cluster_time_limit': 250, 'cues_to_front': 1}),
+]
+
+
+def copy_audio(video_path: Path, cache_path: Path, container_format: str, options: dict):
+    """Stream copy the first audio track of a video into an audio-only file.
+
+    Copies to a temporary name first, so a copy from a stopped run never looks complete.
+    """
+    with replace_when_done(cache_path) as partial_path:
+        stream = ffmpeg.input(str(video_path))
+        stream = ffmpeg.output(stream['a:0'], str(partial_path), format=container_format, **options, **{'c:a': 'copy'})
+        media.run(stream, quiet=True, overwrite_output=True)
+
+
+@trace.stage
+def demux_audio(video_path: Path) -> Path:
+    """Get an audio-only copy of a video's first audio track, from the cache if it's up to date, or by copying it.
+
+    Args:
+        video_path -- path to the video, the copy is saved in its folder
+    Returns the path of the audio-only file, or the video path if the audio couldn't be copied, so ripping still
+    works, just slower.
+    """
+    video_folder = video_path.with_suffix('')
+    cache_info_path = video_folder / info_name
+    fingerprint = fingerprint_file(video_path)
+
+    try:
+        with open(cache_info_path) as cache_info_file:
+            cache_info = json.load(cache_info_file)
+        cache_path = video_folder / cache_info['name']
+        if cache_info['fingerprint'] == fingerprint and cache_path.is_file():
+            return cache_path
+    except (FileNotFoundError, json.JSONDecodeError, KeyError, TypeError):
+        pass
+
+    print('Copying audio track')
+    cache_info_path.unlink(missing_ok=True)
+    video_folder.mkdir(parents=True, exist_ok=True)
+    for name, container_format, options in containers:
+        cache_path = video_folder / name
+        cache_path.unlink(missing_ok=True)
+        try:
+            copy_audio(video_path, cache_path, container_format, options)
+        except ffmpeg.Error as err:
+            last_error = err
+        else:
+            with open(cache_info_path, 'w') as cache_info_file:
+                json.dump({'fingerprint': fingerprint, 'name': name}, cache_info_file)
+            return cache_path
+
+    print("Couldn't copy the audio track, ripping from the video instead: "
+          f"{media.get_stderr_tail(last_error.stderr)}")
+    return video_path
+
+
+def clear_cache(video_path: Path) -> int:
+    """Delete the audio-only copy of a video, and return how many bytes it took."""
+    video_folder = video_path.with_suffix('')
+    size = 0
+    for path in [video_folder / name for name, _, _ in containers] + [video_folder / info_name]:
+        try:
+            size += path.stat().st_size
+        except FileNotFoundError:
+            continue
+        path.unlink(missing_ok=True)
+    return size
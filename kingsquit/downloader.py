@@ -1,11 +1,28 @@
 """Module for downloading videos with youtube_dl and processing their subtitles into a timestamps file."""
 
-import json
+import re
+import typing
+import threading
+import urllib.parse
 from pathlib import Path
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, Future
 
-import youtube_dl as youtube_yl  # youtube yownloader
-import pycaption
-import pysrt
+from kingsquit import subtitles, trace, journal
+
+
+# name of the timestamps file's entry in the video folder's journal
+timestamps_stage = 'timestamps'
+# a url without its http://, like youtube.com/watch?v=..., which youtube-dl adds it back to
+schemeless_url_pattern = re.compile(r'[^\s/]+\.[^\s/]+/')
+
+
+def is_url(text: str) -> bool:
+    """Check whether an input is a web url youtube-dl can be given, rather than a path or a search."""
+    parsed = urllib.parse.urlparse(text)
+    if parsed.scheme:
+        return parsed.scheme in ('http', 'https') and bool(parsed.netloc)
+    return bool(schemeless_url_pattern.match(text))
 
 
 def find_subtitle_file(video_path: Path, sub_extension: str = '.ttml'):
@@ -34,30 +51,96 @@ def find_subtitle_file(video_path: Path, sub_extension: str = '.ttml'):
     return None
 
 
-def srt_to_timestamps(srt_path: Path):
-    """Convert a .srt subtitles file to a list of tuple timestamps, and save it to json."""
-    srt_subtitles = pysrt.open(srt_path)
+def find_timestamps(video_path: Path) -> typing.Optional[Path]:
+    """Find the timestamps file for a local video, converting its subtitle file if there isn't one yet.
 
-    timestamps = [(s.start.ordinal/1000, s.end.ordinal/1000) for s in srt_subtitles]
-    with open(srt_path.with_suffix('.json'), 'w') as timestamps_file:
-        json.dump(timestamps, timestamps_file)
+    If there are no usable subtitles, the dialogue is found from the audio with detect_timestamps instead. A timestamps
+    file that was made from other subtitles, or by a run that was stopped, is made again.
+    Returns the path of the timestamps file, or None if there's no dialogue.
+    """
+    timestamps_path = video_path.with_suffix('.json')
+    subtitle_path = None
+    for extension in ('.ttml', '.vtt', '.srt'):
+        subtitle_path = find_subtitle_file(video_path, extension)
+        if subtitle_path:
+            break
+
+    video_journal = journal.get_journal(video_path.with_suffix(''))
+    if timestamps_path.is_file():
+        entry = video_journal.get(timestamps_stage)
+        # one the journal doesn't know about was made by hand or before there was a journal, so it's kept
+        if entry is None or entry['done'] and (not subtitle_path or entry['key'] == get_subtitles_key(subtitle_path)):
+            return timestamps_path
+
+    if subtitle_path:
+        key = get_subtitles_key(subtitle_path)
+        video_journal.start(timestamps_stage, key)
+        if convert_subs(subtitle_path):
+            video_journal.finish(timestamps_stage, key, [timestamps_path])
+            return timestamps_path
+    return detect_timestamps(video_path)
+
+
+def get_subtitles_key(subtitle_path: Path) -> str:
+    """Get the journal key of the timestamps made from a subtitle file."""
+    return journal.make_key('subtitles', subtitle_path.name, journal.file_key(subtitle_path))
+
+
+def get_speech_key(video_path: Path) -> str:
+    """Get the journal key of the timestamps found from a video's audio."""
+    # imported here so videos with subtitles don't import numpy for it
+    from kingsquit import vad
+    return journal.make_key('speech', journal.file_key(video_path), vad.default_min_speech, vad.default_min_pause,
+                            vad.default_padding)
+
+
+def detect_timestamps(video_path: Path) -> typing.Optional[Path]:
+    """Make the timestamps file for a video without usable subtitles, by finding the dialogue in its audio.
+
+    Does nothing if the journal says it was already made from the same video.
+    Returns the path of the timestamps file, or None if no dialogue was found. Raises MediaError if the audio can't
+    be decoded.
+    """
+    from kingsquit import vad
+    timestamps_path = video_path.with_suffix('.json')
+    video_journal = journal.get_journal(video_path.with_suffix(''))
+    key = get_speech_key(video_path)
+    if video_journal.is_done(timestamps_stage, key):
+        return timestamps_path
+
+    print('Finding the dialogue from the audio')
+    video_journal.start(timestamps_stage, key)
+    if not vad.detect_speech(video_path, timestamps_path):
+        print('No dialogue found')
+        timestamps_path.unlink()
+        return None
+    video_journal.finish(timestamps_stage, key, [timestamps_path])
+    return timestamps_path
 
 
-def convert_subs(subtitle_path: Path):
-    """Convert any valid subtitle file to srt subtitles for processing, using pycaption; then process them.
+def srt_to_timestamps(srt_path: Path):
+    """Convert a .srt subtitles file to a list of timestamps with their text, and save it to json."""
+    subtitles.write_timestamps(subtitles.parse_cues(srt_path), srt_path.with_suffix('.json'))
+
+
+def convert_subs_with_pycaption(subtitle_path: Path):
+    """Convert a subtitle file the fast parsers don't support to srt subtitles using pycaption, then process them.
 
     Args:
         subtitle_path -- path of subtitles to convert
     Return True if successful, False otherwise.
     """
+    # slow to import and only needed for unusual formats
+    import pycaption
+
     with open(subtitle_path, encoding='utf-8') as sub_file:
-        subtitles = sub_file.read()
-    subtitle_reader_class = pycaption.detect_format(subtitles)
+        subtitle_text = sub_file.read()
+    subtitle_reader_class = pycaption.detect_format(subtitle_text)
     if not subtitle_reader_class:
         return False
 
     subtitle_reader = subtitle_reader_class()
-    srt_subtitles = pycaption.SRTWriter().write(subtitle_reader.read(subtitles))
+    srt_subtitles = pycaption.SRTWriter().write(subtitle_reader.read(subtitle_text))
     with open(subtitle_path.with_suffix('.srt'), 'w', encoding='utf-8') as sub_file:
         sub_file.write(srt_subtitles)
 
@@ -65,43 +148,119 @@ def convert_subs(subtitle_path: Path):
     return True
 
 
-progress_hook = {}
-
+@trace.stage
+def convert_subs(subtitle_path: Path):
+    """Convert any valid subtitle file to a json timestamps file.
 
-def extract_progress_hook(hook: dict):
-    """Take the progress hook dict from ytdl and make it a global variable.
+    Args:
+        subtitle_path -- path of subtitles to convert
+    Return True if successful, False otherwise.
 
-    A bit of a hack but the best way I can think of to get it right now.
+    TTML, WebVTT and SRT are read straight into timestamps with the fast parsers in kingsquit.subtitles. Anything
+    else goes through pycaption.
     """
-    global progress_hook
-    progress_hook = hook
+    timestamps = subtitles.iter_timestamps(subtitle_path)
+    if timestamps is None:
+        return convert_subs_with_pycaption(subtitle_path)
+
+    try:
+        count = subtitles.write_timestamps(timestamps, subtitle_path.with_suffix('.json'))
+    except (ValueError, ElementTree.ParseError):
+        subtitle_path.with_suffix('.json').unlink(missing_ok=True)
+        return False
+    return bool(count)
 
 
-def process_progress_hook(hook: dict):
-    """Process video once it's done downloading.
+def convert_downloaded_subs(video_path: Path) -> typing.Optional[Path]:
+    """Find and convert the subtitles youtube-dl downloaded for a video.
 
-    Progress hook for ytdl. Once the download status is 'finished', get the subtitle path from the video path,
-    and run convert_subs on it.
+    Returns the path of the subtitle file if it was converted, or None if it wasn't found or couldn't be converted.
     """
-    # would be nice if youtube_dl gave you all the downloaded files including the progress hook
-    # and if it let you get the return value of the progress hook
-    if hook['status'] != 'finished':
-        return None, None
-
-    video_path = Path(hook['filename'])
     subtitle_path = find_subtitle_file(video_path)
     if not subtitle_path:
-        print('Subtitle file not found! (speech-to-text auto subtitling coming soon?)')
-        return video_path, None
+        print('Subtitle file not found!')
+        return None
 
     if convert_subs(subtitle_path):
-        return video_path, subtitle_path
+        return subtitle_path
     else:
-        print('Unable to convert subtitles! (speech-to-text auto subtitling coming soon?)')
-        return video_path, None
+        print('Unable to convert subtitles!')
+        return None
+
+
+class DownloadJob:
+    """Class for following one download through its own youtube-dl progress hook.
+
+    Each download gets its own job, so several can run at once without sharing state.
+    """
+
+    def __init__(self, conversion_threads: ThreadPoolExecutor):
+        """Make the futures for the video and subtitles.
+
+        Args:
+            conversion_threads -- executor to convert the subtitles in, while the video is still downloading
+        """
+        self.conversion_threads = conversion_threads
+        # set to the path of the video when youtube-dl says it's finished
+        self.video: Future = Future()
+        # set to the path of the converted subtitles, or None, once the video has started downloading
+        self.subtitles: typing.Optional[Future] = None
+        self.lock = threading.Lock()
+
+    def progress_hook(self, hook: dict):
+        """Progress hook for youtube-dl.
+
+        youtube-dl writes the subtitles before it starts on the video, so the first call starts converting them.
+        The video future is set once the status is finished.
+        """
+        if 'filename' not in hook:
+            return
+        video_path = Path(hook['filename'])
+        with self.lock:
+            if self.subtitles is None:
+                self.subtitles = self.conversion_threads.submit(convert_downloaded_subs, video_path)
+        if hook['status'] == 'finished' and not self.video.done():
+            self.video.set_result(video_path)
+
+    def wait(self) -> typing.Tuple[typing.Optional[Path], typing.Optional[Path]]:
+        """Wait for the video to finish downloading and the subtitles to be converted.
+
+        Returns a tuple of the video path and subtitle path, either of which may be None if it failed.
+        Only call once youtube-dl's download has returned, or from another thread.
+        """
+        if not self.video.done():
+            # youtube-dl returned without ever finishing the video
+            return None, None
+        video_path = self.video.result()
+        subtitle_path = self.subtitles.result() if self.subtitles else convert_downloaded_subs(video_path)
+        return video_path, subtitle_path
+
 
+def download_video(url: str, ydl_opts: dict,
+                   youtube_dl_class=None) -> typing.Tuple[typing.Optional[Path], typing.Optional[Path]]:
+    """Download one video and its subtitles, converting the subtitles while the video is still downloading.
 
-def main(dest: str = ''):
+    Args:
+        url -- url of the video
+        ydl_opts -- options for youtube-dl. the progress hook is added to them
+        youtube_dl_class -- class to download with, youtube_dl.YoutubeDL if None. anything with the same constructor,
+                            context manager and download method works, like a stub that copies local files
+    Returns a tuple of the video path and subtitle path, either of which may be None if it failed.
+    Raises youtube-dl's DownloadError if the download fails. Safe to run from several threads at once.
+    """
+    if youtube_dl_class is None:
+        import youtube_dl as youtube_yl
+        youtube_dl_class = youtube_yl.YoutubeDL
+
+    with ThreadPoolExecutor(1) as conversion_threads:
+        job = DownloadJob(conversion_threads)
+        with youtube_dl_class({**ydl_opts, 'progress_hooks': [job.progress_hook]}) as ydl:
+            ydl.download([url])
+        print('Processing subtitles')
+        return job.wait()
+
+
+def main(dest: str = '', url: str = None, language: str = None, search: str = None, youtube_dl_class=None):
     """Download the video to the destination folder, and process its subtitles.
 
     Args:
@@ -109,9 +268,16 @@ def main(dest: str = ''):
                 must be a string, not a path object, and use forward slashes, not backslashes.
                 should also have no trailing slash.
                 appended to the start of the youtube dl default out template.
-    Returns nothing.
+        url -- url of the video. if None, the url and subtitle language are asked for, and if the url is invalid,
+               whether to search for it instead
+        language -- subtitle language to download, any language if None
+        search -- youtube-dl default_search to use if the url isn't valid, like auto or ytsearch.
+                  if None when the url was given, an invalid url just fails
+        youtube_dl_class -- passed on to download_video
+    Returns a tuple of the video path and subtitle path, either of which may be None if it failed.
     """
-    global progress_hook
+    # slow to import, so it's only imported when something actually needs downloading
+    import youtube_dl as youtube_yl  # youtube yownloader
 
     ydl_opts = {
         'outtmpl': f'{dest}/{youtube_yl.DEFAULT_OUTTMPL}',
@@ -119,46 +285,36 @@ def main(dest: str = ''):
         'writesubtitles': True,
         'writeautomaticsub': True,
         'subtitlesformat': 'ttml',
-        'progress_hooks': [extract_progress_hook],
         # 'nooverwrites': True,
         # 'ignoreerrors': True,
     }
 
     # todo: put the subtitle etc. files in the video folder so as to not clog the main folder
-    url = input('Youtube url: ')
-    subtitleslang = input('Subtitle language to download (type nothing for any): ')
-    # url = 'https://www.youtube.com/watch?v=vDUYLDtC5Qw'
-    # subtitleslang = 'ko'
-    if subtitleslang:
-        ydl_opts['subtitleslangs'] = [subtitleslang]
+    interactive = url is None
+    if interactive:
+        url = input('Youtube url: ')
+        language = input('Subtitle language to download (type nothing for any): ')
+    if language:
+        ydl_opts['subtitleslangs'] = [language]
     try:
-        with youtube_yl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        return download_video(url, ydl_opts, youtube_dl_class)
     except youtube_yl.DownloadError as err:
         if err.exc_info[0] == youtube_yl.utils.ExtractorError:
             # todo: stop youtube dl from logging the error message
-            choice = input('Invalid url, run a search? (y/N/youtube-dl search identifier)\n').casefold()
-            if not choice or choice == 'n':
+            if interactive:
+                choice = input('Invalid url, run a search? (y/N/youtube-dl search identifier)\n').casefold()
+                if choice == 'y':
+                    search = 'auto_warning'
+                elif choice != 'n':
+                    search = choice
+            if not search:
                 return None, None
-            elif choice == 'y':
-                ydl_opts['default_search'] = 'auto_warning'
-            else:
-                ydl_opts['default_search'] = choice
+            ydl_opts['default_search'] = search
 
-            with youtube_yl.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+            return download_video(url, ydl_opts, youtube_dl_class)
         else:
             raise
 
-    print('Processing subtitles')
-    while True:
-        if not progress_hook:
-            continue
-        video_path, subtitle_path = process_progress_hook(progress_hook)
-        if video_path:
-            return video_path, subtitle_path
-        progress_hook = None
-
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,120 @@
+"""Renderer that cuts and joins the shuffled audio with ffmpeg filtergraphs, without clip files or a decoded cache.
+
+Each planned range gets its own input, seeked to just before it in the audio-only copy of the video, and trimmed to
+its exact samples with atrim. A few dozen of them are joined with concat in each ffmpeg run, and the runs' raw output
+is streamed in order into the media backend's mux. So ffmpeg never has to hold audio that isn't needed yet, which one
+graph that splits the whole track into every range would, and memory use doesn't grow with the length of the video.
+"""
+
+import os
+import typing
+import collections
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+
+import kingsquit.demux
+from kingsquit import plan, media, trace, backends
+
+
+sample_format = 'f32le'
+# most inputs in one ffmpeg run, each one costs a few megabytes of memory for its demuxer and decoder
+max_inputs = 32
+# most seconds of audio cut in one ffmpeg run, so one run's output never takes much memory
+max_group_length = 30.0
+
+
+def group_ranges(ranges: plan.tl_type, max_length: int) -> typing.Iterator[plan.tl_type]:
+    """Split planned ranges into groups to cut in one ffmpeg run each.
+
+    Args:
+        ranges -- list of tuple source ranges in samples, in the order they should be played
+        max_length -- most samples in a group. longer ranges are split into pieces that fit
+    Returns an iterator of lists of ranges, with at most max_inputs in each.
+    """
+    group = []
+    group_length = 0
+    for start, end in ranges:
+        for piece_start in range(start, end, max_length):
+            piece_end = min(piece_start + max_length, end)
+            if len(group) == max_inputs or group_length + piece_end - piece_start > max_length:
+                yield group
+                group = []
+                group_length = 0
+            group.append((piece_start, piece_end))
+            group_length += piece_end - piece_start
+    if group:
+        yield group
+
+
+def cut_group(source_path: Path, group: plan.tl_type, sample_rate: int, channels: int) -> bytes:
+    """Cut a group of ranges out of the audio and join them, in one ffmpeg run.
+
+    Returns the raw samples, in sample_format. Raises media.MediaError if ffmpeg fails.
+    """
+    uses = collections.Counter(group)
+    # a range that's used more than once, like a repeated line, is cut once and split
+    splits = {source_range: backends.seek_audio(source_path, *source_range, sample_rate).filter_multi_output(
+                  'asplit', count)
+              for source_range, count in uses.items() if count > 1}
+    parts = []
+    for source_range in group:
+        if source_range in splits:
+            uses[source_range] -= 1
+            parts.append(splits[source_range].stream(uses[source_range]))
+        else:
+            parts.append(backends.seek_audio(source_path, *source_range, sample_rate))
+    stream = ffmpeg.concat(*parts, v=0, a=1) if len(parts) > 1 else parts[0]
+    stream = ffmpeg.output(stream, 'pipe:', format=sample_format, ac=channels)
+    data, _ = media.run(stream, capture_stdout=True, capture_stderr=True)
+    length = sum(end - start for start, end in group)
+    return backends.fit_samples(data, length, backends.get_frame_size(channels, sample_format))
+
+
+def iter_audio(source_path: Path, ranges: plan.tl_type, sample_rate: int, channels: int,
+               workers: int = None) -> typing.Iterator[bytes]:
+    """Get the new audio track, a group of ranges at a time.
+
+    Args:
+        source_path -- path of the audio to cut the ranges from
+        ranges -- list of tuple source ranges in samples, in the order they should be played
+        sample_rate, channels -- format to cut at
+        workers -- number of groups to cut at once, and to cut ahead of the one being muxed
+    Returns an iterator of raw samples in sample_format.
+    """
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(workers) as threads:
+        pending = collections.deque()
+        for group in group_ranges(ranges, round(max_group_length * sample_rate)):
+            pending.append(threads.submit(cut_group, source_path, group, sample_rate, channels))
+            if len(pending) > workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+@trace.stage
+def generate_new_video(video_path: Path, final_result_path: Path, video_info: dict, timestamps: plan.tl_type,
+                       strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3, texts: list[str] = None,
+                       workers: int = None):
+    """Shuffle the dialogue and make the new video, cutting the audio with ffmpeg filtergraphs.
+
+    Args:
+        video_path -- path to the video, also used to get the video folder
+        final_result_path -- path to save the new video to
+        video_info -- output of ffmpeg.probe for the video
+        timestamps -- list of tuple timestamps of dialogue, in seconds
+        strategy, seed, jump_chance, texts -- passed on to the shuffle
+        workers -- passed on to iter_audio
+    Returns nothing. Raises media.MediaError if cutting or muxing fails.
+    """
+    audio_info = media.get_audio_stream_info(video_info)
+    sample_rate = int(audio_info['sample_rate'])
+    channels = int(audio_info['channels'])
+    total = round(float(video_info['format']['duration']) * sample_rate)
+    ranges = plan.plan_shuffle(timestamps, sample_rate, total, strategy, seed, jump_chance, texts)
+
+    source_path = kingsquit.demux.demux_audio(video_path)
+    backends.get_backend().mux(video_path, iter_audio(source_path, ranges, sample_rate, channels, workers),
+                               final_result_path, sample_rate, channels, sample_format)
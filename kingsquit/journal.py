@@ -0,0 +1,122 @@
+"""Job journals that record which stages of a job are done, so a stopped job can carry on where it left off.
+
+Each folder a job works in has a journal.json with an entry for each stage: a key made from fingerprints of the
+stage's inputs and its parameters, whether the stage finished, and the size of every file it made. When the job is
+run again, a stage is skipped if its key is the same, it finished, and its files are all still there at the same
+size. A stage that was stopped part way keeps its key, so it can pick up the work it had already done, and one with a
+different key starts again from nothing.
+"""
+
+import os
+import json
+import hashlib
+import typing
+import threading
+from pathlib import Path
+
+from kingsquit.atomic import replace_when_done
+from kingsquit.fingerprint import fingerprint_file
+
+
+journal_name = 'journal.json'
+journals = {}
+journals_lock = threading.Lock()
+
+
+def make_key(*parts) -> str:
+    """Make a key from anything that can be saved as json, like file fingerprints, timestamps and settings."""
+    text = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def file_key(path: Path) -> typing.Optional[str]:
+    """Get the fingerprint of an input file for a key, or None if it doesn't exist."""
+    try:
+        return fingerprint_file(path)
+    except FileNotFoundError:
+        return None
+
+
+def describe_outputs(paths: typing.Iterable[str]) -> typing.Optional[str]:
+    """Get a digest of the names and sizes of some files, or None if any of them is missing."""
+    outputs_hash = hashlib.sha1()
+    for path in paths:
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        outputs_hash.update(f'{path}:{size}\n'.encode())
+    return outputs_hash.hexdigest()
+
+
+class Journal:
+    """Class for the journal of one folder. Get one with get_journal, so every thread shares the same one."""
+
+    def __init__(self, folder: Path):
+        """Load the journal from the folder, or start an empty one if it doesn't have one or it can't be read."""
+        self.path = folder / journal_name
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as journal_file:
+                self.entries = json.load(journal_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.entries = {}
+
+    def save(self):
+        """Save the journal, writing to a temporary name first so a stopped run never leaves half a journal."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with replace_when_done(self.path) as partial_path, open(partial_path, 'w') as journal_file:
+            json.dump(self.entries, journal_file, indent=1)
+
+    def get(self, stage: str, key: str = None) -> typing.Optional[dict]:
+        """Get the entry of a stage if it has the same key, whether or not it finished, or None if it doesn't.
+
+        With no key, the entry is returned whatever its key is.
+        """
+        with self.lock:
+            entry = self.entries.get(stage)
+        if entry is None or key is not None and entry['key'] != key:
+            return None
+        return entry
+
+    def is_done(self, stage: str, key: str) -> bool:
+        """Check whether a stage finished with the same key, and the files it made are still there at the same size."""
+        entry = self.get(stage, key)
+        if entry is None or not entry['done']:
+            return False
+        outputs_digest = describe_outputs(entry['outputs'])
+        return outputs_digest is not None and outputs_digest == entry['outputs_digest']
+
+    def start(self, stage: str, key: str, outputs: typing.Iterable[Path] = (), **details):
+        """Record that a stage has started with a key, and save the journal.
+
+        Args:
+            stage -- name of the stage
+            key -- key of the stage's inputs and parameters, see make_key
+            outputs -- files the stage is going to make, if they're known before it starts. saved as absolute paths
+            details -- anything else to save in the entry, which can be read back with get
+        """
+        with self.lock:
+            self.entries[stage] = {'key': key, 'done': False, 'outputs': [os.path.abspath(p) for p in outputs],
+                                   'outputs_digest': None, **details}
+            self.save()
+
+    def finish(self, stage: str, key: str, outputs: typing.Iterable[Path] = (), **details):
+        """Record that a stage finished, with the files it made and their sizes, and save the journal.
+
+        Takes the same arguments as start.
+        """
+        outputs = [os.path.abspath(p) for p in outputs]
+        with self.lock:
+            self.entries[stage] = {'key': key, 'done': True, 'outputs': outputs,
+                                   'outputs_digest': describe_outputs(outputs), **details}
+            self.save()
+
+
+def get_journal(folder: Path) -> Journal:
+    """Get the journal of a folder, loading it the first time."""
+    folder = folder.resolve()
+    with journals_lock:
+        if folder not in journals:
+            journals[folder] = Journal(folder)
+        return journals[folder]
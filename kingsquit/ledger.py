@@ -0,0 +1,63 @@
+"""Duration ledger for the clips renderer, comparing the duration asked for with the real duration of every clip.
+
+The manifests already record both durations, so the totals work from manifest entries. Whether a clip came out the
+wrong length is checked against the number of samples in its file, so clips that failed or came out wrong are found
+one at a time and repaired on their own, and the totals show exactly how far the new audio track is from the length
+of the video.
+"""
+
+import typing
+
+from kingsquit import media
+from kingsquit.manifest import ClipEntry, status_ok, status_failed, status_repaired
+
+
+# how many samples a clip's length can be off before it's repaired. wav clips are cut exactly, but ffmpeg rounds the
+# times it's given to the nearest sample
+sample_tolerance = 1
+
+
+def clip_drift(entry: ClipEntry) -> typing.Optional[float]:
+    """Get how much longer a clip came out than was asked for, in seconds, or None if its real duration isn't known."""
+    if entry.status == status_failed or entry.real_duration is None:
+        return None
+    return entry.real_duration - entry.duration
+
+
+def needs_repair(entry: ClipEntry, tolerance: int = sample_tolerance) -> bool:
+    """Check whether a clip failed, or has more than the tolerance too many or too few samples.
+
+    Counts the samples in the clip's file, so a clip whose file is missing or can't be read needs repairing too.
+    """
+    if entry.status == status_failed:
+        return True
+    samples = media.get_wav_samples(entry.path)
+    if samples is None:
+        return True
+    count, sample_rate = samples
+    return abs(count - round(entry.duration * sample_rate)) > tolerance
+
+
+def summarise_ledger(entries: typing.Iterable[ClipEntry]) -> dict:
+    """Add up the requested and real durations of some clips.
+
+    Returns a dict with the number of clips, how many were ok, repaired and failed, the requested and real total
+    durations in seconds, and the drift between them. Clips with an unknown real duration count as their requested
+    duration, and failed clips count as nothing.
+    """
+    summary = {'clips': 0, status_ok: 0, status_repaired: 0, status_failed: 0, 'requested': 0.0, 'real': 0.0}
+    for entry in entries:
+        summary['clips'] += 1
+        summary[entry.status] += 1
+        summary['requested'] += entry.duration
+        if entry.status != status_failed:
+            summary['real'] += entry.best_duration
+    summary['drift'] = summary['real'] - summary['requested']
+    return summary
+
+
+def describe_ledger(summary: dict) -> str:
+    """Describe a ledger summary, for printing."""
+    return (f"{summary['clips']} clips, {summary[status_repaired]} repaired, {summary[status_failed]} failed: "
+            f"{summary['real']:.3f}s of audio for {summary['requested']:.3f}s asked for "
+            f"({summary['drift']:+.3f}s)")
@@ -0,0 +1,62 @@
+"""Manifest files that record the clips in a folder, so later stages don't have to scan folders or parse file names.
+
+Each rip stage writes a manifest.json next to its clips, with the start, requested duration, real duration, file
+name and status of every clip, in timeline order.
+"""
+
+import json
+import typing
+from pathlib import Path
+
+from kingsquit.atomic import replace_when_done
+
+
+manifest_name = 'manifest.json'
+status_ok = 'ok'
+status_failed = 'failed'
+# made again on its own after failing or coming out the wrong length, see kingsquit.ledger
+status_repaired = 'repaired'
+
+
+class ClipEntry(typing.NamedTuple):
+    """A clip in a manifest."""
+
+    start: float
+    duration: float
+    real_duration: typing.Optional[float]
+    path: Path
+    status: str
+
+    @property
+    def best_duration(self) -> float:
+        """Get the real duration of the clip if it's known, or the requested duration if not."""
+        if self.real_duration is None:
+            return self.duration
+        return self.real_duration
+
+
+def load_manifest(folder: Path) -> typing.List[ClipEntry]:
+    """Load the manifest of a folder of clips, or return an empty list if there isn't one."""
+    try:
+        with open(folder / manifest_name) as manifest_file:
+            rows = json.load(manifest_file)['clips']
+    except FileNotFoundError:
+        return []
+
+    return [ClipEntry(start, duration, real_duration, folder / name, status)
+            for start, duration, real_duration, name, status in rows]
+
+
+def save_manifest(folder: Path, entries: typing.Iterable[ClipEntry]):
+    """Save the manifest of a folder of clips, replacing any old one.
+
+    Writes to a temporary name first, so a stopped run never leaves half a manifest.
+    """
+    rows = [(e.start, e.duration, e.real_duration, e.path.name, e.status) for e in entries]
+    with replace_when_done(folder / manifest_name) as partial_path, open(partial_path, 'w') as manifest_file:
+        json.dump({'clips': rows}, manifest_file, separators=(',', ':'))
+
+
+def ok_entries(entries: typing.Iterable[ClipEntry]) -> typing.List[ClipEntry]:
+    """Get only the clips that were made successfully, including ones that had to be repaired."""
+    return [e for e in entries if e.status in (status_ok, status_repaired)]
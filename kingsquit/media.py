@@ -0,0 +1,198 @@
+"""Small helpers on top of ffmpeg-python that the renderers share.
+
+Every ffmpeg and ffprobe process goes through here, so they can be limited, counted and traced in one place.
+"""
+
+import os
+import typing
+import threading
+import contextlib
+from pathlib import Path
+
+import ffmpeg
+
+from kingsquit import trace
+
+
+# shared semaphore limiting how many ffmpeg processes run at once, across threads and processes
+process_limit = None
+# number of ffmpeg and ffprobe processes started by this process, for benchmarking
+process_count = 0
+process_count_lock = threading.Lock()
+
+
+def set_process_limit(semaphore):
+    """Limit how many ffmpeg processes can run at once with a (multiprocessing) semaphore, or None for no limit."""
+    global process_limit
+    process_limit = semaphore
+
+
+class MediaError(ffmpeg.Error):
+    """Error from ffmpeg or another media backend, with a message that says what went wrong.
+
+    A subclass of ffmpeg.Error, so code that catches that still catches this.
+    """
+
+    def __init__(self, message: str, cmd: str = 'ffmpeg', stdout: bytes = None, stderr: bytes = None):
+        """Save the message, and the command and its output like ffmpeg.Error."""
+        super().__init__(cmd, stdout, stderr)
+        self.args = (message,)
+
+
+def count_process():
+    """Count an ffmpeg or ffprobe process being started."""
+    global process_count
+    with process_count_lock:
+        process_count += 1
+
+
+def get_stderr_tail(stderr: typing.Optional[bytes]) -> typing.Optional[str]:
+    """Get the last line ffmpeg printed, which usually says what went wrong, or None if nothing was captured."""
+    lines = stderr.decode(errors='replace').strip().splitlines() if stderr else []
+    return lines[-1] if lines else None
+
+
+def get_output_size(args: typing.List[str]) -> int:
+    """Get the size of the file an ffmpeg command wrote, from its last argument, or 0 if it didn't write a file."""
+    # ffmpeg-python puts the overwrite flag after the output file
+    output = args[-2] if args[-1] in ('-y', '-n') else args[-1]
+    try:
+        return os.path.getsize(output)
+    except OSError:
+        return 0
+
+
+@contextlib.contextmanager
+def traced_process(name: str, get_args: typing.Callable[[], typing.List[str]]):
+    """Count a process, and trace how long it takes, its arguments, exit status and bytes out if tracing is on.
+
+    Args:
+        name -- name of the process for the trace, ffmpeg or ffprobe
+        get_args -- function that gets the command line, only called if tracing is on
+    Yields the dict of details for the trace, so the with block can add the exit status if it knows it.
+    """
+    count_process()
+    with trace.span(name, 'ffmpeg') as details:
+        if trace.enabled():
+            details['args'] = get_args()
+        try:
+            yield details
+        except ffmpeg.Error as err:
+            details['stderr'] = get_stderr_tail(err.stderr)
+            raise
+        details.setdefault('returncode', 0)
+        if 'args' in details:
+            details['bytes_out'] = get_output_size(details['args'])
+
+
+@contextlib.contextmanager
+def program_needed(name: str):
+    """Turn the error from starting ffmpeg or ffprobe when it isn't installed into a MediaError that says so."""
+    try:
+        yield
+    except FileNotFoundError as err:
+        raise MediaError(f"Couldn't find {name}, install ffmpeg and put it on your PATH: "
+                         f"https://ffmpeg.org/download.html", name) from err
+
+
+@contextlib.contextmanager
+def process_slot():
+    """Wait for a free ffmpeg process slot, and hold it until the with block ends."""
+    if process_limit is None:
+        yield
+    else:
+        with process_limit:
+            yield
+
+
+def run(stream, **kwargs):
+    """Run an ffmpeg-python stream like ffmpeg.run, once there's a free process slot.
+
+    Raises MediaError if ffmpeg fails or isn't installed.
+    """
+    with process_slot(), program_needed('ffmpeg'):
+        with traced_process('ffmpeg', lambda: ffmpeg.compile(stream, overwrite_output=kwargs.get('overwrite_output'))):
+            try:
+                return ffmpeg.run(stream, **kwargs)
+            except ffmpeg.Error as err:
+                raise MediaError(f'ffmpeg failed: {get_stderr_tail(err.stderr) or "see its output above"}',
+                                 'ffmpeg', err.stdout, err.stderr) from err
+
+
+def run_async(stream, **kwargs):
+    """Start an ffmpeg-python stream like ffmpeg.run_async.
+
+    Doesn't take a process slot, because the process outlives the call. Use process_slot around it if it should.
+    Raises MediaError if ffmpeg isn't installed.
+    """
+    count_process()
+    if trace.enabled():
+        trace.instant('ffmpeg started', args=ffmpeg.compile(stream, overwrite_output=kwargs.get('overwrite_output')))
+    with program_needed('ffmpeg'):
+        return ffmpeg.run_async(stream, **kwargs)
+
+
+def probe(filename: str, **kwargs) -> dict:
+    """Probe a file like ffmpeg.probe, once there's a free process slot.
+
+    Raises MediaError if ffprobe fails or isn't installed.
+    """
+    with process_slot(), program_needed('ffprobe'):
+        with traced_process('ffprobe', lambda: ['ffprobe', filename]):
+            try:
+                return ffmpeg.probe(filename, **kwargs)
+            except ffmpeg.Error as err:
+                raise MediaError(f"Couldn't read {filename}: {get_stderr_tail(err.stderr)}", 'ffprobe', err.stdout,
+                                 err.stderr) from err
+
+
+def get_audio_stream_info(video_info: dict) -> dict:
+    """Get the info for the first audio stream from the output of ffmpeg.probe."""
+    for stream_info in video_info['streams']:
+        if stream_info['codec_type'] == 'audio':
+            return stream_info
+    raise ValueError('Video has no audio stream')
+
+
+def get_wav_samples(path: Path) -> typing.Optional[typing.Tuple[int, int]]:
+    """Get the number of samples in a wav file and its sample rate, or None if it isn't a wav file ffmpeg wrote.
+
+    Reads the sizes in its header instead of trusting ffmpeg's progress line, which is only as precise as a frame of
+    the codec it thinks it's writing.
+    """
+    try:
+        with open(path, 'rb') as wav_file:
+            if wav_file.read(4) not in (b'RIFF', b'RF64') or wav_file.read(8)[4:] != b'WAVE':
+                return None
+            sample_rate = frame_size = data_size = None
+            while True:
+                header = wav_file.read(8)
+                if len(header) < 8:
+                    return None
+                chunk_id, chunk_size = header[:4], int.from_bytes(header[4:], 'little')
+                if chunk_id == b'ds64':
+                    # rf64 files keep the real data size here, when it's too big for the data chunk's header
+                    data_size = int.from_bytes(wav_file.read(chunk_size)[8:16], 'little')
+                elif chunk_id == b'fmt ':
+                    fmt = wav_file.read(chunk_size)
+                    sample_rate = int.from_bytes(fmt[4:8], 'little')
+                    frame_size = int.from_bytes(fmt[12:14], 'little')
+                elif chunk_id == b'data':
+                    if data_size is None or chunk_size != 0xFFFFFFFF:
+                        data_size = chunk_size
+                    break
+                else:
+                    wav_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+    except OSError:
+        return None
+    if not sample_rate or not frame_size:
+        return None
+    return data_size // frame_size, sample_rate
+
+
+def get_wav_duration(path: Path) -> typing.Optional[float]:
+    """Get the duration of a wav file in seconds from the number of samples it holds, or None like get_wav_samples."""
+    samples = get_wav_samples(path)
+    if samples is None:
+        return None
+    return samples[0] / samples[1]
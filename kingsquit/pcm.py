@@ -0,0 +1,177 @@
+"""Renderer that shuffles the decoded audio as a NumPy array, instead of as clip files.
+
+The audio track is decoded once with the media backend into a raw cache file in the video folder, which later runs
+memory-map instead of decoding again. It's cached at the source's own sample depth, so 16-bit audio takes half the
+space of the floats most lossy codecs decode to. The new audio is cut at exact sample offsets and streamed into a
+single encode while being muxed back onto the video.
+"""
+
+import json
+import typing
+from pathlib import Path
+
+import numpy as np
+
+from kingsquit import plan, media, trace, backends
+from kingsquit.atomic import replace_when_done
+from kingsquit.fingerprint import fingerprint_file
+
+
+# raw sample format to cache in for the sample formats decoders give, and for any other
+cache_formats = {'u8': 's16le', 'u8p': 's16le', 's16': 's16le', 's16p': 's16le'}
+default_cache_format = 'f32le'
+cache_name = 'audio.pcm'
+# rows written to ffmpeg at once, so long ranges don't get copied into memory all at once
+write_chunk_size = 1 << 16
+
+
+def get_cache_paths(video_path: Path) -> tuple[Path, Path]:
+    """Get the paths of the decoded audio cache file and its info file."""
+    cache_path = video_path.with_suffix('') / cache_name
+    return cache_path, cache_path.with_suffix('.json')
+
+
+def get_sample_format(audio_info: dict) -> str:
+    """Get the raw sample format to cache a video's audio in, from the info about its audio stream from probing it."""
+    return cache_formats.get(audio_info.get('sample_fmt'), default_cache_format)
+
+
+def get_array_format(samples: np.ndarray) -> str:
+    """Get the raw sample format of decoded audio from load_audio."""
+    return next(name for name, (_, dtype) in backends.sample_formats.items() if samples.dtype == dtype)
+
+
+def decode_audio_to_file(video_path: Path, cache_path: Path, sample_rate: int, channels: int, sample_format: str):
+    """Decode the whole audio track of a video into a raw sample file, with the media backend.
+
+    Decodes to a temporary name first, so a cache from a stopped run never looks complete.
+    """
+    with replace_when_done(cache_path) as partial_path:
+        backends.get_backend().decode_to_file(video_path, partial_path, sample_rate, channels, sample_format)
+
+
+def get_cache_info(video_path: Path, sample_rate: int, channels: int, sample_format: str) -> dict:
+    """Get the info a cache of a video's decoded audio has to have saved with it to be up to date."""
+    return {
+        'fingerprint': fingerprint_file(video_path),
+        'format': sample_format,
+        'sample_rate': sample_rate,
+        'channels': channels,
+    }
+
+
+def map_cache(cache_path: Path, channels: int, sample_format: str) -> np.ndarray:
+    """Memory-map a decoded audio cache file, with one row per sample and one column per channel."""
+    dtype = backends.sample_formats[sample_format][1]
+    if not cache_path.stat().st_size:
+        # np.memmap can't map an empty file
+        return np.zeros((0, channels), dtype=dtype)
+    return np.memmap(cache_path, dtype=dtype, mode='r').reshape(-1, channels)
+
+
+def get_cached_audio(video_path: Path, sample_rate: int, channels: int,
+                     sample_format: str = default_cache_format) -> typing.Optional[np.ndarray]:
+    """Get the decoded audio of a video from the cache, without decoding it.
+
+    Returns a read-only memory-mapped array like load_audio, or None if there's no up to date cache.
+    """
+    cache_path, cache_info_path = get_cache_paths(video_path)
+    try:
+        with open(cache_info_path) as cache_info_file:
+            cache_valid = json.load(cache_info_file) == get_cache_info(video_path, sample_rate, channels,
+                                                                       sample_format)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache_valid = False
+    if not cache_valid or not cache_path.is_file():
+        return None
+    return map_cache(cache_path, channels, sample_format)
+
+
+@trace.stage
+def load_audio(video_path: Path, sample_rate: int, channels: int,
+               sample_format: str = default_cache_format) -> np.ndarray:
+    """Get the decoded audio of a video, from the cache if it's up to date, or by decoding it again if not.
+
+    Args:
+        video_path -- path to the video, the cache is saved in its folder
+        sample_rate -- sample rate to decode at
+        channels -- number of channels to decode
+        sample_format -- raw sample format to decode to, from get_sample_format
+    Returns a read-only memory-mapped array with one row per sample and one column per channel.
+    """
+    samples = get_cached_audio(video_path, sample_rate, channels, sample_format)
+    if samples is not None:
+        print('Loaded decoded audio cache')
+        return samples
+
+    print('Decoding audio')
+    cache_path, cache_info_path = get_cache_paths(video_path)
+    cache_info_path.unlink(missing_ok=True)
+    decode_audio_to_file(video_path, cache_path, sample_rate, channels, sample_format)
+    with open(cache_info_path, 'w') as cache_info_file:
+        json.dump(get_cache_info(video_path, sample_rate, channels, sample_format), cache_info_file)
+    return map_cache(cache_path, channels, sample_format)
+
+
+def clear_cache(video_path: Path) -> int:
+    """Delete the decoded audio cache of a video, and return how many bytes it took."""
+    size = 0
+    for path in get_cache_paths(video_path):
+        try:
+            size += path.stat().st_size
+        except FileNotFoundError:
+            continue
+        path.unlink(missing_ok=True)
+    return size
+
+
+@trace.stage
+def mux_audio(video_path: Path, final_result_path: Path, samples: np.ndarray, ranges: plan.tl_type,
+              sample_rate: int):
+    """Stream the planned ranges of the audio into ffmpeg, and join them with the original video stream.
+
+    Args:
+        video_path -- path to the video to take the video stream from
+        final_result_path -- path to save the new video to
+        samples -- array of the original audio
+        ranges -- list of tuple source ranges in samples, in the order they should be played
+        sample_rate -- sample rate of the audio
+    Returns nothing. Raises media.MediaError if muxing fails.
+
+    Muxed with the media backend. The new audio is never held in memory all at once.
+    """
+    def chunks() -> typing.Iterator[bytes]:
+        for start, end in ranges:
+            for chunk_start in range(start, end, write_chunk_size):
+                chunk_end = min(chunk_start + write_chunk_size, end)
+                yield samples[chunk_start:chunk_end].tobytes()
+
+    backends.get_backend().mux(video_path, chunks(), final_result_path, sample_rate, samples.shape[1],
+                               get_array_format(samples))
+
+
+@trace.stage
+def generate_new_video(video_path: Path, final_result_path: Path, video_info: dict, timestamps: plan.tl_type,
+                       strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3, texts: list[str] = None,
+                       samples: np.ndarray = None):
+    """Shuffle the dialogue using the decoded audio and make the new video.
+
+    Args:
+        video_path -- path to the video
+        final_result_path -- path to save the new video to
+        video_info -- output of ffmpeg.probe for the video
+        timestamps -- list of tuple timestamps of dialogue, in seconds
+        strategy, seed, jump_chance, texts -- passed on to the shuffle
+        samples -- decoded audio of the video from load_audio, loaded here if None
+    Returns nothing.
+
+    The new audio has exactly as many samples as the original, so it can't drift out of sync with the video.
+    """
+    audio_info = media.get_audio_stream_info(video_info)
+    sample_rate = int(audio_info['sample_rate'])
+    channels = int(audio_info['channels'])
+
+    if samples is None:
+        samples = load_audio(video_path, sample_rate, channels, get_sample_format(audio_info))
+    ranges = plan.plan_shuffle(timestamps, sample_rate, len(samples), strategy, seed, jump_chance, texts)
+    mux_audio(video_path, final_result_path, samples, ranges, sample_rate)
@@ -0,0 +1,325 @@
+"""Functions for planning a shuffle from timestamps alone, without touching any media files.
+
+Renderers share these so they all produce the same shuffle, just executed in different ways.
+
+Lines of dialogue with the same text are given the same replacement, so a catchphrase always comes out the same way.
+Each replacement is planned once, for the longest time its line is said, and every time the line is said takes the
+start of it.
+"""
+
+import re
+import math
+import random
+import typing
+
+
+t_type = typing.Tuple[float, float]
+tl_type = typing.List[t_type]
+# a component is the index of a shuffled item, and the start and end offsets into it
+component_type = typing.Tuple[int, int, int]
+# markup like <i> and {\an8}, and sound descriptions like [music] and (laughs)
+markup_pattern = re.compile(r'<[^>]*>|{[^}]*}|\[[^\]]*\]|\([^)]*\)')
+punctuation_pattern = re.compile(r'[^\w\s]')
+
+
+def get_intermediate_timestamps(timestamps: tl_type, video_duration: float) -> tl_type:
+    """Calculate timestamps where there is no dialogue.
+
+    Args:
+        timestamps -- timestamps of dialogue, sorted and not overlapping
+        video_duration -- length of the video, used to calculate the final timestamp
+    Returns a list of tuple timestamps covering every gap between the dialogue.
+    """
+    intermediate_timestamps = []
+    if timestamps[0][0] != 0:
+        intermediate_timestamps.append((0.0, timestamps[0][0]))
+    for i in range(len(timestamps) - 1):
+        if timestamps[i][1] != timestamps[i+1][0]:
+            intermediate_timestamps.append((timestamps[i][1], timestamps[i+1][0]))
+    if timestamps[-1][1] < video_duration:
+        intermediate_timestamps.append((timestamps[-1][1], video_duration))
+
+    return intermediate_timestamps
+
+
+def timestamps_to_samples(timestamps: tl_type, sample_rate: int) -> tl_type:
+    """Convert timestamps in seconds to whole sample offsets, so later maths is exact."""
+    return [(round(t[0] * sample_rate), round(t[1] * sample_rate)) for t in timestamps]
+
+
+def new_seed() -> int:
+    """Pick a random seed, so it can be shown to the user and used again."""
+    return random.randrange(2 ** 32)
+
+
+def shuffle_chunked(items: list, rng: random.Random, jump_chance: float = 0.3, durations: list = None) -> list:
+    """Shuffle a list in chunks, keeping runs of neighbouring items together.
+
+    Args:
+        items -- list of anything, it is not modified
+        rng -- random number generator to use
+        jump_chance -- chance that it will jump to a new random item instead of continuing to the next item.
+                       so chunks are 1 / jump_chance items long on average
+        durations -- not used
+    Returns a new list of the same items, shuffled.
+
+    Chunk lengths are drawn straight from the geometric distribution, then the chunks are shuffled, so it's O(n).
+    """
+    if not items:
+        return []
+
+    chunks = []
+    start = 0
+    while start < len(items):
+        if jump_chance >= 1:
+            length = 1
+        elif jump_chance <= 0:
+            length = len(items)
+        else:
+            # 1 - random() is in (0, 1] so log never gets 0
+            length = int(math.log(1.0 - rng.random()) / math.log(1.0 - jump_chance)) + 1
+        chunks.append(items[start:start + length])
+        start += length
+
+    rng.shuffle(chunks)
+    return [item for chunk in chunks for item in chunk]
+
+
+def shuffle_random(items: list, rng: random.Random, jump_chance: float = 0.3, durations: list = None) -> list:
+    """Shuffle every item separately. jump_chance and durations are not used."""
+    items_shuffled = list(items)
+    rng.shuffle(items_shuffled)
+    return items_shuffled
+
+
+def shuffle_weighted(items: list, rng: random.Random, jump_chance: float = 0.3, durations: list = None) -> list:
+    """Shuffle every item separately, with longer items more likely to come earlier.
+
+    Each place is filled with probability proportional to duration, from the items left. Uses the sort keys from
+    Efraimidis and Spirakis' weighted sampling, random() ** (1 / weight), so it's O(n log n).
+    jump_chance is not used.
+    """
+    if durations is None:
+        raise ValueError('The weighted shuffle needs durations')
+
+    keys = [rng.random() ** (1 / d) if d > 0 else 0.0 for d in durations]
+    order = sorted(range(len(items)), key=keys.__getitem__, reverse=True)
+    return [items[i] for i in order]
+
+
+shuffle_strategies = {
+    'chunked': shuffle_chunked,
+    'random': shuffle_random,
+    'weighted': shuffle_weighted,
+}
+
+
+def shuffle_items(items: list, strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3,
+                  durations: list = None) -> list:
+    """Shuffle a list with one of the shuffle strategies.
+
+    Args:
+        items -- list of anything, it is not modified
+        strategy -- name of a strategy in shuffle_strategies. add to that dict to add new ones
+        seed -- seed for the random number generator, the same seed and items always give the same shuffle
+        jump_chance -- passed on to the strategy
+        durations -- duration of each item, passed on to the strategy
+    Returns a new list of the same items, shuffled.
+    """
+    rng = random.Random(seed)
+    return shuffle_strategies[strategy](items, rng, jump_chance=jump_chance, durations=durations)
+
+
+def plan_reform(durations: typing.Sequence, targets: typing.Sequence) -> typing.List[typing.List[component_type]]:
+    """Work out which parts of the shuffled items fill each target, by walking a cursor through them.
+
+    Args:
+        durations -- length of each shuffled item, in order
+        targets -- length of each slot that needs filling, in order
+    Returns a list with a list of components for each target. Each component is a tuple of the item index, and the
+    start and end offsets into that item.
+
+    Use whole numbers (e.g. samples) for the lengths, then each target is filled exactly and nothing drifts.
+    """
+    cursor_index = 0
+    cursor_time = 0
+    reform_plan = []
+    for target in targets:
+        time_to_fill = target
+        components = []
+        while time_to_fill > 0 and cursor_index < len(durations):
+            remaining = durations[cursor_index] - cursor_time
+            if remaining > time_to_fill:
+                components.append((cursor_index, cursor_time, cursor_time + time_to_fill))
+                cursor_time += time_to_fill
+                time_to_fill = 0
+            else:
+                if remaining > 0:
+                    components.append((cursor_index, cursor_time, durations[cursor_index]))
+                time_to_fill -= remaining
+                cursor_index += 1
+                cursor_time = 0
+        reform_plan.append(components)
+
+    return reform_plan
+
+
+def get_dialogue_key(text: str) -> typing.Optional[str]:
+    """Normalise the text of a line of dialogue, so lines that sound the same have the same key.
+
+    Markup, sound descriptions in brackets, punctuation, case and spacing are ignored.
+    Returns the key, or None if there are no words left, since lines without text can't be matched up.
+    """
+    key = ' '.join(punctuation_pattern.sub('', markup_pattern.sub(' ', text)).casefold().split())
+    return key or None
+
+
+def get_dialogue_keys(texts: typing.Optional[typing.Sequence[str]], count: int) -> typing.List[typing.Optional[str]]:
+    """Get the key of each line of dialogue, or all None if there's no text."""
+    if texts is None:
+        return [None] * count
+    return [get_dialogue_key(text) for text in texts]
+
+
+def take_start(components: typing.List[component_type], length) -> typing.List[component_type]:
+    """Cut a planned replacement down to the components that fill its first length."""
+    taken = []
+    for index, start, end in components:
+        if length <= 0:
+            break
+        end = min(end, start + length)
+        taken.append((index, start, end))
+        length -= end - start
+    return taken
+
+
+def plan_memoised_reform(durations: typing.Sequence, targets: typing.Sequence,
+                         keys: typing.Sequence[typing.Optional[str]]
+                         ) -> typing.Tuple[typing.List[typing.List[component_type]], typing.List[int]]:
+    """Plan a reform like plan_reform, giving targets with the same key the same replacement.
+
+    Args:
+        durations -- length of each shuffled item, in order
+        targets -- length of each slot that needs filling, in order
+        keys -- dialogue key of each target, see get_dialogue_key. None is never the same as anything
+    Returns a tuple of the list of components for each target, and the number of the replacement each target takes
+    the start of, in order of first use.
+
+    Each key is planned once with plan_reform, for its longest target, so repeated lines don't use up shuffled items.
+    The first target that is the longest for its key gets the whole replacement, so renderers can make each
+    replacement once from that target, then cut the others from it.
+    """
+    longest = {}
+    for target, key in zip(targets, keys):
+        if key is not None:
+            longest[key] = max(longest.get(key, target), target)
+
+    replacement_targets = []
+    replacement_numbers = []
+    key_numbers = {}
+    for target, key in zip(targets, keys):
+        if key is None:
+            replacement_numbers.append(len(replacement_targets))
+            replacement_targets.append(target)
+        else:
+            if key not in key_numbers:
+                key_numbers[key] = len(replacement_targets)
+                replacement_targets.append(longest[key])
+            replacement_numbers.append(key_numbers[key])
+
+    replacements = plan_reform(durations, replacement_targets)
+    reform_plan = [take_start(replacements[number], target) for number, target in zip(replacement_numbers, targets)]
+    return reform_plan, replacement_numbers
+
+
+def get_replacement_owners(targets: typing.Sequence, replacement_numbers: typing.Sequence[int]) -> typing.List[int]:
+    """Get the first target that gets the whole of each replacement, by replacement number.
+
+    The rest of the targets with the same replacement can be cut from the owner's.
+    """
+    owners = {}
+    for i, (target, number) in enumerate(zip(targets, replacement_numbers)):
+        if number not in owners or target > targets[owners[number]]:
+            owners[number] = i
+    return [owners[number] for number in range(len(owners))]
+
+
+def merge_ranges(ranges: tl_type) -> tl_type:
+    """Join ranges that follow on directly from each other, so there are fewer to cut."""
+    merged = []
+    for r in ranges:
+        if merged and merged[-1][1] == r[0]:
+            merged[-1] = (merged[-1][0], r[1])
+        elif r[1] > r[0]:
+            merged.append(r)
+    return merged
+
+
+def plan_timeline(timestamps: tl_type, shuffled: tl_type, total, keys: typing.Sequence[str] = None) -> tl_type:
+    """Plan the whole new audio track as a list of ranges of the original audio.
+
+    Args:
+        timestamps -- timestamps of dialogue, sorted and not overlapping
+        shuffled -- the same timestamps, shuffled
+        total -- length of the whole audio track
+        keys -- dialogue key of each timestamp, lines with the same key get the same replacement. None if unknown
+    Returns a list of tuple source ranges which, played in order, make the new audio track.
+
+    Gaps between dialogue are kept as they are, and dialogue is filled from the shuffled dialogue.
+    """
+    durations = [t[1] - t[0] for t in shuffled]
+    keys = keys if keys is not None else [None] * len(timestamps)
+    reform_plan, _ = plan_memoised_reform(durations, [t[1] - t[0] for t in timestamps], keys)
+
+    ranges = []
+    cursor = 0
+    for t, components in zip(timestamps, reform_plan):
+        if t[0] > cursor:
+            ranges.append((cursor, t[0]))
+        for index, start, end in components:
+            source_start = shuffled[index][0]
+            ranges.append((source_start + start, source_start + end))
+        cursor = t[1]
+    if cursor < total:
+        ranges.append((cursor, total))
+
+    return merge_ranges(ranges)
+
+
+def plan_shuffle(timestamps: tl_type, sample_rate: int, total: int, strategy: str = 'chunked', seed: int = None,
+                 jump_chance: float = 0.3, texts: typing.Sequence[str] = None) -> tl_type:
+    """Shuffle the dialogue and plan the new audio track in samples.
+
+    Args:
+        timestamps -- list of tuple timestamps of dialogue, in seconds
+        sample_rate -- sample rate of the audio
+        total -- length of the whole audio track, in samples
+        strategy, seed, jump_chance -- passed on to shuffle_items
+        texts -- text of each timestamp, so the same lines get the same replacement. None if unknown
+    Returns a list of tuple source ranges in samples, see plan_timeline.
+    """
+    sample_timestamps = timestamps_to_samples(timestamps, sample_rate)
+    durations = [t[1] - t[0] for t in sample_timestamps]
+    shuffled = shuffle_items(sample_timestamps, strategy, seed, jump_chance, durations)
+    return plan_timeline(sample_timestamps, shuffled, total, get_dialogue_keys(texts, len(timestamps)))
+
+
+def cut_timeline(ranges: tl_type, start, end) -> tl_type:
+    """Cut part of a planned audio track out, like a time window of the new video.
+
+    Args:
+        ranges -- list of tuple source ranges, see plan_timeline
+        start, end -- part of the new audio track to keep, in the same units as the ranges
+    Returns the source ranges which, played in order, make that part of the new audio track. They're cut from the
+    plan of the whole track, so they come out the same as that part of it.
+    """
+    window = []
+    position = 0
+    for source_start, source_end in ranges:
+        if position >= end:
+            break
+        length = source_end - source_start
+        if position + length > start:
+            window.append((source_start + max(start - position, 0), source_start + min(end - position, length)))
+        position += length
+    return window
@@ -0,0 +1,126 @@
+"""Renderer for quick previews of a shuffle: one part of the new video, as audio or as a small low-bitrate video.
+
+The whole shuffle is planned the same way as for the full video, then cut down to the part being previewed, so a
+preview sounds exactly like that part of the new video made with the same seed. Only the parts of the audio it uses
+are decoded, or read from the pcm renderer's cache if there is one. So a preview of a long video takes seconds
+instead of minutes.
+"""
+
+import typing
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import ffmpeg
+import numpy as np
+
+from kingsquit import plan, media, trace, backends, pcm
+
+
+# raw sample format the ranges are decoded to when there's no cache. the cache's own format is used if there is one
+sample_format = 'f32le'
+# height of the video in video previews, and how much it's compressed. higher crf is smaller and worse
+preview_height = 360
+preview_crf = 32
+preview_audio_bitrate = '96k'
+
+
+def get_preview_extension(video: bool) -> str:
+    """Get the file extension of a preview, .mp4 for a video preview or .m4a for audio only."""
+    return '.mp4' if video else '.m4a'
+
+
+def iter_window_audio(video_path: Path, ranges: plan.tl_type, sample_rate: int, channels: int,
+                      samples: np.ndarray = None, workers: int = None) -> typing.Iterator[bytes]:
+    """Get the audio of some planned ranges, in order.
+
+    Args:
+        video_path -- path to the video to decode the ranges from
+        ranges -- list of tuple source ranges in samples
+        sample_rate, channels -- format to decode at
+        samples -- decoded audio of the whole video, or None to decode just the ranges with the media backend
+        workers -- number of ranges to decode at once
+    Returns an iterator of raw samples, one chunk for each range, in the samples' format if they're given or else
+    sample_format.
+    """
+    if samples is not None:
+        for start, end in ranges:
+            yield samples[start:end].tobytes()
+        return
+
+    backend = backends.get_backend()
+    with ThreadPoolExecutor(workers) as threads:
+        # a line that's said more than once only needs decoding once
+        decodes = {}
+        for source_range in ranges:
+            if source_range not in decodes:
+                decodes[source_range] = threads.submit(backend.decode_range, video_path, *source_range, sample_rate,
+                                                       channels, sample_format)
+        for source_range in ranges:
+            yield decodes[source_range].result()
+
+
+@trace.stage
+def mux_preview(video_path: Path, chunks: typing.Iterable[bytes], final_result_path: Path, start: float,
+                duration: float, sample_rate: int, channels: int, chunk_format: str = sample_format):
+    """Encode the preview's audio with a small, low-bitrate copy of the same part of the video.
+
+    Args:
+        video_path -- path to the video to take the picture from
+        chunks -- raw samples of the preview's audio
+        final_result_path -- path to save the preview to
+        start, duration -- part of the video to take, in seconds
+        sample_rate, channels, chunk_format -- format of the raw samples
+    Returns nothing. Raises media.MediaError if it fails.
+
+    Always made with ffmpeg, since the video has to be scaled and encoded again, which the backends don't do.
+    """
+    video_stream = ffmpeg.input(str(video_path), ss=start, t=duration).video.filter('scale', -2, preview_height)
+    audio_stream = ffmpeg.input('pipe:', format=chunk_format, ar=sample_rate, ac=channels)
+    stream = ffmpeg.output(video_stream, audio_stream, str(final_result_path), vcodec='libx264', preset='veryfast',
+                           crf=preview_crf, **{'b:a': preview_audio_bitrate}).overwrite_output()
+    backends.FFmpegBackend().pipe_samples(stream, chunks)
+
+
+@trace.stage
+def generate_preview(video_path: Path, final_result_path: Path, video_info: dict, timestamps: plan.tl_type,
+                     start: float, end: float, strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3,
+                     texts: list[str] = None, samples: np.ndarray = None, video: bool = False, workers: int = None):
+    """Shuffle the dialogue and make a preview of part of the new video.
+
+    Args:
+        video_path -- path to the video
+        final_result_path -- path to save the preview to
+        video_info -- output of ffmpeg.probe for the video
+        timestamps -- list of tuple timestamps of dialogue, in seconds
+        start, end -- part of the new video to preview, in seconds
+        strategy, seed, jump_chance, texts -- passed on to the shuffle
+        samples -- decoded audio of the video from kingsquit.pcm.load_audio. taken from its cache if None and it's
+                   up to date, or else only the ranges the preview needs are decoded
+        video -- True to make a small video with mux_preview, False for just the audio
+        workers -- passed on to iter_window_audio
+    Returns nothing.
+    """
+    audio_info = media.get_audio_stream_info(video_info)
+    sample_rate = int(audio_info['sample_rate'])
+    channels = int(audio_info['channels'])
+
+    if samples is None:
+        samples = pcm.get_cached_audio(video_path, sample_rate, channels, pcm.get_sample_format(audio_info))
+    if samples is not None:
+        total = len(samples)
+        chunk_format = pcm.get_array_format(samples)
+    else:
+        total = round(float(video_info['format']['duration']) * sample_rate)
+        chunk_format = sample_format
+    ranges = plan.plan_shuffle(timestamps, sample_rate, total, strategy, seed, jump_chance, texts)
+    window_start = round(start * sample_rate)
+    window_end = min(round(end * sample_rate), total)
+    window = plan.cut_timeline(ranges, window_start, window_end)
+    print(f"Preview uses {len(window)} parts of the audio{', from the cache' if samples is not None else ''}")
+
+    chunks = iter_window_audio(video_path, window, sample_rate, channels, samples, workers)
+    if video:
+        mux_preview(video_path, chunks, final_result_path, window_start / sample_rate,
+                    (window_end - window_start) / sample_rate, sample_rate, channels, chunk_format)
+    else:
+        backends.get_backend().encode(chunks, final_result_path, sample_rate, channels, chunk_format)
@@ -0,0 +1,389 @@
+"""Daemon mode, for making new shuffles of videos on request without starting kingsquit again for each one.
+
+Every video the daemon is asked for is kept prepared: probed, with its timestamps loaded and normalised, and with the
+pcm renderer its decoded audio memory-mapped. So a new variant only has to plan the shuffle and mux, instead of
+importing everything, finding the timestamps and probing the video again first. A video is prepared again if it or
+its timestamps file changes.
+
+Requests are json over HTTP, on localhost or a Unix socket:
+
+    POST /shuffle {"video": "path/to/video.mp4", "seed": 123}
+
+returns {"paths": ["path/to/(SHUFFLED) video.mp4"], "seeds": [123]}. The request can also have subs, strategy,
+renderer, variants and output, like the command line options. With "preview": N or [START, END], only that part of
+each shuffle is made, as audio or with "preview_video": true a small video, see kingsquit.make_preview.
+GET /videos lists the videos that are prepared.
+Anyone who can connect can make the daemon read and write files as the user running it, so only serve it somewhere
+other people can't reach.
+"""
+
+import os
+import json
+import stat
+import errno
+import typing
+import threading
+import traceback
+import contextlib
+import socketserver
+import http.server
+from pathlib import Path
+
+import kingsquit
+import kingsquit.downloader
+import kingsquit.pcm
+import kingsquit.timestamps
+from kingsquit import media, plan
+
+
+default_address = '127.0.0.1:8765'
+# largest request body that's read, requests are only a few paths and numbers
+max_request_size = 1 << 16
+
+
+class RequestError(Exception):
+    """Error in a request, with the HTTP status to answer it with."""
+
+    def __init__(self, status: int, message: str):
+        """Save the status and message."""
+        super().__init__(message)
+        self.status = status
+
+
+class WarmVideo(typing.NamedTuple):
+    """A video that's kept prepared between requests."""
+
+    prepared: kingsquit.PreparedVideo
+    timestamps_path: Path
+    # sizes and modification times of the video and timestamps file when it was prepared, to tell if they've changed
+    stats: tuple
+    # decoded audio for the pcm renderer, None until a request needs it
+    samples: typing.Any = None
+
+
+def get_stats(*paths: Path) -> tuple:
+    """Get the sizes and modification times of some files, or None for any that don't exist."""
+    stats = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            stats.append(None)
+        else:
+            stats.append((stat.st_size, stat.st_mtime_ns))
+    return tuple(stats)
+
+
+def get_preview_window(preview) -> typing.Tuple[float, typing.Optional[float]]:
+    """Get the part of the video a request wants previewed.
+
+    Args:
+        preview -- N for the first N seconds, or [START, END] in seconds with an END of null for the end of the video
+    Returns a tuple of the start and end, see kingsquit.make_preview. Raises RequestError if it's not valid.
+    """
+    def is_number(value) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if is_number(preview):
+        return 0.0, preview
+    if isinstance(preview, list) and len(preview) == 2 and is_number(preview[0]) and (
+            preview[1] is None or is_number(preview[1])):
+        return preview[0], preview[1]
+    raise RequestError(400, 'preview must be a number of seconds, or [start, end]')
+
+
+class Shuffler:
+    """Class for the videos kept warm, and the options requests use when they don't give their own."""
+
+    def __init__(self, renderer: str = 'pcm', strategy: str = 'chunked', workers: int = None,
+                 min_cue: float = kingsquit.timestamps.default_min_cue,
+                 min_gap: float = kingsquit.timestamps.default_min_gap, max_scratch: int = None):
+        """Save the default options.
+
+        Args:
+            renderer, strategy, workers, max_scratch -- defaults passed on to kingsquit.make_variants
+            min_cue, min_gap -- passed on to kingsquit.prepare_video
+        """
+        self.renderer = renderer
+        self.strategy = strategy
+        self.workers = workers
+        self.min_cue = min_cue
+        self.min_gap = min_gap
+        self.max_scratch = max_scratch
+
+        self.videos: typing.Dict[tuple, WarmVideo] = {}
+        # one lock for each video, so a video is only prepared once however many requests for it come in at once
+        self.video_locks: typing.Dict[tuple, threading.Lock] = {}
+        # lock for each shuffle being made, and how many requests are holding or waiting for it, see render_lock
+        self.render_locks: typing.Dict[tuple, typing.List] = {}
+        self.lock = threading.Lock()
+
+    def get_video(self, video_path: Path, subtitle_path: typing.Optional[Path], renderer: str) -> WarmVideo:
+        """Get a video prepared, from the ones kept warm if it and its timestamps haven't changed.
+
+        Args:
+            video_path -- path to the video
+            subtitle_path -- subtitle or timestamps file to use, or None to find the one next to the video
+            renderer -- renderer it's for, the pcm renderer's decoded audio is only loaded when it's needed
+        Returns the prepared video. Raises RequestError if there's no video, or no usable dialogue.
+        """
+        key = (video_path.resolve(), subtitle_path.resolve() if subtitle_path else None)
+        with self.lock:
+            video_lock = self.video_locks.setdefault(key, threading.Lock())
+
+        with video_lock:
+            warm = self.videos.get(key)
+            if warm is None or get_stats(video_path, warm.timestamps_path) != warm.stats:
+                warm = self.prepare_video(video_path, subtitle_path)
+            if renderer == 'pcm' and warm.samples is None:
+                audio_info = media.get_audio_stream_info(warm.prepared.video_info)
+                samples = kingsquit.pcm.load_audio(video_path, int(audio_info['sample_rate']),
+                                                   int(audio_info['channels']),
+                                                   kingsquit.pcm.get_sample_format(audio_info))
+                warm = warm._replace(samples=samples)
+            self.videos[key] = warm
+        return warm
+
+    @contextlib.contextmanager
+    def render_lock(self, video_path: Path, renderer: typing.Optional[str], seeds: typing.Iterable[int]):
+        """Hold the locks for making some seeds of a video, until the with block ends.
+
+        Two requests for the same shuffle at once would both write the same file, so the second waits for the first,
+        and then gets the video it made back from the journal. The clips renderer makes every seed in the same
+        folders, so it has one lock for the whole video. Previews have their own locks, with a renderer of None.
+        """
+        video_path = video_path.resolve()
+        if renderer == 'clips':
+            keys = [(video_path, renderer, None)]
+        else:
+            keys = [(video_path, renderer, seed) for seed in sorted(seeds)]
+        with self.lock:
+            entries = [self.render_locks.setdefault(key, [threading.Lock(), 0]) for key in keys]
+            for entry in entries:
+                entry[1] += 1
+        try:
+            with contextlib.ExitStack() as stack:
+                # always taken in order of seed, so requests with overlapping seeds can't each wait for the other
+                for lock, _ in entries:
+                    stack.enter_context(lock)
+                yield
+        finally:
+            with self.lock:
+                for key, entry in zip(keys, entries):
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self.render_locks[key]
+
+    def prepare_video(self, video_path: Path, subtitle_path: typing.Optional[Path]) -> WarmVideo:
+        """Find a video's timestamps and prepare it, like a normal run does.
+
+        Raises RequestError if there's no video, or no usable dialogue.
+        """
+        if not video_path.is_file():
+            raise RequestError(404, f"Video doesn't exist: {video_path}")
+        if subtitle_path:
+            timestamps_path = kingsquit.get_timestamps_path(subtitle_path)
+        else:
+            timestamps_path = kingsquit.downloader.find_timestamps(video_path)
+        if not timestamps_path:
+            raise RequestError(422, 'No usable subtitles, timestamps file or dialogue')
+
+        stats = get_stats(video_path, timestamps_path)
+        prepared = kingsquit.prepare_video(video_path, timestamps_path, self.min_cue, self.min_gap)
+        if prepared is None:
+            raise RequestError(422, 'Invalid video or timestamps')
+        return WarmVideo(prepared, timestamps_path, stats)
+
+    def shuffle(self, request: dict) -> dict:
+        """Make new shuffles of a video for a request.
+
+        Args:
+            request -- the request's json, see the module docstring
+        Returns the json to answer with. Raises RequestError if the request is wrong, or the video can't be used.
+        """
+        video = request.get('video')
+        if not isinstance(video, str):
+            raise RequestError(400, 'video must be the path of a video')
+        subs = request.get('subs')
+        output = request.get('output')
+        renderer = request.get('renderer', self.renderer)
+        strategy = request.get('strategy', self.strategy)
+        seed = request.get('seed')
+        variants = request.get('variants', 1)
+        if subs is not None and not isinstance(subs, str) or output is not None and not isinstance(output, str):
+            raise RequestError(400, 'subs and output must be paths')
+        if renderer not in kingsquit.renderer_names:
+            raise RequestError(400, f"renderer must be one of {', '.join(kingsquit.renderer_names)}")
+        if strategy not in plan.shuffle_strategies:
+            raise RequestError(400, f"strategy must be one of {', '.join(plan.shuffle_strategies)}")
+        if seed is not None and type(seed) is not int:
+            raise RequestError(400, 'seed must be a whole number')
+        if type(variants) is not int or variants < 1:
+            raise RequestError(400, 'variants must be a whole number, 1 or more')
+        preview = request.get('preview')
+        preview_window = get_preview_window(preview) if preview is not None else None
+
+        warm = self.get_video(Path(video), Path(subs) if subs else None, renderer)
+        if seed is None:
+            seed = plan.new_seed()
+        output_path = Path(output) if output else None
+        seeds = range(seed, seed + variants)
+        if preview_window:
+            with self.render_lock(warm.prepared.video_path, None, seeds):
+                paths = self.make_previews(warm, preview_window, strategy, seed, variants, output_path,
+                                           bool(request.get('preview_video')))
+        else:
+            with self.render_lock(warm.prepared.video_path, renderer, seeds):
+                paths = kingsquit.make_variants(warm.prepared, renderer, strategy, seed, variants, self.workers,
+                                                output_path, self.max_scratch, warm.samples)
+        # resolved, because a video made by an earlier request comes back from the journal as an absolute path
+        return {'paths': [str(p.resolve()) for p in paths], 'seeds': list(seeds)}
+
+    def make_previews(self, warm: WarmVideo, preview_window: tuple, strategy: str, seed: int, variants: int,
+                      output_path: typing.Optional[Path], video: bool) -> typing.List[Path]:
+        """Make a preview of each variant of a shuffle, named like make_variants names the variants.
+
+        Returns the paths of the previews. Raises RequestError if the part to preview isn't in the video.
+        """
+        paths = []
+        for n in range(1, variants + 1):
+            path = output_path
+            if output_path and variants > 1:
+                path = output_path.with_stem(f'{output_path.stem}-{n}')
+            try:
+                paths.append(kingsquit.make_preview(warm.prepared, *preview_window, strategy, seed + n - 1, path,
+                                                    video, self.workers, warm.samples))
+            except ValueError as err:
+                raise RequestError(422, str(err)) from err
+        return paths
+
+    def describe_videos(self) -> dict:
+        """Get the json listing the videos that are kept warm."""
+        with self.lock:
+            videos = list(self.videos.values())
+        return {'videos': [{'video': str(v.prepared.video_path), 'timestamps': str(v.timestamps_path),
+                            'duration': v.prepared.duration, 'dialogue': len(v.prepared.timestamps),
+                            'decoded_audio': v.samples is not None}
+                           for v in videos]}
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    """Class for answering one HTTP request, with the server's Shuffler."""
+
+    server_version = f'kingsquit/{kingsquit.__version__}'
+
+    def send_json(self, status: int, body: dict):
+        """Send a json response."""
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """List the videos that are kept warm."""
+        if self.path != '/videos':
+            self.send_json(404, {'error': 'Not found, use GET /videos or POST /shuffle'})
+            return
+        self.send_json(200, self.server.shuffler.describe_videos())
+
+    def do_POST(self):
+        """Make new shuffles of a video."""
+        try:
+            if self.path != '/shuffle':
+                raise RequestError(404, 'Not found, use GET /videos or POST /shuffle')
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > max_request_size:
+                raise RequestError(413, 'Request too big')
+            try:
+                request = json.loads(self.rfile.read(length))
+            except json.JSONDecodeError as err:
+                raise RequestError(400, f'Request is not valid json: {err}') from err
+            if not isinstance(request, dict):
+                raise RequestError(400, 'Request must be a json object')
+            self.send_json(200, self.server.shuffler.shuffle(request))
+        except RequestError as err:
+            self.send_json(err.status, {'error': str(err)})
+        except media.MediaError as err:
+            self.send_json(500, {'error': str(err)})
+        except Exception:
+            self.send_json(500, {'error': traceback.format_exc().strip().splitlines()[-1]})
+
+    def address_string(self) -> str:
+        """Get the client's address for the log, which Unix sockets don't have."""
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return str(self.client_address[0])
+        return 'unix'
+
+
+class TCPServer(http.server.ThreadingHTTPServer):
+    """HTTP server on a TCP port, answering each request in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, address: tuple, shuffler: Shuffler):
+        """Start listening, and save the Shuffler for the request handlers."""
+        self.shuffler = shuffler
+        super().__init__(address, RequestHandler)
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket, answering each request in its own thread."""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, shuffler: Shuffler):
+        """Start listening, replacing a socket file left by a daemon that stopped before, and save the Shuffler for
+        the request handlers.
+
+        Raises FileExistsError if there's already something at the path that isn't a socket, like a file given as the
+        address by mistake, so it's never deleted.
+        """
+        self.shuffler = shuffler
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise FileExistsError(errno.EEXIST, "There's already a file there that isn't a socket", path)
+            os.unlink(path)
+        super().__init__(path, RequestHandler)
+
+
+def parse_address(address: str) -> typing.Tuple[bool, typing.Any]:
+    """Parse a socket address given by the user.
+
+    Args:
+        address -- unix:PATH, or anything with a slash in it, for a Unix socket. HOST:PORT, :PORT or PORT for TCP,
+                   with HOST 127.0.0.1 if it isn't given
+    Returns a tuple of whether it's a Unix socket, and the path or (host, port) tuple. Raises ValueError if the port
+    isn't a number.
+    """
+    if address.startswith('unix:'):
+        return True, address[len('unix:'):]
+    if '/' in address or os.sep in address:
+        return True, address
+    host, _, port = address.rpartition(':')
+    return False, (host or '127.0.0.1', int(port))
+
+
+def run_server(address: str = default_address, shuffler: Shuffler = None):
+    """Answer requests until stopped with ctrl+c.
+
+    Args:
+        address -- where to listen, see parse_address
+        shuffler -- the videos and default options to use, a new Shuffler with the pcm renderer if None
+    Returns nothing. Raises ValueError if the address is invalid, or OSError if it can't be listened on.
+    """
+    shuffler = shuffler or Shuffler()
+    is_unix, parsed_address = parse_address(address)
+    server = UnixServer(parsed_address, shuffler) if is_unix else TCPServer(parsed_address, shuffler)
+    print(f'Serving on {address}, stop with ctrl+c')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('Stopping')
+    finally:
+        server.server_close()
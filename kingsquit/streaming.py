@@ -0,0 +1,323 @@
+"""Renderer that streams reformed clips into the final mux as soon as they're ready, instead of in separate stages.
+
+Clips are ripped as raw samples when the first reformed clip that needs them is made, reformed clips are cut from
+them at exact sample offsets, and each one is handed to the muxing ffmpeg through a bounded queue in timeline order.
+Ripping, reforming and muxing all overlap, and only a limited number of reformed clips wait in memory at once.
+Gaps between dialogue are decoded in pieces of at most gap_piece_length, so a long gap never waits in memory whole.
+A line of dialogue that's said more than once is only reformed once, and kept in memory until its last use.
+
+The ripped clips are the only scratch files. Each one is deleted as soon as it's been read for the last time, and
+with a limit on scratch space, clips that aren't being read are deleted early to make room, and ripped again if
+they're needed later. So a multi-hour video never needs more scratch space than the limit, or its longest line of
+dialogue if that's bigger. The audio-only copy of the video that clips are ripped from is kept between runs like the
+other renderers' caches, and isn't counted in the limit.
+"""
+
+import queue
+import collections
+import shutil
+import threading
+import typing
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future
+
+import kingsquit
+import kingsquit.demux
+from kingsquit import plan, media, trace, backends
+
+
+sample_format = 's16le'
+sample_width = 2
+# reformed clips that can be waiting to be muxed at once
+default_queue_size = 64
+# longest piece of a gap between dialogue that's decoded at once, in seconds. with a full queue of them, this is about
+# 60MB of 48kHz stereo audio waiting in memory
+gap_piece_length = 5.0
+
+
+def rip_raw_clip(video_path: Path, t: plan.t_type, sample_rate: int, channels: int, out_path: Path) -> Path:
+    """Rip a timestamp in samples from a video to a raw sample file with the media backend, and return its path."""
+    data = backends.get_backend().decode_range(video_path, t[0], t[1], sample_rate, channels, sample_format)
+    out_path.write_bytes(data)
+    return out_path
+
+
+def read_samples(path: Path, start: int, end: int, channels: int) -> bytes:
+    """Read a range of samples from a raw sample file, padding with silence if the file is too short."""
+    frame_size = sample_width * channels
+    with open(path, 'rb') as raw_file:
+        raw_file.seek(start * frame_size)
+        data = raw_file.read((end - start) * frame_size)
+    return data.ljust((end - start) * frame_size, b'\0')
+
+
+class StreamingRenderer:
+    """Class for storing the state shared by the jobs of one streamed render."""
+
+    def __init__(self, video_path: Path, scratch_folder: Path, sample_rate: int, channels: int,
+                 timestamps: plan.tl_type, workers: int = None, source_path: Path = None,
+                 keys: typing.List[typing.Optional[str]] = None, max_scratch: int = None):
+        """Save the settings to the instance and make the scratch folder.
+
+        Args:
+            video_path -- path to the video to rip clips from, and take the video stream from
+            scratch_folder -- folder for the ripped clips, deleted after rendering
+            sample_rate -- sample rate to rip at
+            channels -- number of channels to rip
+            timestamps -- list of tuple timestamps of dialogue, in samples
+            workers -- number of clips to rip at once, the ThreadPoolExecutor default if None
+            source_path -- file to rip the clips from instead of the video, like its audio-only copy
+            keys -- dialogue key of each timestamp, see kingsquit.plan.get_dialogue_key. None if unknown
+            max_scratch -- most bytes of ripped clips to keep on disk at once, no limit if None
+        """
+        self.video_path = video_path
+        self.source_path = source_path or video_path
+        self.scratch_folder = scratch_folder
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.timestamps = timestamps
+        self.workers = workers
+        self.keys = keys if keys is not None else [None] * len(timestamps)
+
+        self.max_scratch = max_scratch
+        # ripped dialogue clips on disk, and the size of each one
+        self.source_clips: typing.Dict[int, Future] = {}
+        self.source_sizes: typing.Dict[int, int] = {}
+        # jobs reading each clip right now, which can't be deleted until they're done
+        self.source_readers = collections.Counter()
+        # reads of each clip still to come, it's deleted after the last one
+        self.source_uses = collections.Counter()
+        self.scratch_used = 0
+        self.peak_scratch = 0
+        self.source_clips_condition = threading.Condition()
+        # replacements used more than once, and how many uses each has left
+        self.replacements: typing.Dict[int, Future] = {}
+        self.replacement_uses: typing.Dict[int, int] = {}
+        self.replacements_lock = threading.Lock()
+        self.rip_threads = None
+
+        self.scratch_folder.mkdir(parents=True, exist_ok=True)
+
+    def open_source_clip(self, index: int) -> Future:
+        """Get the future of the raw clip of a dialogue timestamp for reading, ripping it if it isn't on disk.
+
+        The clip can't be deleted until it's closed with close_source_clip.
+        """
+        with self.source_clips_condition:
+            future = self.source_clips.get(index)
+            t = self.timestamps[index]
+            size = (t[1] - t[0]) * sample_width * self.channels
+            if future is None:
+                self.make_room(size)
+                # another job might have ripped it while this one was waiting for room
+                future = self.source_clips.get(index)
+            if future is None:
+                out_path = self.scratch_folder / f'{index}.raw'
+                future = self.rip_threads.submit(rip_raw_clip, self.source_path, t, self.sample_rate, self.channels,
+                                                 out_path)
+                self.source_clips[index] = future
+                self.source_sizes[index] = size
+                self.scratch_used += size
+                self.peak_scratch = max(self.peak_scratch, self.scratch_used)
+                trace.counter('scratch', bytes=self.scratch_used)
+            self.source_readers[index] += 1
+        return future
+
+    def close_source_clip(self, index: int):
+        """Finish reading a raw clip, deleting it if that was its last use."""
+        with self.source_clips_condition:
+            self.source_readers[index] -= 1
+            self.source_uses[index] -= 1
+            if self.source_uses[index] <= 0 and index in self.source_clips:
+                self.delete_source_clip(index)
+            self.source_clips_condition.notify_all()
+
+    def delete_source_clip(self, index: int):
+        """Delete a raw clip from disk. Only call while holding source_clips_condition."""
+        del self.source_clips[index]
+        self.scratch_used -= self.source_sizes.pop(index)
+        (self.scratch_folder / f'{index}.raw').unlink(missing_ok=True)
+        trace.counter('scratch', bytes=self.scratch_used)
+
+    def make_room(self, size: int):
+        """Wait until a new clip fits in the scratch space limit, deleting clips that aren't being read to make room.
+
+        Clips are deleted in the order they were ripped. If every clip on disk is being read, this waits for them to
+        be closed. A clip bigger than the limit is let through once nothing else is on disk, so it never waits
+        forever. Only call while holding source_clips_condition.
+        """
+        if self.max_scratch is None:
+            return
+        while self.scratch_used and self.scratch_used + size > self.max_scratch:
+            unread = next((i for i, future in self.source_clips.items()
+                           if not self.source_readers[i] and future.done()), None)
+            if unread is None:
+                self.source_clips_condition.wait()
+            else:
+                self.delete_source_clip(unread)
+
+    def read_source_clip(self, index: int, start: int, end: int) -> bytes:
+        """Read a range of samples from the raw clip of a dialogue timestamp, waiting for it to be ripped."""
+        future = self.open_source_clip(index)
+        try:
+            return read_samples(future.result(), start, end, self.channels)
+        finally:
+            self.close_source_clip(index)
+
+    def make_dialogue(self, components: typing.List[typing.Tuple[int, int, int]]) -> bytes:
+        """Make the samples of one reformed clip from components of the ripped dialogue clips.
+
+        Args:
+            components -- list of tuples of dialogue timestamp index, start and end offsets in samples
+        Returns the raw samples.
+        """
+        return b''.join(self.read_source_clip(index, start, end) for index, start, end in components)
+
+    def get_replacement(self, number: int, components: typing.List[typing.Tuple[int, int, int]], length: int) -> bytes:
+        """Get the start of a replacement that's used more than once, making it the first time it's needed.
+
+        Args:
+            number -- number of the replacement, see kingsquit.plan.plan_memoised_reform
+            components -- components of the whole replacement
+            length -- number of samples to take from the start of it
+        Returns the raw samples.
+        """
+        with self.replacements_lock:
+            future = self.replacements.get(number)
+            first_use = future is None
+            if first_use:
+                future = self.replacements[number] = Future()
+            self.replacement_uses[number] -= 1
+            if not self.replacement_uses[number]:
+                # jobs that still need it already have the future
+                del self.replacements[number]
+        if first_use:
+            try:
+                future.set_result(self.make_dialogue(components))
+            except BaseException as err:
+                future.set_exception(err)
+        return future.result()[:length * sample_width * self.channels]
+
+    def make_gap(self, t: plan.t_type) -> bytes:
+        """Rip the samples of a piece of a gap between dialogue, which is kept as it is."""
+        return backends.get_backend().decode_range(self.source_path, t[0], t[1], self.sample_rate, self.channels,
+                                                   sample_format)
+
+    def plan_jobs(self, shuffled_indices: typing.List[int], total: int) -> typing.Iterator[typing.Callable]:
+        """Get a job for every piece of the new audio track, in timeline order. Each job returns raw samples."""
+        durations = [self.timestamps[i][1] - self.timestamps[i][0] for i in shuffled_indices]
+        targets = [t[1] - t[0] for t in self.timestamps]
+        reform_plan, replacement_numbers = plan.plan_memoised_reform(durations, targets, self.keys)
+        owners = plan.get_replacement_owners(targets, replacement_numbers)
+        self.replacement_uses = collections.Counter(replacement_numbers)
+        # a replacement used more than once is only made the first time, so its clips are only read once
+        self.source_uses = collections.Counter(shuffled_indices[i] for number in set(replacement_numbers)
+                                               for i, _, _ in reform_plan[owners[number]])
+
+        cursor = 0
+        for t, components, number in zip(self.timestamps, reform_plan, replacement_numbers):
+            yield from self.plan_gap_jobs(cursor, t[0])
+            if self.replacement_uses[number] == 1:
+                source_components = [(shuffled_indices[i], start, end) for i, start, end in components]
+                yield lambda source_components=source_components: self.make_dialogue(source_components)
+            else:
+                source_components = [(shuffled_indices[i], start, end) for i, start, end in reform_plan[owners[number]]]
+                yield lambda number=number, source_components=source_components, length=t[1] - t[0]: \
+                    self.get_replacement(number, source_components, length)
+            cursor = t[1]
+        yield from self.plan_gap_jobs(cursor, total)
+
+    def plan_gap_jobs(self, start: int, end: int) -> typing.Iterator[typing.Callable]:
+        """Get a job for each piece of a gap between dialogue, at most gap_piece_length long, or none if it's empty."""
+        piece_length = round(gap_piece_length * self.sample_rate)
+        for piece_start in range(start, end, piece_length):
+            gap = (piece_start, min(piece_start + piece_length, end))
+            yield lambda gap=gap: self.make_gap(gap)
+
+    @trace.stage
+    def render(self, final_result_path: Path, shuffled_indices: typing.List[int], total: int,
+               queue_size: int = default_queue_size):
+        """Make the new video, streaming each reformed clip into ffmpeg as soon as it and those before it are ready.
+
+        Args:
+            final_result_path -- path to save the new video to
+            shuffled_indices -- indices of the dialogue timestamps, shuffled
+            total -- length of the whole audio track, in samples
+            queue_size -- most reformed clips that can be waiting to be muxed at once
+        Returns nothing. Raises the error if any job fails, or media.MediaError if muxing fails.
+        """
+        jobs = list(self.plan_jobs(shuffled_indices, total))
+        progress_bar = kingsquit.ProgressBarRunner(len(jobs))
+        job_queue = queue.Queue(queue_size)
+        stop = threading.Event()
+
+        queue_finished = threading.Event()
+
+        def produce(reform_threads: ThreadPoolExecutor):
+            for job in jobs:
+                if stop.is_set():
+                    break
+                job_queue.put(reform_threads.submit(job))
+            job_queue.put(None)
+
+        def consume() -> typing.Iterator[bytes]:
+            while (future := job_queue.get()) is not None:
+                yield future.result()
+                progress_bar.progress()
+            queue_finished.set()
+
+        backend = backends.get_backend()
+        with ThreadPoolExecutor(self.workers) as self.rip_threads, ThreadPoolExecutor(self.workers) as reform_threads:
+            producer = threading.Thread(target=produce, args=(reform_threads,), daemon=True)
+            producer.start()
+            try:
+                backend.mux(self.video_path, consume(), final_result_path, self.sample_rate, self.channels,
+                            sample_format)
+            except BaseException:
+                stop.set()
+                # empty the queue so the producer isn't stuck waiting to put more in
+                if not queue_finished.is_set():
+                    while (future := job_queue.get()) is not None:
+                        future.cancel()
+                raise
+            finally:
+                producer.join()
+        backend.close()
+
+
+@trace.stage
+def generate_new_video(video_path: Path, final_result_path: Path, video_info: dict, timestamps: plan.tl_type,
+                       strategy: str = 'chunked', seed: int = None, jump_chance: float = 0.3, workers: int = None,
+                       texts: typing.List[str] = None, max_scratch: int = None):
+    """Shuffle the dialogue and make the new video, streaming clips from ripping through to muxing.
+
+    Args:
+        video_path -- path to the video
+        final_result_path -- path to save the new video to
+        video_info -- output of ffmpeg.probe for the video
+        timestamps -- list of tuple timestamps of dialogue, in seconds
+        strategy, seed, jump_chance -- passed on to the shuffle
+        workers -- number of clips to rip or reform at once
+        texts -- text of each timestamp, so the same lines get the same replacement. None if unknown
+        max_scratch -- most bytes of ripped clips to keep on disk at once, no limit if None. the audio-only copy of the
+                       video from kingsquit.demux isn't counted
+    Returns nothing.
+    """
+    audio_info = media.get_audio_stream_info(video_info)
+    sample_rate = int(audio_info['sample_rate'])
+    channels = int(audio_info['channels'])
+    total = round(float(video_info['format']['duration']) * sample_rate)
+
+    sample_timestamps = plan.timestamps_to_samples(timestamps, sample_rate)
+    durations = [t[1] - t[0] for t in sample_timestamps]
+    # shuffling the indices gives the same order as shuffling the timestamps does in the other renderers
+    shuffled_indices = plan.shuffle_items(list(range(len(sample_timestamps))), strategy, seed, jump_chance, durations)
+
+    scratch_folder = video_path.with_suffix('') / f'streaming-{seed}'
+    source_path = kingsquit.demux.demux_audio(video_path)
+    renderer = StreamingRenderer(video_path, scratch_folder, sample_rate, channels, sample_timestamps, workers,
+                                 source_path, plan.get_dialogue_keys(texts, len(timestamps)), max_scratch)
+    try:
+        renderer.render(final_result_path, shuffled_indices, total)
+    finally:
+        shutil.rmtree(scratch_folder, ignore_errors=True)
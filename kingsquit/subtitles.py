@@ -0,0 +1,213 @@
+"""Fast parsers that get the timing and text of each cue from TTML, WebVTT and SRT subtitles.
+
+They read the file a bit at a time and never build a model of the whole file, so even subtitles with tens of thousands
+of cues are quick and use little memory.
+"""
+
+import re
+import json
+import typing
+from pathlib import Path
+from xml.etree import ElementTree
+
+from kingsquit.atomic import replace_when_done
+
+
+# start and end time, and the text of the cue
+cue_type = typing.Tuple[float, float, str]
+
+ttml_clock_time_pattern = re.compile(r'^(\d+):(\d{2}):(\d{2}(?:\.\d+)?)(?::(\d+(?:\.\d+)?))?$')
+ttml_offset_time_pattern = re.compile(r'^(\d+(?:\.\d+)?)(h|ms|m|s|f|t)$')
+# matches the HH:MM:SS.mmm or MM:SS.mmm times of WebVTT, and the HH:MM:SS,mmm times of SRT
+cue_time_pattern = re.compile(r'(?:(\d+):)?(\d{1,2}):(\d{2})[.,](\d{1,3})')
+ttp_namespace = '{http://www.w3.org/ns/ttml#parameter}'
+
+
+def local_name(tag: str) -> str:
+    """Get an XML tag name without its namespace."""
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_ttml_time(time_expression: str, frame_rate: float, tick_rate: float) -> float:
+    """Convert a TTML time expression to seconds.
+
+    Args:
+        time_expression -- clock time like 00:00:01.500 or 00:00:01:12, or offset time like 1.5s, 1500ms or 15000000t
+        frame_rate -- frames per second, for times in frames
+        tick_rate -- ticks per second, for times in ticks
+    Returns the time in seconds. Raises ValueError if the expression isn't valid.
+    """
+    time_expression = time_expression.strip()
+    match = ttml_clock_time_pattern.match(time_expression)
+    if match:
+        hours, minutes, seconds, frames = match.groups()
+        time = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        if frames:
+            time += float(frames) / frame_rate
+        return time
+
+    match = ttml_offset_time_pattern.match(time_expression)
+    if match:
+        count, metric = float(match.group(1)), match.group(2)
+        return {
+            'h': lambda: count * 3600,
+            'm': lambda: count * 60,
+            's': lambda: count,
+            'ms': lambda: count / 1000,
+            'f': lambda: count / frame_rate,
+            't': lambda: count / tick_rate,
+        }[metric]()
+
+    raise ValueError(f'Invalid TTML time expression: {time_expression}')
+
+
+def parse_frame_rate_multiplier(multiplier: typing.Optional[str]) -> float:
+    """Convert a TTML frame rate multiplier like '1000 1001' to a number."""
+    if not multiplier:
+        return 1.0
+    numerator, denominator = multiplier.split()
+    return int(numerator) / int(denominator)
+
+
+def get_cue_text(lines: typing.Iterable[str]) -> str:
+    """Join the lines of a cue's text into one line."""
+    return ' '.join(' '.join(lines).split())
+
+
+def parse_ttml(path: Path) -> typing.Iterator[cue_type]:
+    """Get the start and end time and text of each paragraph in a TTML file, parsing it incrementally.
+
+    Begin times of the body and divs are added on, for files that use them as time containers.
+    """
+    frame_rate = 30.0
+    tick_rate = 1.0
+    offsets = [0.0]
+    parents = []
+
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        name = local_name(elem.tag)
+        if event == 'start':
+            parents.append(elem)
+            if name == 'tt':
+                frame_rate = float(elem.get(f'{ttp_namespace}frameRate', frame_rate))
+                frame_rate *= parse_frame_rate_multiplier(elem.get(f'{ttp_namespace}frameRateMultiplier'))
+                # the tick rate defaults to the frame rate if that's given
+                default_tick_rate = frame_rate if elem.get(f'{ttp_namespace}frameRate') else tick_rate
+                tick_rate = float(elem.get(f'{ttp_namespace}tickRate', default_tick_rate))
+            elif name in ('body', 'div'):
+                begin = elem.get('begin')
+                offset = parse_ttml_time(begin, frame_rate, tick_rate) if begin else 0.0
+                offsets.append(offsets[-1] + offset)
+            continue
+
+        parents.pop()
+        if name == 'p':
+            begin, end, dur = elem.get('begin'), elem.get('end'), elem.get('dur')
+            if begin is not None and (end is not None or dur is not None):
+                start = offsets[-1] + parse_ttml_time(begin, frame_rate, tick_rate)
+                text = get_cue_text(elem.itertext())
+                if end is not None:
+                    yield start, offsets[-1] + parse_ttml_time(end, frame_rate, tick_rate), text
+                else:
+                    yield start, start + parse_ttml_time(dur, frame_rate, tick_rate), text
+            # the paragraph isn't needed any more, so free it
+            if parents:
+                parents[-1].remove(elem)
+        elif name in ('body', 'div'):
+            offsets.pop()
+
+
+def parse_cue_time(match: re.Match) -> float:
+    """Convert a matched WebVTT or SRT time to seconds."""
+    hours, minutes, seconds, milliseconds = match.groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(milliseconds.ljust(3, '0')) / 1000
+
+
+def parse_cues(path: Path) -> typing.Iterator[cue_type]:
+    """Get the start and end time and text of each cue in a WebVTT or SRT file, one line at a time.
+
+    Both formats mark the timing of each cue with a line like 'start --> end', followed by its text up to a blank
+    line, so they can share a parser.
+    """
+    cue = None
+    text_lines = []
+    with open(path, encoding='utf-8-sig', errors='replace') as sub_file:
+        for line in sub_file:
+            line = line.strip()
+            if '-->' in line:
+                if cue:
+                    # no blank line before this cue, so the last line was probably its srt number
+                    if text_lines and text_lines[-1].isdigit():
+                        text_lines.pop()
+                    yield (*cue, get_cue_text(text_lines))
+                start_text, end_text = line.split('-->', 1)
+                start_match = cue_time_pattern.search(start_text)
+                end_match = cue_time_pattern.search(end_text)
+                cue = (parse_cue_time(start_match), parse_cue_time(end_match)) if start_match and end_match else None
+                text_lines = []
+            elif not line:
+                if cue:
+                    yield (*cue, get_cue_text(text_lines))
+                cue = None
+            elif cue:
+                text_lines.append(line)
+    if cue:
+        yield (*cue, get_cue_text(text_lines))
+
+
+def detect_format(path: Path) -> typing.Optional[str]:
+    """Guess the format of a subtitle file from its extension, or from its first few bytes if that doesn't work.
+
+    Returns 'ttml', 'vtt', 'srt' or None.
+    """
+    suffix = path.suffix.casefold()
+    if suffix in ('.ttml', '.dfxp', '.xml'):
+        return 'ttml'
+    if suffix in ('.vtt', '.srt'):
+        return suffix[1:]
+
+    with open(path, 'rb') as sub_file:
+        start = sub_file.read(1024).lstrip(b'\xef\xbb\xbf \t\r\n')
+    if start.startswith(b'WEBVTT'):
+        return 'vtt'
+    if start.startswith(b'<'):
+        return 'ttml'
+    if b'-->' in start:
+        return 'srt'
+    return None
+
+
+parsers = {
+    'ttml': parse_ttml,
+    'vtt': parse_cues,
+    'srt': parse_cues,
+}
+
+
+def iter_timestamps(path: Path) -> typing.Optional[typing.Iterator[cue_type]]:
+    """Get an iterator of start and end times and text for the cues in any supported subtitle file, or None if
+    unsupported.
+    """
+    sub_format = detect_format(path)
+    if sub_format is None:
+        return None
+    return parsers[sub_format](path)
+
+
+def write_timestamps(timestamps: typing.Iterable[cue_type], timestamps_path: Path) -> int:
+    """Write timestamps and their text to a compact json file as they come, without holding them all in memory.
+
+    Each cue is saved as [start, end, text], and the file only replaces the old one once it's all written. Returns
+    the number of timestamps written.
+    """
+    count = 0
+    with replace_when_done(timestamps_path) as partial_path, open(partial_path, 'w') as timestamps_file:
+        timestamps_file.write('[')
+        for start, end, text in timestamps:
+            if count:
+                timestamps_file.write(',')
+            # rounded to get rid of float error like 0.30000000000000004
+            timestamps_file.write(f'[{round(start, 6)!r},{round(end, 6)!r},{json.dumps(text)}]')
+            count += 1
+        timestamps_file.write(']')
+    return count
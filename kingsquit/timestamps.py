@@ -0,0 +1,159 @@
+"""Normalising dialogue timestamps from subtitles before they're used, so they're valid and there aren't too many.
+
+Subtitles, especially auto-generated ones, often have cues that overlap, run past the end of the video, or are tiny
+rolling fragments a few frames apart. Every cue and every gap between cues becomes a clip, so joining them up cuts
+the number of clips and ffmpeg runs a lot, and avoids clips too short for ffmpeg to cut. The text of cues that are
+joined is joined too, in order. Cues that are exactly the same are only kept once.
+"""
+
+import typing
+
+from kingsquit.plan import tl_type
+
+# numpy is imported where it's used, so importing kingsquit for its defaults doesn't import numpy
+if typing.TYPE_CHECKING:
+    import numpy as np
+
+
+default_min_cue = 0.25
+default_min_gap = 0.1
+# furthest a short cue is joined onto its neighbour from. one further away than this is padded out instead
+default_max_join = 0.5
+
+
+def join_texts(texts: typing.Sequence[str]) -> str:
+    """Join the text of cues that are joined, leaving out empty ones."""
+    return ' '.join(text for text in texts if text)
+
+
+def merge_groups(starts: 'np.ndarray', ends: 'np.ndarray', texts: typing.List[str],
+                 separate: 'np.ndarray') -> typing.Tuple['np.ndarray', 'np.ndarray', typing.List[str]]:
+    """Join neighbouring cues into one wherever they aren't marked as separate.
+
+    Args:
+        starts, ends -- start and end times of the cues, sorted by start
+        texts -- text of the cues
+        separate -- for each pair of neighbouring cues, whether they stay separate
+    Returns the new start and end times, and text.
+    """
+    import numpy as np
+    group_starts = np.concatenate(([0], np.flatnonzero(separate) + 1))
+    group_ends = np.append(group_starts[1:], len(starts))
+    if len(group_starts) < len(starts):
+        texts = [join_texts(texts[start:end]) for start, end in zip(group_starts.tolist(), group_ends.tolist())]
+    return starts[group_starts], np.maximum.reduceat(ends, group_starts), texts
+
+
+def split_cues(cues: typing.Sequence[typing.Sequence]) -> typing.Tuple[tl_type, typing.List[str]]:
+    """Split cues from a timestamps file into their timestamps and their text.
+
+    Cues can be [start, end, text], or [start, end] from files made before the text was kept, which get empty text.
+    """
+    timestamps = [(cue[0], cue[1]) for cue in cues]
+    texts = [cue[2] if len(cue) > 2 else '' for cue in cues]
+    return timestamps, texts
+
+
+def pad_cues(starts: 'np.ndarray', ends: 'np.ndarray', pad: 'np.ndarray', min_cue: float, min_gap: float,
+             duration: float):
+    """Pad some cues out towards min_cue long, in place, without closing the gaps either side below min_gap.
+
+    Args:
+        starts, ends -- start and end times of the cues, sorted and not overlapping
+        pad -- whether each cue is padded
+        min_cue, min_gap, duration -- see normalise_timestamps
+    A padded cue is made longer on both sides equally, or more on one side if the other is tight. Two padded cues
+    next to each other share the gap between them, so it's never shorter than min_gap afterwards.
+    """
+    import numpy as np
+    gaps = starts[1:] - ends[:-1]
+    room_before = np.concatenate(([starts[0]], (gaps - min_gap) / 2))[pad]
+    room_after = np.concatenate(((gaps - min_gap) / 2, [duration - ends[-1]]))[pad]
+    need = min_cue - (ends[pad] - starts[pad])
+    pad_after = np.clip(need / 2, 0.0, room_after)
+    pad_before = np.clip(need - pad_after, 0.0, room_before)
+    pad_after = np.clip(need - pad_before, 0.0, room_after)
+    starts[pad] -= pad_before
+    ends[pad] += pad_after
+
+
+def normalise_timestamps(cues: typing.Sequence[typing.Sequence], duration: float, min_cue: float = default_min_cue,
+                         min_gap: float = default_min_gap,
+                         max_join: float = default_max_join) -> typing.Tuple[tl_type, typing.List[str], dict]:
+    """Clamp, sort, dedupe and join up dialogue timestamps.
+
+    Args:
+        cues -- list of cues of dialogue, as start and end in seconds, and optionally text, see split_cues
+        duration -- length of the video, no timestamp can go past this
+        min_cue -- cues shorter than this are joined onto the nearest neighbouring cue if it's close, or else padded
+                   out to this long, or as near as they can be
+        min_gap -- gaps shorter than this are closed by joining the cues either side, and gaps this short at the
+                   start and end of the video are closed too
+        max_join -- a short cue is only joined onto a neighbour that's at most this far away
+    Returns a tuple of the new list of timestamps, the text of each, and a dict counting what was changed.
+    """
+    import numpy as np
+    report = {'input': len(cues)}
+    timestamps, texts = split_cues(cues)
+    times = np.asarray(timestamps, dtype=float).reshape(-1, 2)
+
+    clamped = np.clip(times, 0.0, duration)
+    report['clamped'] = int(np.count_nonzero((clamped != times).any(axis=1)))
+    nonempty = clamped[:, 1] > clamped[:, 0]
+    report['dropped'] = int(np.count_nonzero(~nonempty))
+    order = np.flatnonzero(nonempty)
+    order = order[np.lexsort((clamped[order, 1], clamped[order, 0]))]
+    times = clamped[order]
+    texts = [texts[i] for i in order.tolist()]
+    # the same cue given twice, which some subtitle files do, would otherwise be joined with its text twice
+    duplicate = np.zeros(len(times), dtype=bool)
+    duplicate[1:] = (times[1:] == times[:-1]).all(axis=1) & np.array([a == b for a, b in zip(texts[1:], texts[:-1])],
+                                                                      dtype=bool)
+    report['duplicates_dropped'] = int(np.count_nonzero(duplicate))
+    times = times[~duplicate]
+    texts = [text for text, dropped in zip(texts, duplicate.tolist()) if not dropped]
+    starts, ends = times[:, 0], times[:, 1]
+
+    if len(starts):
+        # the furthest any earlier cue reaches, so a cue inside a long one counts as overlapping it
+        reach = np.maximum.accumulate(ends)[:-1]
+        gaps = starts[1:] - reach
+        report['overlaps_merged'] = int(np.count_nonzero(gaps < 0))
+        report['short_gaps_merged'] = int(np.count_nonzero((gaps >= 0) & (gaps < min_gap)))
+        starts, ends, texts = merge_groups(starts, ends, texts, gaps >= min_gap)
+    else:
+        report['overlaps_merged'] = report['short_gaps_merged'] = 0
+
+    short = (ends - starts) < min_cue
+    report['short_cues_merged'] = report['short_cues_padded'] = 0
+    if len(starts) and short.any():
+        gaps = starts[1:] - ends[:-1]
+        gap_before = np.concatenate(([np.inf], gaps))
+        gap_after = np.concatenate((gaps, [np.inf]))
+        # joining onto a cue far away would make the gap between them dialogue too
+        join = short & (np.minimum(gap_before, gap_after) <= max_join)
+        join_before = join & (gap_before <= gap_after)
+        join_after = join & ~join_before
+        separate = ~(join_before[1:] | join_after[:-1])
+        report['short_cues_merged'] = int(np.count_nonzero(join))
+        report['short_cues_padded'] = int(np.count_nonzero(short & ~join))
+        pad_cues(starts, ends, short & ~join, min_cue, min_gap, duration)
+        starts, ends, texts = merge_groups(starts, ends, texts, separate)
+
+    if len(starts):
+        if starts[0] < min_gap:
+            starts[0] = 0.0
+        if duration - ends[-1] < min_gap:
+            ends[-1] = duration
+
+    report['output'] = len(starts)
+    return list(zip(starts.tolist(), ends.tolist())), texts, report
+
+
+def describe_report(report: dict) -> str:
+    """Describe what normalise_timestamps changed, for printing."""
+    return (f"{report['input']} timestamps -> {report['output']}: "
+            f"{report['clamped']} clamped to the video, {report['dropped']} empty and "
+            f"{report['duplicates_dropped']} duplicates dropped, "
+            f"{report['overlaps_merged']} overlaps and {report['short_gaps_merged']} short gaps joined, "
+            f"{report['short_cues_merged']} short cues joined and {report['short_cues_padded']} padded")
@@ -0,0 +1,174 @@
+"""Tracing of pipeline stages and ffmpeg processes, for finding out what makes a run slow.
+
+When tracing is started, every stage and every ffmpeg or ffprobe process writes an event to the trace file as it
+finishes, with how long it took, its arguments, its exit status and how many bytes it wrote. Progress bars write
+counter events to the same file. The file is either JSON lines, one event per line, or the Chrome trace format, which
+can be opened in chrome://tracing or https://ui.perfetto.dev to see the stages and clips on a timeline.
+
+Summarise a trace with: kingsquit --summarise-trace trace.jsonl
+"""
+
+import os
+import json
+import time
+import typing
+import functools
+import threading
+import contextlib
+from pathlib import Path
+
+
+trace_formats = ['jsonl', 'chrome']
+trace_file = None
+trace_format = 'jsonl'
+trace_lock = threading.Lock()
+events_written = 0
+
+
+def start_trace(path: Path, file_format: str = 'jsonl'):
+    """Start writing trace events to a file, replacing it if it exists."""
+    global trace_file, trace_format, events_written
+    with trace_lock:
+        trace_file = open(path, 'w', encoding='utf-8')
+        trace_format = file_format
+        events_written = 0
+        if trace_format == 'chrome':
+            trace_file.write('[\n')
+
+
+def stop_trace():
+    """Stop tracing and close the trace file."""
+    global trace_file
+    with trace_lock:
+        if trace_file is None:
+            return
+        if trace_format == 'chrome':
+            trace_file.write('\n]\n')
+        trace_file.close()
+        trace_file = None
+
+
+def enabled() -> bool:
+    """Check whether tracing is on, so callers can skip working out event details if it isn't."""
+    return trace_file is not None
+
+
+def now() -> int:
+    """Get the time for an event, in microseconds. Wall clock time, so traces from batch workers line up."""
+    return time.time_ns() // 1000
+
+
+def write_event(event: dict):
+    """Write one event to the trace file, if tracing is on."""
+    global events_written
+    event.setdefault('pid', os.getpid())
+    event.setdefault('tid', threading.get_ident())
+    line = json.dumps(event, separators=(',', ':'), default=str)
+    with trace_lock:
+        if trace_file is None:
+            return
+        if trace_format == 'chrome' and events_written:
+            trace_file.write(',\n')
+        trace_file.write(line)
+        if trace_format == 'jsonl':
+            trace_file.write('\n')
+        # flushed so a trace is still useful if the run is stopped part way
+        trace_file.flush()
+        events_written += 1
+
+
+@contextlib.contextmanager
+def span(name: str, category: str = 'stage', **args):
+    """Time the with block, and write it as a complete event when it ends.
+
+    Args:
+        name -- name of the event
+        category -- kind of event, stage for pipeline stages or ffmpeg for processes
+        args -- details to save with the event. the with block can add more to the yielded dict
+    Yields the dict of details. An exception in the with block is saved as the error detail, then raised again.
+    """
+    if trace_file is None:
+        yield args
+        return
+
+    start = now()
+    try:
+        yield args
+    except BaseException as err:
+        args['error'] = type(err).__name__
+        raise
+    finally:
+        write_event({'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': now() - start, 'args': args})
+
+
+def stage(function: typing.Callable) -> typing.Callable:
+    """Decorator that traces every call of a function as a stage, named after its module and function."""
+    name = f'{function.__module__}.{function.__qualname__}'
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def instant(name: str, category: str = 'ffmpeg', **args):
+    """Write an event for something that happened at one moment."""
+    if trace_file is not None:
+        write_event({'name': name, 'cat': category, 'ph': 'i', 's': 't', 'ts': now(), 'args': args})
+
+
+def counter(name: str, **values):
+    """Write the current values of a counter, like the number of clips done so far."""
+    if trace_file is not None:
+        write_event({'name': name, 'cat': 'progress', 'ph': 'C', 'ts': now(), 'args': values})
+
+
+def load_events(path: Path) -> typing.List[dict]:
+    """Load the events from a trace file in either format, including one that wasn't finished."""
+    text = path.read_text(encoding='utf-8').strip()
+    if text.startswith('['):
+        # a stopped run leaves the list of a Chrome trace open
+        if not text.endswith(']'):
+            text = text.rstrip(',') + ']'
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line]
+
+
+def summarise(events: typing.List[dict], top: int = 10) -> str:
+    """Describe where the time went in a trace: the total time of each stage, and the slowest clips and processes."""
+    stage_times = {}
+    clip_events = []
+    ffmpeg_events = []
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        if event['cat'] == 'stage':
+            count, total = stage_times.get(event['name'], (0, 0))
+            stage_times[event['name']] = count + 1, total + event['dur']
+        elif event['cat'] == 'clip':
+            clip_events.append(event)
+        elif event['cat'] == 'ffmpeg':
+            ffmpeg_events.append(event)
+
+    lines = ['Stages:']
+    for name, (count, total) in sorted(stage_times.items(), key=lambda item: -item[1][1]):
+        lines.append(f'{total / 1e6:>10.3f}s {count:>6}x  {name}')
+
+    if clip_events:
+        lines.append(f'\nClips: {len(clip_events)}. Slowest:')
+        for event in sorted(clip_events, key=lambda e: -e['dur'])[:top]:
+            args = event['args']
+            lines.append(f"{event['dur'] / 1e6:>10.3f}s {args.get('status', ''):>8}  {event['name']} at "
+                         f"{args.get('start')}s for {args.get('duration')}s")
+
+    ffmpeg_total = sum(e['dur'] for e in ffmpeg_events)
+    lines.append(f'\nffmpeg: {len(ffmpeg_events)} processes, {ffmpeg_total / 1e6:.3f}s in total. Slowest:')
+    for event in sorted(ffmpeg_events, key=lambda e: -e['dur'])[:top]:
+        args = event['args']
+        status = 'failed' if args.get('error') or args.get('returncode') else 'ok'
+        lines.append(f"{event['dur'] / 1e6:>10.3f}s {status:>6}  {args.get('bytes_out', 0):>10} bytes  "
+                     f"{' '.join(map(str, args.get('args', [])))}")
+    return '\n'.join(lines)
+
@@ -0,0 +1,188 @@
+"""Finding the dialogue in a video that has no subtitles, with a simple voice activity detector.
+
+The audio is decoded through an ffmpeg pipe at a low sample rate and read a chunk at a time, so memory use doesn't grow
+with the length of the video. Each chunk is cut into short frames. A frame counts as speech when its energy in the
+speech band is above the noise floor, and the spectrum around it keeps changing quickly, like it does from one
+syllable to the next. Steady sounds like hum and held notes have energy but hardly any spectral flux. Runs of speech
+frames become dialogue timestamps, with short pauses joined up and blips dropped.
+
+No models or network needed, and it runs many times faster than realtime.
+"""
+
+import typing
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+
+from kingsquit import media, trace
+from kingsquit.media import MediaError
+from kingsquit.subtitles import cue_type, write_timestamps
+
+
+sample_rate = 16000
+# 20ms frames
+frame_length = 320
+# 30s of frames are read at once
+chunk_frames = 1500
+# lowest and highest frequencies of speech that are measured, in Hz
+speech_band = (300, 3400)
+# quietest a frame can be and still be speech, in dB below full scale
+min_energy = -55.0
+# dB above the noise floor a frame has to be to be speech
+energy_margin = 6.0
+# spectral flux above this many times the chunk's median counts as changing quickly
+flux_factor = 1.5
+# frames around each frame that are checked for changing quickly, half a second
+activity_frames = 25
+# fraction of the frames around a frame that have to be changing quickly for it to be speech
+min_activity = 0.2
+# how much of the last chunk's noise floor is kept when it goes up, so a chunk of nonstop talking doesn't raise it
+floor_smoothing = 0.8
+default_min_speech = 0.25
+default_min_pause = 0.3
+# seconds added to each end of the dialogue, so quiet starts and ends of words aren't cut off
+default_padding = 0.1
+
+
+def iter_audio_chunks(video_path: Path) -> typing.Iterator[np.ndarray]:
+    """Decode a video's audio to mono at sample_rate and yield it a chunk at a time, as arrays of frames.
+
+    Each chunk is an array with one row per frame, and the last one is padded with silence to a whole frame.
+    Holds a process slot while decoding. Raises MediaError if ffmpeg fails.
+    """
+    chunk_size = chunk_frames * frame_length * 4
+    stream = ffmpeg.input(str(video_path))
+    stream = ffmpeg.output(stream.audio, 'pipe:', format='f32le', ac=1, ar=sample_rate).global_args('-v', 'error')
+    with media.process_slot():
+        process = media.run_async(stream, pipe_stdout=True)
+        try:
+            while data := process.stdout.read(chunk_size):
+                samples = np.frombuffer(data, np.float32)
+                if len(samples) % frame_length:
+                    samples = np.pad(samples, (0, frame_length - len(samples) % frame_length))
+                yield samples.reshape(-1, frame_length)
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            process.stdout.close()
+            process.wait()
+    if process.returncode:
+        raise MediaError(f"Couldn't decode the audio of {video_path}, see ffmpeg's output above")
+
+
+class SpeechDetector:
+    """Class for carrying the state of the detector from one chunk to the next."""
+
+    def __init__(self):
+        """Start with no noise floor and no previous frame."""
+        self.window = np.hanning(frame_length).astype(np.float32)
+        self.window_power = float(np.sum(self.window ** 2))
+        frequencies = np.fft.rfftfreq(frame_length, 1 / sample_rate)
+        self.band = (frequencies >= speech_band[0]) & (frequencies <= speech_band[1])
+        self.noise_floor = None
+        self.last_spectrum = None
+
+    def detect(self, frames: np.ndarray) -> np.ndarray:
+        """Decide which frames of a chunk are speech.
+
+        Args:
+            frames -- array with one row of samples per frame
+        Returns an array of whether each frame is speech.
+        """
+        spectrum = np.abs(np.fft.rfft(frames * self.window, axis=1))[:, self.band]
+        # mean square of the speech band, so a full scale sine in it comes out at -3dB
+        power = np.sum(spectrum ** 2, axis=1) * 2 / (frame_length * self.window_power)
+        energy = 10 * np.log10(power + 1e-12)
+
+        log_spectrum = np.log1p(spectrum)
+        last_spectrum = self.last_spectrum if self.last_spectrum is not None else log_spectrum[:1]
+        flux = np.maximum(np.diff(log_spectrum, axis=0, prepend=last_spectrum), 0).sum(axis=1)
+        self.last_spectrum = log_spectrum[-1:]
+
+        # the noise floor drops straight away but only rises slowly
+        chunk_floor = np.percentile(energy, 10)
+        if self.noise_floor is None or chunk_floor < self.noise_floor:
+            self.noise_floor = chunk_floor
+        else:
+            self.noise_floor += (chunk_floor - self.noise_floor) * (1 - floor_smoothing)
+
+        changing = flux > np.median(flux) * flux_factor
+        # centred on each frame, and as long as the chunk even when it's shorter than the window
+        activity = np.convolve(changing, np.full(activity_frames, 1 / activity_frames))
+        activity = activity[(activity_frames - 1) // 2:][:len(changing)]
+        return (energy > self.noise_floor + energy_margin) & (energy > min_energy) & (activity >= min_activity)
+
+
+def iter_speech_runs(chunks: typing.Iterable[np.ndarray]) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Find the runs of speech frames in chunks of audio frames.
+
+    Returns an iterator of the start and end frame numbers of each run, following on across chunks.
+    """
+    detector = SpeechDetector()
+    offset = 0
+    # frame number the current run started at, if one is still going at the end of the last chunk
+    run_start = None
+    for frames in chunks:
+        speech = detector.detect(frames)
+        edges = np.flatnonzero(np.diff(speech.astype(np.int8), prepend=np.int8(0), append=np.int8(0)))
+        starts, ends = edges[::2], edges[1::2]
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if start == 0 and run_start is not None:
+                start = run_start - offset
+                run_start = None
+            elif run_start is not None:
+                yield run_start, offset
+                run_start = None
+            if end == len(frames):
+                run_start = offset + start
+            else:
+                yield offset + start, offset + end
+        if not len(starts) and run_start is not None:
+            yield run_start, offset
+            run_start = None
+        offset += len(frames)
+    if run_start is not None:
+        yield run_start, offset
+
+
+def join_runs(runs: typing.Iterable[typing.Tuple[int, int]], min_speech: float = default_min_speech,
+              min_pause: float = default_min_pause, padding: float = default_padding) -> typing.Iterator[cue_type]:
+    """Turn runs of speech frames into dialogue timestamps.
+
+    Args:
+        runs -- start and end frame numbers of each run of speech, in order
+        min_speech -- dialogue shorter than this, after pauses are joined, is dropped
+        min_pause -- pauses shorter than this are joined up
+        padding -- seconds added to each end of the dialogue
+    Returns an iterator of cues with start and end in seconds, and no text.
+    """
+    frame_time = frame_length / sample_rate
+    current = None
+    for start, end in runs:
+        start, end = start * frame_time, end * frame_time
+        if current and start - current[1] < min_pause:
+            current[1] = end
+            continue
+        if current and current[1] - current[0] >= min_speech:
+            yield max(0.0, current[0] - padding), current[1] + padding, ''
+        current = [start, end]
+    if current and current[1] - current[0] >= min_speech:
+        yield max(0.0, current[0] - padding), current[1] + padding, ''
+
+
+@trace.stage
+def detect_speech(video_path: Path, timestamps_path: Path, min_speech: float = default_min_speech,
+                  min_pause: float = default_min_pause, padding: float = default_padding) -> int:
+    """Find the dialogue in a video's audio, and save it as a timestamps file like the ones made from subtitles.
+
+    Args:
+        video_path -- path to the video
+        timestamps_path -- path to save the timestamps to
+        min_speech, min_pause, padding -- passed on to join_runs
+    Returns the number of timestamps found. Raises MediaError if the audio can't be decoded.
+    """
+    runs = iter_speech_runs(iter_audio_chunks(video_path))
+    # write_timestamps only replaces the file once it's complete, so a failed decode leaves the old one alone
+    return write_timestamps(join_runs(runs, min_speech, min_pause, padding), timestamps_path)
@@ -33,12 +33,16 @@ setuptools.setup(
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
     ],
-    python_requires='>=3',
+    python_requires='>=3.9',
     install_requires=[
-        'ffmpeg-python',
-        'youtube-dl',
-        'pysrt',
-        'pycaption',
-        'cchardet',
-    ]
+        'ffmpeg-python>=0.2.0',
+        'youtube-dl>=2021.4.1',
+        'pycaption>=1.0.2',
+        'cchardet>=2.1.7',
+        'numpy>=1.21.0',
+    ],
+    extras_require={
+        # PyAV 10 or later, for AudioResampler.resample returning lists of frames and flushing with None
+        'pyav': ['av>=10'],
+    },
 )
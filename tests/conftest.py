@@ -0,0 +1,71 @@
+import json
+import shutil
+import subprocess
+import importlib.util
+
+import ffmpeg
+import numpy as np
+import pytest
+
+from kingsquit import backends
+
+
+video_length = 6.0
+cues = [[0.5, 1.2, 'hello'], [1.5, 2.0, 'there'], [2.4, 3.3, 'hello'], [3.8, 4.1, 'bye'], [4.6, 5.5, 'now']]
+
+
+def decode(path):
+    """Decode the audio of a file to an array of mono samples with ffmpeg."""
+    args = ['ffmpeg', '-v', 'error', '-i', str(path), '-map', '0:a:0', '-f', 's16le', '-ac', '1', '-']
+    return np.frombuffer(subprocess.run(args, capture_output=True, check=True).stdout, np.int16).astype(int)
+
+
+def sound_alike(samples, other_samples):
+    """Check whether two arrays of samples are about the same audio, as two lossy encodings of it would be."""
+    return np.mean(np.abs(samples - other_samples)) < np.abs(samples).max() / 20
+
+
+def get_backend_name():
+    """Get the media backend the tests can use here, or None if there isn't one."""
+    if shutil.which('ffprobe'):
+        return 'ffmpeg'
+    if importlib.util.find_spec('av'):
+        return 'pyav'
+    return None
+
+
+@pytest.fixture
+def media_backend(monkeypatch):
+    """Use a media backend that can probe here, and put the old one back afterwards."""
+    if not shutil.which('ffmpeg'):
+        pytest.skip('needs the ffmpeg executable')
+    name = get_backend_name()
+    if name is None:
+        pytest.skip('needs ffprobe or PyAV')
+    monkeypatch.setattr(backends, 'current_backend', None)
+    backends.set_backend(name)
+    return name
+
+
+@pytest.fixture(scope='session')
+def source_video(tmp_path_factory):
+    """Make a short test video once for all the tests that use one."""
+    if not shutil.which('ffmpeg'):
+        pytest.skip('needs the ffmpeg executable')
+    video_path = tmp_path_factory.mktemp('source') / 'video.mp4'
+    video_stream = ffmpeg.input(f'testsrc=size=160x120:rate=25:duration={video_length}', format='lavfi')
+    # a rising tone in each channel, so every part of the audio is different and moving any of it shows
+    audio_stream = ffmpeg.input(f'aevalsrc=0.4*sin(2*PI*(200+100*t)*t)|0.4*sin(2*PI*(500+50*t)*t)'
+                                f':sample_rate=44100:duration={video_length}', format='lavfi')
+    stream = ffmpeg.output(video_stream, audio_stream, str(video_path), vcodec='mpeg4', acodec='aac')
+    ffmpeg.run(stream, quiet=True)
+    return video_path
+
+
+@pytest.fixture
+def video(tmp_path, source_video, media_backend):
+    """Copy the test video and its timestamps into a folder of their own, so their caches and journals are too."""
+    video_path = tmp_path / source_video.name
+    shutil.copyfile(source_video, video_path)
+    video_path.with_suffix('.json').write_text(json.dumps(cues))
+    return video_path
@@ -0,0 +1,20 @@
+import pytest
+
+from kingsquit.atomic import replace_when_done
+
+
+def test_replace_when_done(tmp_path):
+    path = tmp_path / 'file.json'
+    path.write_text('old')
+    with pytest.raises(KeyError):
+        with replace_when_done(path) as partial_path:
+            partial_path.write_text('half')
+            raise KeyError
+    # a write that was stopped leaves the old file as it was, and nothing else
+    assert path.read_text() == 'old'
+    assert list(tmp_path.iterdir()) == [path]
+
+    with replace_when_done(path) as partial_path:
+        partial_path.write_text('new')
+    assert path.read_text() == 'new'
+    assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,94 @@
+import shutil
+import importlib.util
+
+import numpy as np
+import pytest
+
+from kingsquit import backends
+from kingsquit.media import MediaError
+from conftest import video_length
+
+
+sample_rate = 44100
+# raw s16le stereo samples that count up, so any sample that's moved or dropped shows
+ramp = b''.join(i.to_bytes(2, 'little', signed=True) * 2 for i in range(-3000, 3000))
+
+
+def get_backend(name):
+    """Make a media backend, skipping the test if it can't be used here."""
+    if not shutil.which('ffmpeg'):
+        pytest.skip('needs the ffmpeg executable')
+    if name == 'pyav' and not importlib.util.find_spec('av'):
+        pytest.skip('needs PyAV')
+    return backends.backend_classes[name]()
+
+
+def test_fit_samples():
+    assert backends.fit_samples(b'abcdef', 2, 2) == b'abcd'
+    assert backends.fit_samples(b'ab', 3, 2) == b'ab\0\0\0\0'
+
+
+def test_get_frame_size():
+    assert backends.get_frame_size(2, 's16le') == 4
+    assert backends.get_frame_size(1, 'f32le') == 4
+
+
+@pytest.mark.parametrize('name', backends.backend_names)
+def test_decode_range(name, source_video):
+    backend = get_backend(name)
+    data = backend.decode_range(source_video, 1000, 5000, sample_rate, 2)
+    assert len(data) == 4000 * 4
+    # decoding the same range again gives exactly the same samples, so clips are reproducible
+    assert backend.decode_range(source_video, 1000, 5000, sample_rate, 2) == data
+    assert backend.decode_range(source_video, 3000, 5000, sample_rate, 2) == data[2000 * 4:]
+
+    # past the end of the audio is silence
+    end = round(video_length * sample_rate) + 2000
+    data = backend.decode_range(source_video, end - 500, end, sample_rate, 1, 'f32le')
+    assert len(data) == 500 * 4
+    assert data[-1000:] == bytes(1000)
+
+
+def test_backends_agree(source_video):
+    ffmpeg_backend, pyav_backend = get_backend('ffmpeg'), get_backend('pyav')
+    for start, end in [(0, 3000), (44100, 50000)]:
+        ffmpeg_samples = np.frombuffer(ffmpeg_backend.decode_range(source_video, start, end, sample_rate, 2), np.int16)
+        pyav_samples = np.frombuffer(pyav_backend.decode_range(source_video, start, end, sample_rate, 2), np.int16)
+        # they can round differently, but a sample out of place would be far off on the test tone
+        assert np.abs(ffmpeg_samples.astype(int) - pyav_samples).max() <= 1
+
+
+@pytest.mark.parametrize('name', backends.backend_names)
+def test_encode_and_decode_to_file(name, tmp_path):
+    backend = get_backend(name)
+    audio_path = tmp_path / 'audio.wav'
+    backend.encode([ramp[:1000], b'', ramp[1000:]], audio_path, sample_rate, 2)
+    backend.decode_to_file(audio_path, tmp_path / 'audio.raw', sample_rate, 2)
+    assert (tmp_path / 'audio.raw').read_bytes() == ramp
+
+
+@pytest.mark.parametrize('name', backends.backend_names)
+def test_mux(name, tmp_path, source_video, media_backend):
+    backend = get_backend(name)
+    new_path = tmp_path / 'new.mp4'
+    backend.mux(source_video, [ramp], new_path, sample_rate, 2)
+    streams = backends.get_backend().probe(new_path)['streams']
+    assert sorted(stream['codec_type'] for stream in streams) == ['audio', 'video']
+
+
+@pytest.mark.parametrize('name', backends.backend_names)
+def test_mux_abandoned(name, tmp_path, source_video):
+    backend = get_backend(name)
+
+    def chunks():
+        yield ramp
+        raise RuntimeError('renderer failed')
+
+    with pytest.raises(RuntimeError, match='renderer failed'):
+        backend.mux(source_video, chunks(), tmp_path / 'new.mp4', sample_rate, 2)
+
+
+@pytest.mark.parametrize('name', backends.backend_names)
+def test_missing_file(name, tmp_path):
+    with pytest.raises(MediaError):
+        get_backend(name).decode_range(tmp_path / 'missing.mp4', 0, 100, sample_rate, 2)
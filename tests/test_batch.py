@@ -0,0 +1,19 @@
+from kingsquit import batch
+
+
+def test_find_videos(tmp_path):
+    for name in ['b.mp4', 'a.MKV', 'notes.txt', '(SHUFFLED) a.mkv', '(SHUFFLED-2) a.mkv']:
+        (tmp_path / name).touch()
+    other = tmp_path / 'other.webm'
+    assert batch.find_videos([str(tmp_path), str(other)]) == [tmp_path / 'a.MKV', tmp_path / 'b.mp4', other]
+
+
+def test_run_batch(video, media_backend, capsys):
+    broken = video.with_name('broken.mp4')
+    broken.write_bytes(b'not a video')
+    assert not batch.run_batch([str(video.parent)], jobs=2, max_ffmpeg=2, seed=1, backend=media_backend)
+    report = capsys.readouterr().out
+    assert f'OK     {video}: {video.with_name("(SHUFFLED) video.mp4")}' in report
+    assert f'FAILED {broken}: ' in report
+    assert '1/2 videos shuffled' in report
+    assert video.with_name('(SHUFFLED) video.mp4').is_file()
@@ -0,0 +1,38 @@
+import os
+import sys
+import subprocess
+from pathlib import Path
+
+import kingsquit
+
+
+def run(*args, cwd=None):
+    """Run kingsquit in a new process, like from the command line, and get its exit code and output."""
+    env = {**os.environ, 'PYTHONPATH': str(Path(kingsquit.__file__).parent.parent)}
+    result = subprocess.run([sys.executable, *args], cwd=cwd, env=env, capture_output=True, text=True)
+    return result.returncode, result.stdout
+
+
+def test_startup_imports():
+    code = ('import sys, kingsquit\n'
+            'heavy = ["numpy", "multiprocessing", "youtube_dl", "pycaption", "kingsquit.pcm", "kingsquit.streaming",\n'
+            '         "kingsquit.filtergraph", "kingsquit.preview", "kingsquit.batch", "kingsquit.vad"]\n'
+            'print(*[name for name in heavy if name in sys.modules])')
+    # starting up doesn't import anything a run might not need
+    assert run('-c', code) == (0, '\n')
+
+
+def test_version():
+    assert run('-m', 'kingsquit', '--version') == (0, f'{kingsquit.__version__}\n')
+
+
+def test_missing_file(tmp_path):
+    assert run('-m', 'kingsquit', 'missing.mp4', cwd=tmp_path) == (1, 'File not found: missing.mp4\n')
+
+
+def test_local_video(video, media_backend):
+    code, output = run('-m', 'kingsquit', video.name, '--output', 'new.mp4', '--seed', '1', '--backend', media_backend,
+                       cwd=video.parent)
+    assert code == 0, output
+    assert 'Shuffle seed: 1' in output
+    assert video.with_name('new.mp4').is_file()
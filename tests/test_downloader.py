@@ -0,0 +1,104 @@
+import json
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import youtube_dl
+
+from kingsquit import downloader
+
+
+ttml = '''<?xml version="1.0" encoding="utf-8"?>
+<tt xmlns="http://www.w3.org/ns/ttml"><body><div>
+  <p begin="00:00:01.000" end="00:00:02.000">Hello</p>
+  <p begin="00:00:03.000" end="00:00:04.500">Goodbye</p>
+</div></body></tt>
+'''
+
+
+class StubYoutubeDL:
+    """Stands in for youtube_dl.YoutubeDL, writing local files where a download would, and calling the same hooks.
+
+    Like youtube-dl, it writes the subtitles before the video, and calls the progress hooks while the video is
+    downloading and once it's finished. A url without a dot is only found by searching.
+    """
+
+    downloads = []
+
+    def __init__(self, options: dict):
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def download(self, urls):
+        url = urls[0]
+        if '.' not in url and not self.options.get('default_search'):
+            raise youtube_dl.DownloadError(f'{url} is not a valid URL',
+                                           (youtube_dl.utils.ExtractorError, None, None))
+        self.downloads.append((url, self.options))
+        folder = Path(self.options['outtmpl']).parent
+        name = url.rsplit('/', 1)[-1]
+        (folder / f'{name}.en.ttml').write_text(ttml)
+        video_path = folder / f'{name}.mp4'
+        for hook in self.options['progress_hooks']:
+            hook({'status': 'downloading', 'filename': str(video_path)})
+        video_path.write_bytes(b'not really a video')
+        for hook in self.options['progress_hooks']:
+            hook({'status': 'finished', 'filename': str(video_path)})
+
+
+@pytest.fixture(autouse=True)
+def clear_downloads():
+    StubYoutubeDL.downloads = []
+
+
+def test_download(tmp_path):
+    video_path, subtitle_path = downloader.main(str(tmp_path), 'https://example.com/watch', 'en',
+                                                youtube_dl_class=StubYoutubeDL)
+    assert video_path == tmp_path / 'watch.mp4'
+    # the language is taken off the subtitle file's name, so it matches the video's
+    assert subtitle_path == tmp_path / 'watch.ttml'
+    assert json.loads(subtitle_path.with_suffix('.json').read_text()) == [[1.0, 2.0, 'Hello'], [3.0, 4.5, 'Goodbye']]
+    (_, options), = StubYoutubeDL.downloads
+    assert options['subtitleslangs'] == ['en']
+
+
+def test_invalid_url_without_search(tmp_path):
+    assert downloader.main(str(tmp_path), 'cats', youtube_dl_class=StubYoutubeDL) == (None, None)
+    assert not StubYoutubeDL.downloads
+
+
+def test_invalid_url_with_search(tmp_path):
+    video_path, subtitle_path = downloader.main(str(tmp_path), 'cats', search='ytsearch',
+                                                youtube_dl_class=StubYoutubeDL)
+    assert video_path == tmp_path / 'cats.mp4'
+    assert subtitle_path == tmp_path / 'cats.ttml'
+    (_, options), = StubYoutubeDL.downloads
+    assert options['default_search'] == 'ytsearch'
+
+
+def test_downloads_at_once(tmp_path):
+    # every download has its own job, so their hooks don't mix up each other's files
+    with ThreadPoolExecutor(2) as threads:
+        results = list(threads.map(lambda name: downloader.main(str(tmp_path), f'https://example.com/{name}',
+                                                                youtube_dl_class=StubYoutubeDL), ('a', 'b')))
+    assert results == [(tmp_path / 'a.mp4', tmp_path / 'a.ttml'), (tmp_path / 'b.mp4', tmp_path / 'b.ttml')]
+
+
+@pytest.mark.parametrize('text, url', [
+    ('https://www.youtube.com/watch?v=RqunFIEI1IY', True),
+    ('http://youtu.be/RqunFIEI1IY', True),
+    ('youtube.com/watch?v=RqunFIEI1IY', True),
+    ('video.mp4', False),
+    ('videos/video.mp4', False),
+    ('/home/me/video.mp4', False),
+    ('C:\\videos\\video.mp4', False),
+    ('ftp://example.com/video.mp4', False),
+    ('some search terms', False),
+])
+def test_is_url(text, url):
+    assert downloader.is_url(text) == url
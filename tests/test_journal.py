@@ -0,0 +1,67 @@
+import json
+
+from kingsquit import journal
+
+
+def test_make_key():
+    assert journal.make_key('a', {'x': 1, 'y': 2}) == journal.make_key('a', {'y': 2, 'x': 1})
+    assert journal.make_key('a', 1) != journal.make_key('a', 2)
+
+
+def test_file_key(tmp_path):
+    path = tmp_path / 'input.txt'
+    assert journal.file_key(path) is None
+    path.write_text('one')
+    key = journal.file_key(path)
+    path.write_text('two')
+    assert journal.file_key(path) != key
+
+
+def test_stages(tmp_path):
+    output = tmp_path / 'output.txt'
+    stage_journal = journal.get_journal(tmp_path)
+    assert journal.get_journal(tmp_path) is stage_journal
+    assert not stage_journal.is_done('rip', 'key')
+
+    stage_journal.start('rip', 'key', seed=5)
+    assert not stage_journal.is_done('rip', 'key')
+    assert stage_journal.get('rip', 'key')['seed'] == 5
+    assert stage_journal.get('rip', 'other key') is None
+
+    output.write_text('clips')
+    stage_journal.finish('rip', 'key', [output])
+    assert stage_journal.is_done('rip', 'key')
+    assert not stage_journal.is_done('rip', 'other key')
+
+
+def test_changed_outputs(tmp_path):
+    output = tmp_path / 'output.txt'
+    output.write_text('clips')
+    stage_journal = journal.get_journal(tmp_path)
+    stage_journal.finish('rip', 'key', [output])
+
+    # a different size means the output was changed or only partly made again
+    output.write_text('more clips')
+    assert not stage_journal.is_done('rip', 'key')
+    output.unlink()
+    assert not stage_journal.is_done('rip', 'key')
+
+
+def test_saved(tmp_path):
+    journal.get_journal(tmp_path).finish('probe', 'key', info={'duration': 1.5})
+    saved = journal.Journal(tmp_path)
+    assert saved.is_done('probe', 'key')
+    assert saved.get('probe')['info'] == {'duration': 1.5}
+    assert [path.name for path in tmp_path.iterdir()] == [journal.journal_name]
+
+
+def test_unreadable(tmp_path):
+    (tmp_path / journal.journal_name).write_text('{"rip": ')
+    assert journal.Journal(tmp_path).entries == {}
+
+
+def test_saved_entries_are_json(tmp_path):
+    journal.get_journal(tmp_path).start('rip', 'key')
+    entries = json.loads((tmp_path / journal.journal_name).read_text())
+    assert entries['rip']['key'] == 'key'
+    assert entries['rip']['done'] is False
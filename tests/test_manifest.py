@@ -0,0 +1,53 @@
+import wave
+
+from kingsquit import ledger
+from kingsquit.manifest import (ClipEntry, load_manifest, save_manifest, ok_entries, status_ok, status_failed,
+                                status_repaired)
+
+
+sample_rate = 8000
+
+
+def write_wav(path, samples, channels=1):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(bytes(samples * channels * 2))
+    return path
+
+
+def test_manifest(tmp_path):
+    entries = [
+        ClipEntry(0.0, 1.5, 1.5, tmp_path / '0.0d1.5.wav', status_ok),
+        ClipEntry(1.5, 0.5, None, tmp_path / '1.5d0.5.wav', status_failed),
+        ClipEntry(2.0, 1.0, 1.0, tmp_path / '2.0d1.0.wav', status_repaired),
+    ]
+    assert load_manifest(tmp_path) == []
+    save_manifest(tmp_path, entries)
+    assert load_manifest(tmp_path) == entries
+    assert ok_entries(entries) == [entries[0], entries[2]]
+    assert entries[1].best_duration == 0.5
+
+
+def test_needs_repair(tmp_path):
+    # one second is 8000 samples, and being one sample off is within the tolerance
+    assert not ledger.needs_repair(ClipEntry(0.0, 1.0, 1.0, write_wav(tmp_path / 'a.wav', 8000), status_ok))
+    assert not ledger.needs_repair(ClipEntry(0.0, 1.0, 1.0, write_wav(tmp_path / 'b.wav', 8001, 2), status_ok))
+    assert ledger.needs_repair(ClipEntry(0.0, 1.0, 1.0, write_wav(tmp_path / 'c.wav', 8002), status_ok))
+    assert ledger.needs_repair(ClipEntry(0.0, 1.0, 1.0, write_wav(tmp_path / 'd.wav', 7000), status_ok))
+    assert ledger.needs_repair(ClipEntry(0.0, 1.0, None, write_wav(tmp_path / 'e.wav', 8000), status_failed))
+    assert ledger.needs_repair(ClipEntry(0.0, 1.0, 1.0, tmp_path / 'missing.wav', status_ok))
+
+
+def test_summarise_ledger(tmp_path):
+    summary = ledger.summarise_ledger([
+        ClipEntry(0.0, 1.0, 1.25, tmp_path / 'a.wav', status_ok),
+        ClipEntry(1.0, 2.0, None, tmp_path / 'b.wav', status_ok),
+        ClipEntry(3.0, 0.5, None, tmp_path / 'c.wav', status_failed),
+        ClipEntry(3.5, 1.0, 1.0, tmp_path / 'd.wav', status_repaired),
+    ])
+    assert summary == {'clips': 4, status_ok: 2, status_repaired: 1, status_failed: 1, 'requested': 4.5,
+                       'real': 4.25, 'drift': -0.25}
+    assert ledger.describe_ledger(summary) == ('4 clips, 1 repaired, 1 failed: 4.250s of audio for 4.500s asked for '
+                                               '(-0.250s)')
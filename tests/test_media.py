@@ -0,0 +1,75 @@
+import wave
+
+import pytest
+
+from kingsquit import media
+
+
+def write_wav(path, frames, channels=2, sample_width=2, sample_rate=48000):
+    with wave.open(str(path), 'wb') as wav_file:
+        wav_file.setnchannels(channels)
+        wav_file.setsampwidth(sample_width)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(bytes(frames * channels * sample_width))
+    return path
+
+
+def chunk(chunk_id, data):
+    return chunk_id + len(data).to_bytes(4, 'little') + data + b'\0' * (len(data) % 2)
+
+
+def fmt_chunk(channels, sample_rate, sample_width):
+    frame_size = channels * sample_width
+    return chunk(b'fmt ', (1).to_bytes(2, 'little') + channels.to_bytes(2, 'little')
+                 + sample_rate.to_bytes(4, 'little') + (sample_rate * frame_size).to_bytes(4, 'little')
+                 + frame_size.to_bytes(2, 'little') + (sample_width * 8).to_bytes(2, 'little'))
+
+
+@pytest.mark.parametrize('frames, channels, sample_width, sample_rate', [
+    (48000, 2, 2, 48000),
+    (1, 1, 2, 44100),
+    (0, 2, 2, 48000),
+    (12345, 6, 4, 96000),
+])
+def test_get_wav_samples(tmp_path, frames, channels, sample_width, sample_rate):
+    path = write_wav(tmp_path / 'clip.wav', frames, channels, sample_width, sample_rate)
+    assert media.get_wav_samples(path) == (frames, sample_rate)
+    assert media.get_wav_duration(path) == frames / sample_rate
+
+
+def test_get_wav_samples_skips_other_chunks(tmp_path):
+    # ffmpeg writes a LIST chunk with its name in before the data, and chunks with an odd size are padded
+    data = bytes(4 * 100)
+    path = tmp_path / 'clip.wav'
+    body = b'WAVE' + fmt_chunk(2, 8000, 2) + chunk(b'LIST', b'INFOISFT\x05\0\0\0Lavf\0') + chunk(b'data', data)
+    path.write_bytes(b'RIFF' + len(body).to_bytes(4, 'little') + body)
+    assert media.get_wav_samples(path) == (100, 8000)
+
+
+def test_get_wav_samples_rf64(tmp_path):
+    # the real size of the data is in the ds64 chunk, and the data chunk's own size is 0xFFFFFFFF
+    data_size = 4 * 250
+    ds64 = (0).to_bytes(8, 'little') + data_size.to_bytes(8, 'little') + (250).to_bytes(8, 'little') + bytes(4)
+    body = b'WAVE' + chunk(b'ds64', ds64) + fmt_chunk(2, 48000, 2)
+    body += b'data' + (0xFFFFFFFF).to_bytes(4, 'little') + bytes(data_size)
+    path = tmp_path / 'clip.wav'
+    path.write_bytes(b'RF64' + (0xFFFFFFFF).to_bytes(4, 'little') + body)
+    assert media.get_wav_samples(path) == (250, 48000)
+
+
+def test_get_wav_samples_not_wav(tmp_path):
+    assert media.get_wav_samples(tmp_path / 'missing.wav') is None
+    assert media.get_wav_duration(tmp_path / 'missing.wav') is None
+    path = tmp_path / 'clip.mp3'
+    path.write_bytes(b'ID3\x04' + bytes(100))
+    assert media.get_wav_samples(path) is None
+    # cut off before the data chunk
+    path = write_wav(tmp_path / 'clip.wav', 10)
+    path.write_bytes(path.read_bytes()[:30])
+    assert media.get_wav_samples(path) is None
+
+
+def test_program_needed():
+    with pytest.raises(media.MediaError, match='install ffmpeg'):
+        with media.program_needed('ffprobe'):
+            raise FileNotFoundError(2, 'No such file or directory', 'ffprobe')
@@ -0,0 +1,32 @@
+import os
+
+from kingsquit import backends, media, pcm
+
+
+def load(video):
+    """Load the decoded audio of a video the way the pcm renderer does, and get the format it should be in."""
+    audio_info = media.get_audio_stream_info(backends.get_backend().probe(video))
+    sample_format = pcm.get_sample_format(audio_info)
+    samples = pcm.load_audio(video, int(audio_info['sample_rate']), int(audio_info['channels']), sample_format)
+    return samples, sample_format
+
+
+def test_cache(video):
+    video.with_suffix('').mkdir()
+    samples, sample_format = load(video)
+    assert pcm.get_array_format(samples) == sample_format
+    cache_path, cache_info_path = pcm.get_cache_paths(video)
+    made = cache_path.stat().st_mtime_ns
+    cached, _ = load(video)
+    assert cache_path.stat().st_mtime_ns == made
+    assert cached.shape == samples.shape and (cached == samples).all()
+
+    # a changed video is decoded again
+    os.utime(video, ns=(made, made + 10 ** 9))
+    load(video)
+    assert cache_path.stat().st_mtime_ns != made
+
+    size = cache_path.stat().st_size + cache_info_path.stat().st_size
+    assert pcm.clear_cache(video) == size
+    assert not cache_path.exists() and not cache_info_path.exists()
+    assert pcm.clear_cache(video) == 0
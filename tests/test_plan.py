@@ -0,0 +1,107 @@
+import random
+
+import pytest
+
+from kingsquit import plan
+
+
+timestamps = [(1.0, 2.0), (3.0, 3.5), (4.0, 6.0), (7.0, 7.25), (8.0, 9.0)]
+sample_rate = 1000
+total = 10 * sample_rate
+
+
+def expand(ranges):
+    """Get every source sample a list of ranges plays, in order."""
+    return [sample for start, end in ranges for sample in range(start, end)]
+
+
+@pytest.mark.parametrize('strategy', sorted(plan.shuffle_strategies))
+def test_shuffles_are_permutations(strategy):
+    items = list(range(50))
+    shuffled = plan.shuffle_items(items, strategy, seed=1, durations=[i + 1 for i in items])
+    assert sorted(shuffled) == items
+    assert shuffled != items
+    assert plan.shuffle_items(items, strategy, seed=1, durations=[i + 1 for i in items]) == shuffled
+
+
+def test_chunked_jump_chance():
+    items = list(range(20))
+    # never jumping keeps the items in one chunk
+    assert plan.shuffle_chunked(items, random.Random(1), jump_chance=0) == items
+    assert plan.shuffle_chunked([], random.Random(1)) == []
+
+
+def test_weighted_needs_durations():
+    with pytest.raises(ValueError):
+        plan.shuffle_items([1, 2], 'weighted')
+
+
+def test_get_intermediate_timestamps():
+    assert plan.get_intermediate_timestamps([(1, 2), (2, 3), (4, 5)], 6) == [(0.0, 1), (3, 4), (5, 6)]
+    assert plan.get_intermediate_timestamps([(0, 2)], 2) == []
+
+
+def test_plan_reform_fills_every_target_exactly():
+    durations = [5, 3, 8]
+    targets = [4, 6, 2, 10]
+    reform_plan = plan.plan_reform(durations, targets)
+    assert reform_plan[:3] == [[(0, 0, 4)], [(0, 4, 5), (1, 0, 3), (2, 0, 2)], [(2, 2, 4)]]
+    # the items run out part of the way through the last target
+    assert reform_plan[3] == [(2, 4, 8)]
+
+
+@pytest.mark.parametrize('text, key', [
+    ('Hello, World!', 'hello world'),
+    ('<i>hello</i>   world', 'hello world'),
+    ('[music] (laughs)', None),
+    ('', None),
+])
+def test_get_dialogue_key(text, key):
+    assert plan.get_dialogue_key(text) == key
+
+
+def test_plan_memoised_reform():
+    durations = [10, 10, 10]
+    targets = [4, 6, 3, 2]
+    keys = ['catchphrase', None, 'catchphrase', None]
+    reform_plan, numbers = plan.plan_memoised_reform(durations, targets, keys)
+    # the catchphrase is planned once, for its longest time, and said again from the start of it
+    assert numbers == [0, 1, 0, 2]
+    assert reform_plan[0] == [(0, 0, 4)]
+    assert reform_plan[2] == [(0, 0, 3)]
+    assert reform_plan[1] == [(0, 4, 10)]
+    assert reform_plan[3] == [(1, 0, 2)]
+    assert plan.get_replacement_owners(targets, numbers) == [0, 1, 3]
+
+
+def test_merge_ranges():
+    assert plan.merge_ranges([(0, 5), (5, 8), (8, 8), (10, 12), (20, 25), (25, 30)]) == [(0, 8), (10, 12), (20, 30)]
+
+
+@pytest.mark.parametrize('strategy', sorted(plan.shuffle_strategies))
+def test_plan_shuffle(strategy):
+    ranges = plan.plan_shuffle(timestamps, sample_rate, total, strategy, seed=5)
+    samples = expand(ranges)
+    # the new audio is exactly as long as the old, and the gaps between the dialogue are where they were
+    assert len(samples) == total
+    for start, end in plan.timestamps_to_samples(plan.get_intermediate_timestamps(timestamps, 10.0), sample_rate):
+        assert samples[start:end] == list(range(start, end))
+    assert ranges == plan.plan_shuffle(timestamps, sample_rate, total, strategy, seed=5)
+
+
+def test_plan_shuffle_repeated_lines():
+    texts = ['Oh no!', 'a', 'oh no', 'b', 'OH NO...']
+    ranges = plan.plan_shuffle(timestamps, sample_rate, total, seed=3, texts=texts)
+    samples = expand(ranges)
+    starts = [round(start * sample_rate) for start, _ in timestamps]
+    ends = [round(end * sample_rate) for _, end in timestamps]
+    # the longest time the line is said gets the whole replacement, and the others get the start of it
+    replacement = samples[starts[2]:ends[2]]
+    for i in (0, 4):
+        assert samples[starts[i]:ends[i]] == replacement[:ends[i] - starts[i]]
+
+
+@pytest.mark.parametrize('start, end', [(0, total), (0, 1500), (2500, 6100), (9000, total), (3000, 3000)])
+def test_cut_timeline(start, end):
+    ranges = plan.plan_shuffle(timestamps, sample_rate, total, seed=9)
+    assert expand(plan.cut_timeline(ranges, start, end)) == expand(ranges)[start:end]
@@ -0,0 +1,39 @@
+import argparse
+
+import pytest
+
+import kingsquit
+from conftest import decode, sound_alike
+
+
+@pytest.mark.parametrize('text, window', [
+    ('30', (0.0, 30.0)),
+    ('1.5', (0.0, 1.5)),
+    ('120-150', (120.0, 150.0)),
+    ('120-', (120.0, None)),
+])
+def test_get_preview_window(text, window):
+    assert kingsquit.get_preview_window(text) == window
+
+
+@pytest.mark.parametrize('text', ['soon', '10-five', '150-120', '10-10', '0', '-5'])
+def test_get_preview_window_invalid(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        kingsquit.get_preview_window(text)
+
+
+@pytest.mark.parametrize('video_preview', [False, True])
+def test_preview_sounds_like_the_full_video(video, video_preview):
+    prepared = kingsquit.prepare_video(video, video.with_suffix('.json'))
+    sample_rate = int(kingsquit.media.get_audio_stream_info(prepared.video_info)['sample_rate'])
+    full_path = kingsquit.make_variants(prepared, seed=1, output_path=video.with_name('new.mp4'))[0]
+    preview_path = kingsquit.make_preview(prepared, 1.0, 3.0, seed=1, video=video_preview)
+    full = decode(full_path)[sample_rate:3 * sample_rate]
+    preview = decode(preview_path)
+    # the encoder pads the end out to a whole frame
+    assert len(full) <= len(preview) < len(full) + 2048
+    # the encoder smears the very end of the preview
+    assert sound_alike(full[:-2048], preview[:len(full) - 2048])
+
+    with pytest.raises(ValueError):
+        kingsquit.make_preview(prepared, 10.0, seed=1)
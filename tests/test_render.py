@@ -0,0 +1,60 @@
+import numpy as np
+
+import kingsquit
+from conftest import decode, sound_alike
+
+
+def render(video, renderer, name='new.mp4', **kwargs):
+    """Shuffle the test video with a renderer, and check it's saved where it was asked to be."""
+    output_path = video.with_name(name)
+    paths = kingsquit.shuffle_video(video, video.with_suffix('.json'), renderer, seed=1, output_path=output_path,
+                                    **kwargs)
+    assert paths == [output_path]
+    return output_path
+
+
+def assert_shuffled(video, new_path):
+    """Check the new audio has exactly as many samples as the old, so it stays in sync, and has been shuffled."""
+    source, new = decode(video), decode(new_path)
+    assert len(new) == len(source)
+    assert not sound_alike(new, source)
+
+
+def test_filtergraph(video):
+    assert_shuffled(video, render(video, 'filtergraph'))
+
+
+def test_pcm(video):
+    assert_shuffled(video, render(video, 'pcm'))
+
+
+def test_variants(video):
+    prepared = kingsquit.prepare_video(video, video.with_suffix('.json'))
+    paths = kingsquit.make_variants(prepared, seed=1, variants=2, output_path=video.with_name('new.mp4'))
+    assert [path.name for path in paths] == ['new-1.mp4', 'new-2.mp4']
+    for path in paths:
+        assert_shuffled(video, path)
+    # each variant has its own seed
+    assert not sound_alike(decode(paths[0]), decode(paths[1]))
+
+
+def test_streaming(video):
+    assert_shuffled(video, render(video, 'streaming'))
+
+
+def test_clips(video):
+    assert_shuffled(video, render(video, 'clips'))
+
+
+def test_rerun_isnt_made_again(video):
+    new_path = render(video, 'pcm')
+    made = new_path.stat().st_mtime_ns
+    assert render(video, 'pcm') == new_path
+    assert new_path.stat().st_mtime_ns == made
+
+
+def test_streaming_max_scratch(video):
+    unbounded = render(video, 'streaming')
+    # too small for even one clip, so every clip is ripped again each time it's used
+    bounded = render(video, 'streaming', 'bounded.mp4', max_scratch=1)
+    assert np.array_equal(decode(bounded), decode(unbounded))
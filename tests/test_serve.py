@@ -0,0 +1,118 @@
+import json
+import socket
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pytest
+
+from kingsquit import serve
+
+
+@pytest.mark.parametrize('address, parsed', [
+    ('8000', (False, ('127.0.0.1', 8000))),
+    (':8000', (False, ('127.0.0.1', 8000))),
+    ('0.0.0.0:8000', (False, ('0.0.0.0', 8000))),
+    ('unix:kingsquit.sock', (True, 'kingsquit.sock')),
+    ('/tmp/kingsquit.sock', (True, '/tmp/kingsquit.sock')),
+])
+def test_parse_address(address, parsed):
+    assert serve.parse_address(address) == parsed
+
+
+@pytest.mark.parametrize('preview, window', [
+    (30, (0.0, 30)),
+    (1.5, (0.0, 1.5)),
+    ([120, 150], (120, 150)),
+    ([120, None], (120, None)),
+])
+def test_get_preview_window(preview, window):
+    assert serve.get_preview_window(preview) == window
+
+
+@pytest.mark.parametrize('preview', [True, '30', [120], [120, 150, 180], ['120', 150], [120, False], None])
+def test_get_preview_window_invalid(preview):
+    with pytest.raises(serve.RequestError) as error:
+        serve.get_preview_window(preview)
+    assert error.value.status == 400
+
+
+def test_unix_server_keeps_other_files(tmp_path):
+    path = tmp_path / 'notes.txt'
+    path.write_text('important')
+    with pytest.raises(FileExistsError):
+        serve.UnixServer(str(path), serve.Shuffler())
+    assert path.read_text() == 'important'
+
+
+def test_unix_server_replaces_old_socket(tmp_path):
+    path = tmp_path / 'kingsquit.sock'
+    with socket.socket(socket.AF_UNIX) as old_socket:
+        old_socket.bind(str(path))
+    server = serve.UnixServer(str(path), serve.Shuffler())
+    server.server_close()
+
+
+@pytest.fixture
+def server():
+    """Serve on a free port in another thread, and give the url to send requests to."""
+    tcp_server = serve.TCPServer(('127.0.0.1', 0), serve.Shuffler())
+    thread = threading.Thread(target=tcp_server.serve_forever, args=(0.01,))
+    thread.start()
+    yield f'http://127.0.0.1:{tcp_server.server_address[1]}'
+    tcp_server.shutdown()
+    thread.join()
+    tcp_server.server_close()
+
+
+def send(url, body=None):
+    """Send a request, POST if it has a body, and get the status and json it was answered with."""
+    data = body if body is None or isinstance(body, bytes) else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(url, data) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as err:
+        return err.code, json.load(err)
+
+
+def test_shuffle(server, video):
+    request = {'video': str(video), 'seed': 1, 'output': str(video.with_name('new.mp4'))}
+    answer = {'paths': [str(video.with_name('new.mp4').resolve())], 'seeds': [1]}
+    assert send(f'{server}/shuffle', request) == (200, answer)
+    assert video.with_name('new.mp4').is_file()
+    # the same shuffle again comes back from the journal with the same path
+    assert send(f'{server}/shuffle', request) == (200, answer)
+
+    status, videos = send(f'{server}/videos')
+    assert status == 200
+    assert [(v['video'], v['dialogue'], v['decoded_audio']) for v in videos['videos']] == [(str(video), 5, True)]
+
+
+@pytest.mark.parametrize('body, status', [
+    (b'{"video": ', 400),
+    ([], 400),
+    ({}, 400),
+    ({'video': 'video.mp4', 'renderer': 'fast'}, 400),
+    ({'video': 'video.mp4', 'strategy': 'sorted'}, 400),
+    ({'video': 'video.mp4', 'seed': 1.5}, 400),
+    ({'video': 'video.mp4', 'variants': 0}, 400),
+    ({'video': 'missing.mp4'}, 404),
+])
+def test_bad_requests(server, body, status):
+    answer_status, answer = send(f'{server}/shuffle', body)
+    assert answer_status == status
+    assert answer['error']
+
+
+def test_preview(server, video):
+    request = {'video': str(video), 'seed': 1, 'variants': 2, 'preview': [1, 3]}
+    status, answer = send(f'{server}/shuffle', request)
+    assert status == 200 and answer['seeds'] == [1, 2]
+    assert [Path(path).name for path in answer['paths']] == ['preview-1-1-3.m4a', 'preview-2-1-3.m4a']
+    assert send(f'{server}/shuffle', {**request, 'preview': [10, None]})[0] == 422
+
+
+def test_not_found(server):
+    assert send(f'{server}/shuffles', {})[0] == 404
+    assert send(f'{server}/video')[0] == 404
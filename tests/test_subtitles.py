@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+from kingsquit import subtitles, downloader
+
+
+ttml = '''<?xml version="1.0" encoding="utf-8"?>
+<tt xmlns="http://www.w3.org/ns/ttml" xmlns:ttp="http://www.w3.org/ns/ttml#parameter" ttp:tickRate="10000000">
+  <body>
+    <div begin="10s">
+      <p begin="00:00:01.500" end="00:00:02.000">Hello <span>there</span></p>
+      <p begin="30000000t" dur="5000000t">General
+      Kenobi</p>
+      <p>no timing</p>
+    </div>
+  </body>
+</tt>
+'''
+
+srt = '''1
+00:00:01,000 --> 00:00:02,500
+First line
+second line
+
+2
+00:01:00,250 --> 00:01:01,000
+<i>Second</i>
+'''
+
+vtt = '''WEBVTT
+
+00:01.000 --> 00:02.500 align:start
+First
+
+1:00:00.5 --> 1:00:01.000
+Second
+'''
+
+
+@pytest.mark.parametrize('expression, seconds', [
+    ('00:00:01.500', 1.5),
+    ('01:02:03', 3723.0),
+    ('00:00:01:15', 1.5),
+    ('1.5s', 1.5),
+    ('1500ms', 1.5),
+    ('2m', 120.0),
+    ('1h', 3600.0),
+    ('45f', 1.5),
+    ('15000000t', 1.5),
+])
+def test_parse_ttml_time(expression, seconds):
+    assert subtitles.parse_ttml_time(expression, 30.0, 10000000.0) == pytest.approx(seconds)
+
+
+def test_parse_ttml_time_invalid():
+    with pytest.raises(ValueError):
+        subtitles.parse_ttml_time('soon', 30.0, 1.0)
+
+
+def test_parse_ttml(tmp_path):
+    path = tmp_path / 'subs.ttml'
+    path.write_text(ttml)
+    # the div's begin is added on, and a paragraph without times is skipped
+    assert list(subtitles.parse_ttml(path)) == [
+        (11.5, 12.0, 'Hello there'),
+        (13.0, 13.5, 'General Kenobi'),
+    ]
+
+
+def test_parse_srt(tmp_path):
+    path = tmp_path / 'subs.srt'
+    path.write_text(srt)
+    assert list(subtitles.parse_cues(path)) == [
+        (1.0, 2.5, 'First line second line'),
+        (60.25, 61.0, '<i>Second</i>'),
+    ]
+
+
+def test_parse_srt_without_blank_lines(tmp_path):
+    path = tmp_path / 'subs.srt'
+    path.write_text('1\n00:00:01,000 --> 00:00:02,000\nOne\n2\n00:00:03,000 --> 00:00:04,000\nTwo\n')
+    assert list(subtitles.parse_cues(path)) == [(1.0, 2.0, 'One'), (3.0, 4.0, 'Two')]
+
+
+def test_parse_vtt(tmp_path):
+    path = tmp_path / 'subs.vtt'
+    path.write_text(vtt)
+    assert list(subtitles.parse_cues(path)) == [(1.0, 2.5, 'First'), (3600.5, 3601.0, 'Second')]
+
+
+@pytest.mark.parametrize('name, text, sub_format', [
+    ('a.ttml', '', 'ttml'),
+    ('a.dfxp', '', 'ttml'),
+    ('a.VTT', '', 'vtt'),
+    ('a.srt', '', 'srt'),
+    ('a.txt', '\ufeffWEBVTT\n', 'vtt'),
+    ('a.txt', '<tt/>', 'ttml'),
+    ('a.txt', '1\n00:00:01,000 --> 00:00:02,000\n', 'srt'),
+    ('a.txt', 'just some text', None),
+])
+def test_detect_format(tmp_path, name, text, sub_format):
+    path = tmp_path / name
+    path.write_text(text, encoding='utf-8')
+    assert subtitles.detect_format(path) == sub_format
+
+
+def test_write_timestamps(tmp_path):
+    path = tmp_path / 'subs.json'
+    count = subtitles.write_timestamps(iter([(0.1 + 0.2, 1.0, 'a "quote"'), (2.0, 3.0, '')]), path)
+    assert count == 2
+    assert json.loads(path.read_text()) == [[0.3, 1.0, 'a "quote"'], [2.0, 3.0, '']]
+
+
+def test_write_timestamps_stopped(tmp_path):
+    path = tmp_path / 'subs.json'
+    path.write_text('[]')
+
+    def cues():
+        yield 1.0, 2.0, 'a'
+        raise KeyError
+
+    with pytest.raises(KeyError):
+        subtitles.write_timestamps(cues(), path)
+    # the old timestamps are kept until the new ones are all written
+    assert path.read_text() == '[]'
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_convert_subs(tmp_path):
+    path = tmp_path / 'video.srt'
+    path.write_text(srt)
+    assert downloader.convert_subs(path)
+    assert json.loads(path.with_suffix('.json').read_text()) == [[1.0, 2.5, 'First line second line'],
+                                                                 [60.25, 61.0, '<i>Second</i>']]
+
+
+def test_convert_invalid_subs(tmp_path):
+    path = tmp_path / 'video.ttml'
+    path.write_text('<tt><body><p begin="soon" end="later">Hi</p></body></tt>')
+    assert not downloader.convert_subs(path)
+    assert not path.with_suffix('.json').exists()
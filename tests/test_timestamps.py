@@ -0,0 +1,88 @@
+import pytest
+
+from kingsquit.timestamps import normalise_timestamps, describe_report
+
+
+def normalise(cues, duration=100.0, **kwargs):
+    timestamps, texts, report = normalise_timestamps(cues, duration, **kwargs)
+    return [(pytest.approx(start), pytest.approx(end)) for start, end in timestamps], texts, report
+
+
+def test_clean_cues_are_kept():
+    timestamps, texts, report = normalise([[1, 2, 'a'], [3, 4, 'b']])
+    assert timestamps == [(1, 2), (3, 4)]
+    assert texts == ['a', 'b']
+    assert report['input'] == report['output'] == 2
+
+
+def test_clamped_to_the_video():
+    timestamps, _, report = normalise([[-1, 2], [5, 15], [20, 30]], duration=10.0)
+    # the last cue is entirely past the end, so it's empty once clamped. the first now starts at 0, and the second
+    # ends at the end
+    assert timestamps == [(0, 2), (5, 10)]
+    assert report['clamped'] == 3
+    assert report['dropped'] == 1
+
+
+def test_sorted_and_overlaps_joined():
+    timestamps, texts, report = normalise([[5, 6, 'c'], [1, 3, 'a'], [2, 4, 'b']])
+    assert timestamps == [(1, 4), (5, 6)]
+    assert texts == ['a b', 'c']
+    assert report['overlaps_merged'] == 1
+
+
+def test_cue_inside_a_longer_one():
+    timestamps, texts, _ = normalise([[1, 10, 'long'], [2, 3, 'inside'], [9.5, 12, 'after']])
+    assert timestamps == [(1, 12)]
+    assert texts == ['long inside after']
+
+
+def test_short_gaps_joined():
+    timestamps, _, report = normalise([[1, 2], [2.05, 3], [3.5, 4]], min_gap=0.1)
+    assert timestamps == [(1, 3), (3.5, 4)]
+    assert report['short_gaps_merged'] == 1
+
+
+def test_duplicates_dropped():
+    timestamps, texts, report = normalise([[1, 2, 'hi'], [1, 2, 'hi'], [1, 2, 'ho']])
+    assert timestamps == [(1, 2)]
+    assert texts == ['hi ho']
+    assert report['duplicates_dropped'] == 1
+
+
+def test_short_cue_joined_onto_its_nearest_neighbour():
+    timestamps, texts, report = normalise([[1, 2, 'a'], [2.3, 2.4, 'b'], [3, 4, 'c']], min_cue=0.25, max_join=0.5)
+    assert timestamps == [(1, 2.4), (3, 4)]
+    assert texts == ['a b', 'c']
+    assert report['short_cues_merged'] == 1
+
+
+def test_lone_short_cues_padded():
+    timestamps, texts, report = normalise([[1, 1.1, 'a'], [3, 3.1, 'b']], min_cue=0.25)
+    assert timestamps == [(0.925, 1.175), (2.925, 3.175)]
+    assert texts == ['a', 'b']
+    assert report['short_cues_padded'] == 2
+    assert report['short_cues_merged'] == 0
+
+
+def test_padding_leaves_the_gap_between():
+    # the short cues are too far apart to join, so they're padded, sharing the room between them
+    timestamps, _, _ = normalise([[1, 1.1], [1.7, 1.8]], min_cue=0.5, min_gap=0.2, max_join=0.5)
+    assert timestamps == [(0.8, 1.3), (1.5, 2.0)]
+
+
+def test_ends_closed_up():
+    timestamps, _, _ = normalise([[0.05, 1], [2, 9.95]], duration=10.0, min_gap=0.1)
+    assert timestamps == [(0, 1), (2, 10)]
+
+
+def test_old_timestamps_without_text():
+    _, texts, _ = normalise([[1, 2], [3, 4]])
+    assert texts == ['', '']
+
+
+def test_empty():
+    timestamps, texts, report = normalise([])
+    assert timestamps == [] and texts == []
+    assert report['output'] == 0
+    assert describe_report(report).startswith('0 timestamps -> 0')
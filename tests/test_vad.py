@@ -0,0 +1,93 @@
+import json
+import wave
+import shutil
+
+import numpy as np
+import pytest
+
+from kingsquit import vad
+from kingsquit.media import MediaError
+
+
+speech = [(3.0, 6.0), (11.0, 12.5)]
+
+
+def make_audio(length, speech, seed=0):
+    """Make quiet noise with bursts of syllables, each a short buzz at a random pitch, where the speech is."""
+    rng = np.random.default_rng(seed)
+    audio = rng.normal(0, 0.001, round(length * vad.sample_rate)).astype(np.float32)
+    t = np.arange(round(0.15 * vad.sample_rate)) / vad.sample_rate
+    for start, end in speech:
+        position = start
+        while position < end - 0.15:
+            pitch = rng.uniform(100, 250)
+            syllable = sum(np.sin(2 * np.pi * pitch * k * t) / k for k in range(1, 15)) * np.hanning(len(t))
+            i = round(position * vad.sample_rate)
+            audio[i:i + len(t)] += 0.2 * syllable.astype(np.float32)
+            position += rng.uniform(0.15, 0.25)
+    return audio
+
+
+def to_frames(audio):
+    return audio[:len(audio) // vad.frame_length * vad.frame_length].reshape(-1, vad.frame_length)
+
+
+def find_dialogue(chunks):
+    return list(vad.join_runs(vad.iter_speech_runs(chunks)))
+
+
+def assert_found(cues):
+    assert len(cues) == len(speech)
+    for (start, end, text), (speech_start, speech_end) in zip(cues, speech):
+        assert speech_start - 0.2 <= start <= speech_start and speech_end - 0.2 <= end <= speech_end + 0.2
+        assert text == ''
+
+
+def test_join_runs():
+    frame = vad.frame_length / vad.sample_rate
+    seconds = [(0.0, 1.0), (1.1, 2.0), (5.0, 5.1), (8.0, 9.0)]
+    runs = [(round(start / frame), round(end / frame)) for start, end in seconds]
+    # the short pause is joined up, the short blip is dropped, and the padding doesn't go before the start
+    assert list(vad.join_runs(runs, min_speech=0.25, min_pause=0.3, padding=0.1)) == [
+        (0.0, pytest.approx(2.1), ''), (pytest.approx(7.9), pytest.approx(9.1), '')]
+    assert list(vad.join_runs([])) == []
+
+
+def test_finds_speech():
+    frames = to_frames(make_audio(20.0, speech))
+    assert_found(find_dialogue([frames]))
+    # the detector carries on across chunks, so it finds the same wherever they're split
+    assert find_dialogue(frames[i:i + 400] for i in range(0, len(frames), 400)) == find_dialogue([frames])
+
+
+def test_ignores_noise_and_tones():
+    assert find_dialogue([to_frames(make_audio(20.0, []))]) == []
+    tone = 0.3 * np.sin(2 * np.pi * 440 * np.arange(20 * vad.sample_rate) / vad.sample_rate)
+    assert find_dialogue([to_frames(tone.astype(np.float32))]) == []
+
+
+@pytest.fixture
+def needs_ffmpeg():
+    if not shutil.which('ffmpeg'):
+        pytest.skip('needs the ffmpeg executable')
+
+
+def test_detect_speech(tmp_path, needs_ffmpeg):
+    audio_path = tmp_path / 'speech.wav'
+    with wave.open(str(audio_path), 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(vad.sample_rate)
+        wav_file.writeframes((make_audio(20.0, speech) * 32767).astype('<i2').tobytes())
+    timestamps_path = tmp_path / 'speech.json'
+    assert vad.detect_speech(audio_path, timestamps_path) == len(speech)
+    assert_found(json.loads(timestamps_path.read_text()))
+
+
+def test_detect_speech_fails(tmp_path, needs_ffmpeg):
+    timestamps_path = tmp_path / 'speech.json'
+    timestamps_path.write_text('[[1.0,2.0,""]]')
+    with pytest.raises(MediaError):
+        vad.detect_speech(tmp_path / 'missing.mp4', timestamps_path)
+    # the timestamps from before are kept
+    assert timestamps_path.read_text() == '[[1.0,2.0,""]]'